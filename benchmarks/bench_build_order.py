@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Christoph Reiter
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+"""Measures ordering the PKGBUILD files of a synthetic repo for building,
+compared to the comparison based sort it replaced.
+
+    python benchmarks/bench_build_order.py [count]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import random
+import timeit
+from functools import cmp_to_key
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from m2hlib.build import get_pkgbuilds_to_build_in_order
+from m2hlib.srcinfo import SrcInfoPackage, SrcInfoPool
+
+
+def legacy_order(packages_todo):
+    # the sort before the topological one, for comparison
+    pool = SrcInfoPool()
+    pkgbuilds = {}
+    for package in packages_todo:
+        pool.add_package(package)
+        pkgbuilds.setdefault(package.pkgbuild_path, set()).add(package)
+
+    def cmp_(a, b):
+        return (a > b) - (a < b)
+
+    def cmp_func(aa, bb):
+        at = set()
+        for a in aa:
+            a_name = a.pkgname
+            at.update(pool.get_transitive_dependencies(a))
+        bt = set()
+        for b in bb:
+            b_name = b.pkgname
+            bt.update(pool.get_transitive_dependencies(b))
+        a_key = (len(at), a_name)
+        b_key = (len(bt), b_name)
+        if a_name in bt and b_name in at:
+            return cmp_(a_key, b_key)
+        elif a_name in bt:
+            return -1
+        elif b_name in at:
+            return 1
+        else:
+            return cmp_(a_key, b_key)
+
+    return sorted(pkgbuilds.items(),
+                  key=cmp_to_key(lambda a, b: cmp_func(a[1], b[1])))
+
+
+def get_packages(count, seed=0):
+    """`count` PKGBUILDs, each with two packages depending on up to eight
+    packages of earlier PKGBUILDs.
+    """
+
+    rand = random.Random(seed)
+    packages = []
+    for i in range(count):
+        path = os.path.join("mingw-w64-pkg%d" % i, "PKGBUILD")
+        deps = ["pkg%d" % j for j in rand.sample(range(i), min(i, 8))]
+        for suffix in ["", "-docs"]:
+            p = SrcInfoPackage(
+                path, "pkg%d" % i, "pkg%d%s" % (i, suffix), "1.0", "1")
+            p.depends = tuple(d + ">=1.0" for d in deps[:4])
+            p.makedepends = tuple(deps[4:])
+            packages.append(p)
+    return packages
+
+
+def count_violations(order):
+    position = {}
+    for i, (path, packages) in enumerate(order):
+        for p in packages:
+            position[p.pkgname] = i
+    violations = 0
+    for i, (path, packages) in enumerate(order):
+        for p in packages:
+            for dep in p.depends + p.makedepends:
+                if position[dep.split(">=")[0]] > i:
+                    violations += 1
+    return violations
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 5000
+    packages = get_packages(count)
+
+    repeat = 5
+    new = min(timeit.repeat(
+        lambda: get_pkgbuilds_to_build_in_order(packages),
+        number=1, repeat=repeat))
+    order = get_pkgbuilds_to_build_in_order(packages)[1]
+    print("%d PKGBUILDs: %.1f ms, %d dependencies ordered wrong" % (
+        count, new * 1000, count_violations(order)))
+
+    # the old sort is too slow for the full set
+    count = min(count, 300)
+    packages = get_packages(count)
+    old = min(timeit.repeat(
+        lambda: legacy_order(packages), number=1, repeat=1))
+    new = min(timeit.repeat(
+        lambda: get_pkgbuilds_to_build_in_order(packages),
+        number=1, repeat=repeat))
+    print("%d PKGBUILDs: comparison sort %.1f ms, "
+          "topological %.1f ms (%.0fx), %d dependencies ordered wrong "
+          "before" % (count, old * 1000, new * 1000, old / new,
+                      count_violations(legacy_order(packages))))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Christoph Reiter
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+"""Measures finding the PKGBUILD files in a synthetic repo, compared to the
+os.walk() based search.
+
+    python benchmarks/bench_discovery.py [repo_path]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import timeit
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from m2hlib import srcinfo
+
+
+def find_pkgbuilds_walk(repo_path):
+    # the search before it used scandir, for comparison
+    pkgbuild_paths = []
+    for base, dirs, files in os.walk(repo_path):
+        for f in files:
+            if f == "PKGBUILD":
+                del dirs[:]
+                path = os.path.join(base, f)
+                pkgbuild_paths.append(path)
+    pkgbuild_paths.sort()
+    return pkgbuild_paths
+
+
+def create_repo(path, count=2000, patches=20, leftovers=50):
+    """A repo with `count` package directories, each with some patches and
+    a few with build leftovers, plus a .git directory.
+    """
+
+    def touch(*parts):
+        with open(os.path.join(path, *parts), "wb"):
+            pass
+
+    for i in range(count):
+        name = "mingw-w64-pkg%d" % i
+        os.makedirs(os.path.join(path, name))
+        touch(name, "PKGBUILD")
+        for j in range(patches):
+            touch(name, "%04d-fix.patch" % j)
+        if i % 100 == 0:
+            for sub in ["src", "pkg"]:
+                os.makedirs(os.path.join(path, name, sub))
+                for j in range(leftovers):
+                    touch(name, sub, "file%d" % j)
+
+    for i in range(256):
+        os.makedirs(os.path.join(path, ".git", "objects", "%02x" % i))
+        for j in range(10):
+            touch(".git", "objects", "%02x" % i, "obj%d" % j)
+
+
+def main(argv):
+    temp_dir = None
+    if len(argv) > 1:
+        repo_path = argv[1]
+    else:
+        temp_dir = repo_path = tempfile.mkdtemp()
+        create_repo(repo_path)
+
+    try:
+        old = find_pkgbuilds_walk(repo_path)
+        new = list(srcinfo._find_pkgbuilds(repo_path, {}))
+        print("%d PKGBUILD files" % len(new))
+        assert sorted(old) == sorted(new)
+
+        repeat = 5
+        old = min(timeit.repeat(
+            lambda: find_pkgbuilds_walk(repo_path), number=1, repeat=repeat))
+        new = min(timeit.repeat(
+            lambda: list(srcinfo._find_pkgbuilds(repo_path, {})),
+            number=1, repeat=repeat))
+        print("os.walk: %.1f ms" % (old * 1000))
+        print("scandir: %.1f ms (%.2fx)" % (new * 1000, old / new))
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Christoph Reiter
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+"""Measures the memory used by the package records of a synthetic
+10k package pool, compared to plain objects holding lists of strings.
+
+    python3 benchmarks/bench_memory.py
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from m2hlib import utils
+from m2hlib.srcinfo import SrcInfoPackage
+from m2hlib.pacman import PacmanPackage
+
+ARCHES = [("mingw64", "x86_64"), ("mingw32", "i686")]
+
+
+class LegacySrcInfoPackage(object):
+    # how the records looked like before, a __dict__ and lists
+
+    def __init__(self, pkgbuild_path, pkgbase, pkgname, pkgver, pkgrel):
+        self.pkgbuild_path = pkgbuild_path
+        self.pkgbase = pkgbase
+        self.pkgname = pkgname
+        self.pkgver = pkgver
+        self.pkgrel = pkgrel
+        self.epoch = None
+        self.depends = []
+        self.makedepends = []
+        self.sources = []
+        self._version_key = None
+
+
+class LegacyPacmanPackage(object):
+
+    def __init__(self, repo, pkgname, version):
+        self.repo = repo
+        self.pkgname = pkgname
+        self.epoch = None
+        self.pkgver, self.pkgrel = version.rsplit("-", 1)
+        self._version_key = None
+
+
+def legacy_for_srcinfo(pkgbuild_path, srcinfo):
+    packages = set()
+    for line in srcinfo.splitlines():
+        key, sep, value = line.strip().partition(" = ")
+        if key == "pkgbase":
+            pkgver = pkgrel = None
+            depends = []
+            makedepends = []
+            sources = []
+            pkgbase = value
+        elif key == "depends":
+            depends.append(value)
+        elif key == "makedepends":
+            makedepends.append(value)
+        elif key == "source":
+            sources.append(value)
+        elif key == "pkgver":
+            pkgver = value
+        elif key == "pkgrel":
+            pkgrel = value
+        elif key == "pkgname":
+            package = LegacySrcInfoPackage(
+                pkgbuild_path, pkgbase, value, pkgver, pkgrel)
+            package.depends = depends
+            package.makedepends = makedepends
+            package.sources = sources
+            packages.add(package)
+    return packages
+
+
+def get_synthetic_pool(count, seed=0):
+    """Returns srcinfo texts and `pacman -Sl` lines for `count` packages"""
+
+    rand = random.Random(seed)
+    names = ["lib%d" % i for i in range(count // len(ARCHES))]
+    texts = []
+    lines = []
+    for name in names:
+        text = []
+        deps = rand.sample(names, rand.randint(1, 15))
+        makedeps = rand.sample(names, rand.randint(0, 10))
+        for repo, arch in ARCHES:
+            prefix = "mingw-w64-%s-" % arch
+            text.append("pkgbase = mingw-w64-%s" % name)
+            text.append("\tpkgver = 1.%d" % rand.randint(0, 20))
+            text.append("\tpkgrel = 1")
+            for dep in deps:
+                text.append("\tdepends = %s%s" % (prefix, dep))
+            for dep in makedeps:
+                text.append("\tmakedepends = %s%s" % (prefix, dep))
+            text.append("\tsource = https://example.com/%s.tar.xz" % name)
+            text.append("")
+            text.append("pkgname = %s%s" % (prefix, name))
+            text.append("")
+            lines.append("%s %s%s 1.0-1" % (repo, prefix, name))
+        texts.append("\n".join(text))
+    return texts, lines
+
+
+def measure(func):
+    utils._STRINGS.clear()
+    tracemalloc.start()
+    try:
+        result = func()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    count = 10000
+    texts, lines = get_synthetic_pool(count)
+
+    def srcinfo_new():
+        return [SrcInfoPackage.for_srcinfo("PKGBUILD", t) for t in texts]
+
+    def srcinfo_old():
+        return [legacy_for_srcinfo("PKGBUILD", t) for t in texts]
+
+    def pacman_new():
+        return [PacmanPackage(*l.split()) for l in lines]
+
+    def pacman_old():
+        return [LegacyPacmanPackage(*l.split()) for l in lines]
+
+    print("%d packages" % count)
+    for name, old, new in [("srcinfo", srcinfo_old, srcinfo_new),
+                           ("pacman", pacman_old, pacman_new)]:
+        old_size = measure(old)
+        new_size = measure(new)
+        print("%s: %.1f MiB -> %.1f MiB (%.0f%% less)" % (
+            name, old_size / 2.0 ** 20, new_size / 2.0 ** 20,
+            100.0 - new_size * 100.0 / old_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Christoph Reiter
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+"""Runs the build scheduler with the simulated builder on synthetic
+PKGBUILD graphs and reports its overhead and the makespan.
+
+    python benchmarks/bench_scheduler.py [jobs]
+
+For each graph size there are two runs: one where builds take no time,
+which shows the time spent per build outside of building, and one with
+random build times, scaled down, where the makespan is compared to the
+one simulate_builds() predicts.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from m2hlib import build
+from m2hlib.srcinfo import SrcInfoPackage
+
+
+def get_packages(count, seed=0):
+    """`count` PKGBUILDs with one package each, depending on up to four
+    packages of the 50 PKGBUILDs before them.
+    """
+
+    rand = random.Random(seed)
+    packages = []
+    for i in range(count):
+        name = "pkg%d" % i
+        p = SrcInfoPackage(
+            os.path.join(name, "PKGBUILD"), name, name, "1.0", "1")
+        earlier = range(max(0, i - 50), i)
+        p.depends = tuple(
+            "pkg%d" % j for j in rand.sample(earlier, min(len(earlier), 4)))
+        packages.append(p)
+    return packages
+
+
+@contextlib.contextmanager
+def quiet():
+    stdout = sys.stdout
+    with open(os.devnull, "w") as h:
+        sys.stdout = h
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def run(packages, builder, jobs):
+    target_path = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        pool, pkgbuilds, cycles = build.get_pkgbuilds_to_build_in_order(
+            packages)
+        dependencies = build.get_build_dependencies(pool, pkgbuilds)
+        planned = time.time()
+        durations = [builder.durations.get(list(ps)[0].pkgbase, 0.0)
+                     for path, ps in pkgbuilds]
+        with quiet():
+            build.build_pkgbuilds(
+                pkgbuilds, dependencies, builder, target_path, jobs=jobs,
+                durations=durations)
+        end = time.time()
+    finally:
+        shutil.rmtree(target_path)
+    predicted = build.simulate_builds(dependencies, durations, jobs)
+    return planned - start, end - planned, predicted
+
+
+def main(argv):
+    jobs = int(argv[1]) if len(argv) > 1 else 8
+    rand = random.Random(0)
+    print("%d jobs" % jobs)
+    for count in [100, 1000, 10000]:
+        packages = get_packages(count)
+
+        builder = build.SimulatedBuilder()
+        plan, makespan, predicted = run(packages, builder, jobs)
+        print("%5d PKGBUILDs: planning %.0f ms, %.2f ms per build" % (
+            count, plan * 1000, makespan * 1000 / count))
+
+        # 0.5 to 60 "minutes", one minute is 2 ms here
+        scale = 0.002
+        durations = dict(
+            (p.pkgbase, rand.uniform(0.5, 60) * scale) for p in packages)
+        if count > 1000:
+            # keep the run short
+            durations = dict((k, v / 10) for k, v in durations.items())
+        builder = build.SimulatedBuilder(durations=durations)
+        plan, makespan, predicted = run(packages, builder, jobs)
+        print("%5d PKGBUILDs: makespan %.2f s, predicted %.2f s (%+.1f%%)" % (
+            count, makespan, predicted,
+            (makespan - predicted) * 100 / predicted))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
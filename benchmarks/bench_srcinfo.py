@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Christoph Reiter
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+"""Measures how long parsing the bundled srcinfo cache takes.
+
+    python benchmarks/bench_srcinfo.py
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from m2hlib.srcinfo import SrcInfoPackage
+from m2hlib.srcinfocache import JSON_PATH
+
+
+def for_srcinfo_old(pkgbuild_path, srcinfo):
+    # the parser before it got table driven, for comparison
+    packages = set()
+
+    for line in srcinfo.splitlines():
+        line = line.strip()
+        if line.startswith("pkgbase = "):
+            pkgver = pkgrel = epoch = None
+            depends = []
+            makedepends = []
+            sources = []
+            pkgbase = line.split(" = ", 1)[-1]
+        elif line.startswith("depends = "):
+            depends.append(line.split(" = ", 1)[-1])
+        elif line.startswith("makedepends = "):
+            makedepends.append(line.split(" = ", 1)[-1])
+        elif line.startswith("source = "):
+            sources.append(line.split(" = ", 1)[-1])
+        elif line.startswith("pkgver = "):
+            pkgver = line.split(" = ", 1)[-1]
+        elif line.startswith("pkgrel = "):
+            pkgrel = line.split(" = ", 1)[-1]
+        elif line.startswith("epoch = "):
+            epoch = line.split(" = ", 1)[-1]
+        elif line.startswith("pkgname = "):
+            pkgname = line.split(" = ", 1)[-1]
+            package = SrcInfoPackage(
+                pkgbuild_path, pkgbase, pkgname, pkgver, pkgrel)
+            package.epoch = epoch
+            package.depends = depends
+            package.makedepends = makedepends
+            package.sources = sources
+            packages.add(package)
+
+    return packages
+
+
+def main():
+    with open(JSON_PATH, "rb") as h:
+        texts = list(json.loads(h.read().decode("utf-8")).values())
+
+    def run(func):
+        for text in texts:
+            func("PKGBUILD", text)
+
+    count = sum(len(SrcInfoPackage.for_srcinfo("", t)) for t in texts)
+    print("%d srcinfo texts, %d packages" % (len(texts), count))
+
+    repeat = 20
+    old = min(timeit.repeat(
+        lambda: run(for_srcinfo_old), number=1, repeat=repeat))
+    new = min(timeit.repeat(
+        lambda: run(SrcInfoPackage.for_srcinfo), number=1, repeat=repeat))
+    print("old parser: %.1f ms" % (old * 1000))
+    print("new parser: %.1f ms (%.2fx)" % (new * 1000, old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -28,7 +28,7 @@ import sys
 import argparse
 
 from m2hlib import build_check, update_check, dll_check, url_check, build,\
-    check
+    check, cache
 
 
 def main(argv):
@@ -44,6 +44,7 @@ def main(argv):
     url_check.add_parser(subparser)
     build.add_parser(subparser)
     check.add_parser(subparser)
+    cache.add_parser(subparser)
 
     args = parser.parse_args(argv[1:])
     return args.func(args)
@@ -25,87 +25,548 @@
 from __future__ import print_function
 
 import os
-import sys
+import time
+import errno
+import heapq
+import shutil
+import tempfile
+import threading
 import subprocess
+from collections import deque
+from contextlib import contextmanager
 
-from .srcinfo import SrcInfoPool, iter_packages
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .srcinfo import SrcInfoPool, add_iter_packages_arguments, \
+    iter_packages_for_args
 from .pacman import PacmanPackage
-from .utils import version_is_newer_than, version_cmp
+from .utils import compare_versions, popen_process_group, \
+    kill_process_group, release_process_group, kill_process_groups
+from .depgraph import topological_order, get_transitive_closures, iter_bits
+from .buildjournal import BuildJournal, get_pkgbuild_key
+from .buildstats import BuildStats, format_duration
 
 
-def sorted_with_cmp(sequence, cmp_func, **kwargs):
-    # sort with a cmp func which works under both Python 2 and 3
+def get_pkgbuilds_to_build_in_order(packages_todo):
+    """Returns the PKGBUILD files in the order they need to be build
 
-    if sys.version_info[0] == 3:
-        from functools import cmp_to_key
+    Args:
+        packages_todo (iterable): SrcInfoPackage instances
+    Returns:
+        tuple: (pool, pkgbuilds, cycles) where pool is a SrcInfoPool of
+            all packages, pkgbuilds a list of (path, set(SrcInfoPackage))
+            with dependencies first and cycles a list of lists of PKGBUILD
+            paths which depend on each other
+    """
 
-        key = cmp_to_key(cmp_func)
+    pool = SrcInfoPool()
+    pkgbuilds = {}
+    for package in packages_todo:
+        pool.add_package(package)
+        pkgbuilds.setdefault(package.pkgbuild_path, set()).add(package)
 
-        def do_sort(x):
-            return sorted(x, key=key, **kwargs)
-    else:
-        def do_sort(x):
-            return sorted(x, cmp=cmp_func, **kwargs)
+    paths = sorted(pkgbuilds)
+    edges = _get_pkgbuild_edges(pool, paths)
 
-    return do_sort(sequence)
+    order = []
+    cycles = []
+    for component in topological_order(edges):
+        if len(component) > 1:
+            cycles.append([paths[i] for i in component])
+        for i in component:
+            order.append((paths[i], pkgbuilds[paths[i]]))
 
+    return pool, order, cycles
 
-def cmp_(a, b):
-    return (a > b) - (a < b)
 
+def _get_pkgbuild_edges(pool, paths):
+    # a graph of the PKGBUILD files, built from the one of the packages
+    path_ids = dict((path, i) for i, path in enumerate(paths))
+    graph = pool.get_graph()
+    edges = [set() for path in paths]
+    for i, package in enumerate(graph.packages):
+        if package.pkgbuild_path not in path_ids:
+            continue
+        targets = edges[path_ids[package.pkgbuild_path]]
+        for j in graph.get_dependency_ids(i):
+            target = path_ids.get(graph.packages[j].pkgbuild_path)
+            if target is not None:
+                targets.add(target)
+    for i, targets in enumerate(edges):
+        targets.discard(i)
+    return edges
 
-def get_pkgbuilds_to_build_in_order(packages_todo):
-    """Returns a list of PKGBUILD files in the order they need to be build"""
 
-    pool = SrcInfoPool()
-    pkgbuilds = {}
-    for package in packages_todo:
-        pool.add_package(package)
-        pkgbuilds.setdefault(package.pkgbuild_path, set()).add(package)
+def get_build_dependencies(pool, pkgbuilds):
+    """Which PKGBUILD files have to be built before another one can start.
 
-    # now sort the pkgbuilds by the dependencies of the contained packages
+    PKGBUILD files depending on each other get built one after the other,
+    in the order of pkgbuilds.
 
-    def cmp_func(aa, bb):
-        """Takes two sets of packages ands sorts according to their
-        dependencies.
-        """
+    Args:
+        pool (SrcInfoPool)
+        pkgbuilds (list): [(path, set(SrcInfoPackage))]
+    Returns:
+        list(set(int)): For each entry in pkgbuilds the indices of the
+            entries it has to wait for
+    """
+
+    edges = _get_pkgbuild_edges(pool, [path for path, packages in pkgbuilds])
+    components = topological_order(edges)
+    component_of = [0] * len(edges)
+    for c, component in enumerate(components):
+        for i in component:
+            component_of[i] = c
+
+    dependencies = []
+    for i, targets in enumerate(edges):
+        dependencies.append(
+            set(j for j in targets if component_of[j] != component_of[i]))
+    for component in components:
+        for a, b in zip(component, component[1:]):
+            dependencies[b].add(a)
+    return dependencies
+
+
+# How the build of a PKGBUILD file ended
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+def get_reverse_dependencies(dependencies):
+    """
+    Args:
+        dependencies (list): see get_build_dependencies()
+    Returns:
+        list(list(int)): For each entry the indices of the entries waiting
+            for it
+    """
 
-        at = set()
-        for a in aa:
-            a_name = a.pkgname
-            at.update(pool.get_transitive_dependencies(a))
-
-        bt = set()
-        for b in bb:
-            b_name = b.pkgname
-            bt.update(pool.get_transitive_dependencies(b))
-
-        # make the result deterministic,
-        # packages with fewer dependencies first
-        a_key = (len(at), a_name)
-        b_key = (len(bt), b_name)
-
-        if a_name in bt and b_name in at:
-            # cyclic dependency!
-            return cmp_(a_key, b_key)
-        elif a_name in bt:
-            return -1
-        elif b_name in at:
-            return 1
+    users = [[] for deps in dependencies]
+    for i, deps in enumerate(dependencies):
+        for j in deps:
+            users[j].append(i)
+    return users
+
+
+def get_expected_durations(stats, pkgbuilds):
+    """
+    Args:
+        stats (BuildStats)
+        pkgbuilds (list): [(path, set(SrcInfoPackage))]
+    Returns:
+        list(float) or None: The expected build time of each entry, taken
+            from earlier builds. Entries which weren't built before get
+            the median. None if none of them was built before.
+    """
+
+    durations = []
+    for path, packages in pkgbuilds:
+        pkgbase = list(packages)[0].pkgbase
+        durations.append(stats.get_duration(pkgbase))
+    known = sorted(d for d in durations if d is not None)
+    if not known:
+        return None
+    default = known[len(known) // 2]
+    return [default if d is None else d for d in durations]
+
+
+def get_priorities(dependencies, durations):
+    """
+    Args:
+        dependencies (list): see get_build_dependencies()
+        durations (list(float)): The expected build time of each entry
+    Returns:
+        list(float): For each entry the expected time of the longest chain
+            of builds starting with it
+    """
+
+    users = get_reverse_dependencies(dependencies)
+    priorities = [0.0] * len(dependencies)
+    for component in reversed(topological_order(dependencies)):
+        for i in component:
+            priorities[i] = durations[i] + max(
+                [priorities[u] for u in users[i]] or [0.0])
+    return priorities
+
+
+def get_critical_path(dependencies, durations):
+    """
+    Returns:
+        list(int): The indices of the longest chain of builds by expected
+            time, in build order
+    """
+
+    priorities = get_priorities(dependencies, durations)
+    users = get_reverse_dependencies(dependencies)
+    path = []
+    candidates = range(len(dependencies))
+    while candidates:
+        i = max(candidates, key=lambda i: (priorities[i], -i))
+        path.append(i)
+        candidates = users[i]
+    return path
+
+
+def simulate_builds(dependencies, durations, jobs=1):
+    """
+    Returns:
+        float: The time run_builds() is expected to take with the given
+            durations
+    """
+
+    priorities = get_priorities(dependencies, durations)
+    users = get_reverse_dependencies(dependencies)
+    pending = [len(deps) for deps in dependencies]
+    ready = [(-priorities[i], i) for i in range(len(dependencies))
+             if not pending[i]]
+    heapq.heapify(ready)
+    running = []
+    now = 0.0
+    while ready or running:
+        while ready and len(running) < max(jobs, 1):
+            i = heapq.heappop(ready)[1]
+            heapq.heappush(running, (now + durations[i], i))
+        now, i = heapq.heappop(running)
+        for user in users[i]:
+            pending[user] -= 1
+            if not pending[user]:
+                heapq.heappush(ready, (-priorities[user], user))
+    return now
+
+
+def run_builds(pkgbuilds, dependencies, build_func, jobs=1, completed=(),
+               durations=None):
+    """Builds PKGBUILD files in parallel, each one as soon as all the ones
+    it depends on are built. If a build fails everything depending on it
+    gets skipped.
+
+    Args:
+        pkgbuilds (list): [(path, set(SrcInfoPackage))]
+        dependencies (list): see get_build_dependencies()
+        build_func (callable): gets passed (path, packages) from a thread
+            and raises BuildError if the build failed
+        jobs (int): The maximum number of builds running at the same time
+        completed (iterable): indices of entries which are already built
+        durations (list(float) or None): The expected build time of each
+            entry. If given the builds with the longest chain of builds
+            depending on them start first, and an ETA gets printed.
+            Otherwise they start in the order of pkgbuilds.
+    Returns:
+        tuple: (states, blocked_by) where states contains DONE, FAILED or
+            SKIPPED for each entry in pkgbuilds and blocked_by maps the
+            index of each skipped entry to the set of indices of the
+            failed entries it depends on
+    """
+
+    count = len(pkgbuilds)
+    states = [None] * count
+    pending = [len(deps) for deps in dependencies]
+    users = get_reverse_dependencies(dependencies)
+    blocked_by = {}
+    if durations is not None:
+        priorities = get_priorities(dependencies, durations)
+    else:
+        priorities = [0] * count
+
+    for i in sorted(completed):
+        print("ALREADY BUILT %s" % pkgbuilds[i][0])
+        states[i] = DONE
+        for user in users[i]:
+            pending[user] -= 1
+
+    ready = [(-priorities[i], i) for i in range(count)
+             if not pending[i] and states[i] is None]
+    heapq.heapify(ready)
+    finished = queue.Queue()
+    # index -> start time
+    running = {}
+    remaining = [0.0]
+    if durations is not None:
+        remaining[0] = sum(
+            durations[i] for i in range(count) if states[i] is None)
+
+    def run(i):
+        path, packages = pkgbuilds[i]
+        try:
+            build_func(path, packages)
+        except BuildError as e:
+            finished.put((i, FAILED, str(e)))
+        except BaseException as e:
+            finished.put((i, FAILED, repr(e)))
+            raise
         else:
-            return cmp_(a_key, b_key)
+            finished.put((i, DONE, ""))
+
+    # bitsets of everything downstream of each entry, on the first failure
+    downstream = []
 
-    return pool, sorted_with_cmp(
-        pkgbuilds.items(), lambda a, b: cmp_func(a[1], b[1]))
+    def block(root):
+        # skips everything downstream of root, none of it can have started
+        if not downstream:
+            downstream.extend(get_transitive_closures(users))
+        for i in iter_bits(downstream[root] & ~(1 << root)):
+            blocked_by.setdefault(i, set()).add(root)
+            if states[i] is None:
+                states[i] = SKIPPED
+                if durations is not None:
+                    remaining[0] -= durations[i]
+                print("SKIPPING %s because %s failed" % (
+                    pkgbuilds[i][0], pkgbuilds[root][0]))
+
+    def get_eta():
+        # the longest remaining chain, or all the work spread over the jobs
+        now = time.time()
+        chains = [priorities[i] - (now - start)
+                  for i, start in running.items()]
+        if ready:
+            chains.append(-ready[0][0])
+        work = remaining[0] - sum(
+            min(now - start, durations[i]) for i, start in running.items())
+        return max(chains + [work / max(jobs, 1), 0])
+
+    while True:
+        while ready and len(running) < max(jobs, 1):
+            i = heapq.heappop(ready)[1]
+            print("STARTING %s" % pkgbuilds[i][0])
+            running[i] = time.time()
+            thread = threading.Thread(target=run, args=(i,))
+            thread.daemon = True
+            thread.start()
+        if not running:
+            break
+
+        # with a timeout, so KeyboardInterrupt works under Python 2
+        i, state, message = finished.get(True, 60 * 60 * 24 * 365)
+        del running[i]
+        states[i] = state
+        if durations is not None:
+            remaining[0] -= durations[i]
+        if state == DONE:
+            print("DONE %s" % pkgbuilds[i][0])
+            for user in users[i]:
+                pending[user] -= 1
+                if not pending[user] and states[user] is None:
+                    heapq.heappush(ready, (-priorities[user], user))
+        else:
+            print("FAILED %s" % pkgbuilds[i][0])
+            for line in message.splitlines():
+                print("    %s" % line)
+            block(i)
+        if durations is not None and (ready or running):
+            print("ETA %s" % format_duration(get_eta()))
+
+    return states, blocked_by
 
 
 class BuildError(Exception):
     pass
 
 
-def build_source(pkgbuild, packages, targetdir):
+# Number of output lines kept for the error message of a failed command
+TAIL_LINES = 30
+
+# Minimum seconds between output lines shown on the console
+ECHO_INTERVAL = 2.0
+
+# Longer lines get split, so memory use doesn't depend on the output
+MAX_LINE_LENGTH = 64 * 1024
+
+
+def _wait(process):
+    # like Popen.wait(), but also returns the peak RSS in KiB, if known
+    if not hasattr(os, "wait4"):
+        return process.wait(), None
+    while True:
+        try:
+            status, usage = os.wait4(process.pid, 0)[1:]
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        break
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode, usage.ru_maxrss
+
+
+def run_logged(args, log, cwd=None, echo=None, usage=None, nice=0):
+    """Runs a command and writes its output to a log file while it runs.
+
+    Args:
+        args (list): The command
+        log (file): Opened in binary mode
+        cwd (str or None)
+        echo (str or None): If not None the latest output line gets
+            printed with this prefix, at most every ECHO_INTERVAL seconds
+        usage (dict or None): "max_rss" gets set to the peak RSS of the
+            command in KiB, if it is higher
+        nice (int): Run the command with a lower priority, using nice(1)
+    Raises:
+        BuildError: If the command fails or can't be started, containing
+            the last lines of output
+    """
+
+    if nice:
+        args = ["nice", "-n", str(nice)] + list(args)
+    log.write(("==> %s\n" % " ".join(args)).encode("utf-8"))
+    log.flush()
+    try:
+        # in its own process group, so nothing it started survives it
+        # getting killed and keeps writing to the staging directory
+        process = popen_process_group(
+            args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except EnvironmentError as e:
+        log.write(("%s\n" % e).encode("utf-8"))
+        raise BuildError("Failed to run %r: %s" % (args, e))
+
+    tail = deque(maxlen=TAIL_LINES)
+    last_echo = 0
+    try:
+        for line in iter(
+                lambda: process.stdout.readline(MAX_LINE_LENGTH), b""):
+            log.write(line)
+            tail.append(line)
+            if echo is not None and time.time() - last_echo >= ECHO_INTERVAL:
+                last_echo = time.time()
+                print("%s %s" % (
+                    echo, line.decode("utf-8", "replace").rstrip()))
+        process.stdout.close()
+    except BaseException:
+        kill_process_group(process)
+        raise
+    finally:
+        returncode, max_rss = _wait(process)
+        release_process_group(process)
+        log.flush()
+
+    if usage is not None and max_rss is not None:
+        usage["max_rss"] = max(usage.get("max_rss") or 0, max_rss)
+
+    if returncode != 0:
+        raise BuildError(
+            "Command %r returned non-zero exit status %d:\n%s" % (
+                args, returncode,
+                b"".join(tail).decode("utf-8", "replace").rstrip()))
+
+
+class TargetDirectory(object):
+    """The directory the build results end up in, with an index of its
+    content. Builds write to their own staging directory inside of it and
+    the results get moved over when the build is done, so only complete
+    files show up and each build knows exactly what it produced.
+
+    Args:
+        path (str)
+    """
+
+    STAGING_PREFIX = ".staging-"
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._names = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._names is None:
+            try:
+                names = os.listdir(self.path)
+            except EnvironmentError:
+                names = []
+            self._names = set(
+                n for n in names if not n.startswith(self.STAGING_PREFIX))
+
+    def __contains__(self, name):
+        with self._lock:
+            self._load()
+            return name in self._names
+
+    def __len__(self):
+        with self._lock:
+            self._load()
+            return len(self._names)
+
+    @contextmanager
+    def staging(self):
+        """A context manager returning a new empty directory. It gets
+        deleted with everything left in it on exit.
+        """
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        path = tempfile.mkdtemp(prefix=self.STAGING_PREFIX, dir=self.path)
+        try:
+            yield path
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def commit(self, staging_path):
+        """Moves all files from a staging directory to the target
+        directory, replacing existing ones.
+
+        Returns:
+            set(str): The new paths of the files
+        """
+
+        paths = set()
+        for name in sorted(os.listdir(staging_path)):
+            source = os.path.join(staging_path, name)
+            if not os.path.isfile(source):
+                continue
+            target = os.path.join(self.path, name)
+            getattr(os, "replace", os.rename)(source, target)
+            with self._lock:
+                self._load()
+                self._names.add(name)
+            paths.add(target)
+        return paths
+
+    def remove(self, path):
+        """Deletes a file in the target directory, if it exists"""
+
+        name = os.path.basename(path)
+        try:
+            os.unlink(os.path.join(self.path, name))
+        except EnvironmentError:
+            pass
+        with self._lock:
+            self._load()
+            self._names.discard(name)
+
+
+_targets = {}
+_targets_lock = threading.Lock()
+
+
+def get_target_directory(path):
+    """
+    Args:
+        path (str)
+    Returns:
+        TargetDirectory: The same instance for the same path
+    """
+
+    path = os.path.abspath(path)
+    with _targets_lock:
+        if path not in _targets:
+            _targets[path] = TargetDirectory(path)
+        return _targets[path]
+
+
+def build_source(pkgbuild, packages, targetdir, echo=None, usage=None,
+                 nice=0):
     """Build source packages
 
+    Args:
+        echo (str or None): see run_logged()
+        usage (dict or None): see run_logged()
+        nice (int): see run_logged()
     Returns:
         set(str): The paths to the resulting packages
     Raises:
@@ -115,37 +576,35 @@ def build_source(pkgbuild, packages, targetdir):
     targetdir = os.path.abspath(targetdir)
     pkgbuild = os.path.abspath(pkgbuild)
 
-    try:
-        output = subprocess.check_output(
+    some_pkg = list(packages)[0]
+    target_key = "%s-%s" % (some_pkg.pkgbase, some_pkg.build_version)
+    logpath = os.path.join(targetdir, target_key + ".src.log")
+    target = get_target_directory(targetdir)
+    with target.staging() as staging, open(logpath, "wb") as log:
+        run_logged(
             ["bash", "/usr/bin/makepkg", "--noconfirm", "--noprogressbar",
              "--skippgpcheck", "--allsource", "--config",
              "/etc/makepkg_mingw64.conf", "-f",
              "-p", os.path.basename(pkgbuild),
-             "SRCPKGDEST=%s" % targetdir],
-            cwd=os.path.dirname(pkgbuild),
-            stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        output = e.output
-        raise BuildError(e)
-    else:
-        tarballs = set()
-        for entry in os.listdir(targetdir):
-            for p in packages:
-                name = "%s-%s" % (p.pkgbase, p.build_version)
-                if name in entry and ".src." in entry:
-                    tarballs.add(os.path.join(targetdir, entry))
-        return tarballs
-    finally:
-        some_pkg = list(packages)[0]
-        target_key = "%s-%s" % (some_pkg.pkgbase, some_pkg.build_version)
-        logpath = os.path.join(targetdir, target_key + ".src.log")
-        with open(logpath, "wb") as h:
-            h.write(output)
+             "SRCPKGDEST=%s" % staging],
+            log, cwd=os.path.dirname(pkgbuild), echo=echo, usage=usage,
+            nice=nice)
+        return target.commit(staging)
 
 
-def build_and_install_binary(pkgbuild, packages, targetdir):
+def build_and_install_binary(pkgbuild, packages, targetdir,
+                             install_lock=None, echo=None, usage=None):
     """Build binary packages
 
+    Without an install_lock makepkg installs the dependencies, builds,
+    removes the dependencies again and installs the result in one go.
+    With one, the steps changing the installed packages hold the lock and
+    the dependencies stay installed, as other builds might need them.
+
+    Args:
+        install_lock (threading.Lock or None)
+        echo (str or None): see run_logged()
+        usage (dict or None): see run_logged()
     Returns:
         set(str): The paths to the resulting packages
     Raises:
@@ -154,38 +613,49 @@ def build_and_install_binary(pkgbuild, packages, targetdir):
 
     targetdir = os.path.abspath(targetdir)
     pkgbuild = os.path.abspath(pkgbuild)
+    makepkg = ["bash", "/usr/bin/makepkg-mingw", "--noconfirm",
+               "--noprogressbar", "--skippgpcheck", "-f",
+               "-p", os.path.basename(pkgbuild)]
 
-    try:
-        output = subprocess.check_output(
-            ["bash", "/usr/bin/makepkg-mingw", "--noconfirm",
-             "--noprogressbar", "--skippgpcheck", "--nocheck", "--syncdeps",
-             "--rmdeps", "--cleanbuild", "--install", "-f", "--noconfirm",
-             "-p", os.path.basename(pkgbuild),
-             "PKGDEST=%s" % targetdir],
-            cwd=os.path.dirname(pkgbuild),
-            stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        output = e.output
-        raise BuildError(e)
-    else:
-        tarballs = set()
-        for entry in os.listdir(targetdir):
-            for p in packages:
-                name = "%s-%s" % (p.pkgname, p.build_version)
-                if name in entry and ".pkg." in entry:
-                    tarballs.add(os.path.join(targetdir, entry))
+    some_pkg = list(packages)[0]
+    target_key = "%s-%s" % (some_pkg.pkgbase, some_pkg.build_version)
+    logpath = os.path.join(targetdir, target_key + ".pkg.log")
+    target = get_target_directory(targetdir)
+    with target.staging() as staging, open(logpath, "wb") as log:
+
+        def run(args):
+            run_logged(args, log, cwd=os.path.dirname(pkgbuild), echo=echo,
+                       usage=usage)
+
+        if install_lock is None:
+            run(makepkg + ["--nocheck", "--syncdeps", "--rmdeps",
+                           "--cleanbuild", "--install",
+                           "PKGDEST=%s" % staging])
+            return target.commit(staging)
+
+        # install the dependencies, download, extract and prepare
+        with install_lock:
+            run(makepkg + ["--nocheck", "--syncdeps", "--cleanbuild",
+                         "--nobuild"])
+        run(makepkg + ["--nocheck", "--noextract",
+                       "PKGDEST=%s" % staging])
+        tarballs = target.commit(staging)
+        with install_lock:
+            run(["pacman", "-U", "--noconfirm"] + sorted(tarballs))
         return tarballs
-    finally:
-        some_pkg = list(packages)[0]
-        target_key = "%s-%s" % (some_pkg.pkgbase, some_pkg.build_version)
-        logpath = os.path.join(targetdir, target_key + ".pkg.log")
-        with open(logpath, "wb") as h:
-            h.write(output)
 
 
-def build(pkgbuild, packages, targetdir):
+def build(pkgbuild, packages, targetdir, install_lock=None, echo=False,
+          usage=None, source=True):
     """Build packages
 
+    Args:
+        install_lock (threading.Lock or None): Gets held while installing,
+            needed if more than one build runs at a time
+        echo (bool): Show some of the build output on the console
+        usage (dict or None): see run_logged()
+        source (bool): Build the source package first, otherwise only the
+            binary packages
     Returns:
         set(str): The paths to the resulting packages
     Raises:
@@ -201,28 +671,345 @@ def build(pkgbuild, packages, targetdir):
     fail_path = os.path.join(targetdir, "%s.failed" % target_key)
 
     if os.path.exists(fail_path):
-        print("%s found, build aborted. Delete the file to not skip "
-              "the build." % fail_path)
-        raise BuildError
+        raise BuildError(
+            "%s found, build aborted. Delete the file to not skip "
+            "the build." % fail_path)
 
+    echo = "[%s]" % target_key if echo else None
     try:
-        results.update(build_source(pkgbuild, packages, targetdir))
+        if source:
+            results.update(
+                build_source(pkgbuild, packages, targetdir, echo, usage))
         results.update(
-            build_and_install_binary(pkgbuild, packages, targetdir))
+            build_and_install_binary(
+                pkgbuild, packages, targetdir, install_lock, echo, usage))
     except BuildError:
         open(fail_path, "wb").close()
 
         # something failed, try to clean up
+        target = get_target_directory(targetdir)
         for path in results:
-            try:
-                os.unlink(path)
-            except EnvironmentError:
-                pass
+            target.remove(path)
         raise
     else:
         return results
 
 
+class Builder(object):
+    """How PKGBUILD files get built"""
+
+    def build(self, pkgbuild, packages, targetdir, install_lock=None,
+              usage=None, source=True):
+        """Like build()
+
+        Returns:
+            set(str): The paths to the resulting packages
+        Raises:
+            BuildError
+        """
+
+        raise NotImplementedError
+
+    def build_source(self, pkgbuild, packages, targetdir, nice=0):
+        """Like build_source()
+
+        Returns:
+            set(str): The paths to the resulting packages
+        Raises:
+            BuildError
+        """
+
+        raise NotImplementedError
+
+
+class MakepkgBuilder(Builder):
+    """Builds with makepkg and makepkg-mingw
+
+    Args:
+        echo (bool): see build()
+    """
+
+    def __init__(self, echo=False):
+        self.echo = echo
+
+    def build(self, pkgbuild, packages, targetdir, install_lock=None,
+              usage=None, source=True):
+        return build(pkgbuild, packages, targetdir, install_lock,
+                     echo=self.echo, usage=usage, source=source)
+
+    def build_source(self, pkgbuild, packages, targetdir, nice=0):
+        echo = None
+        if self.echo:
+            some_pkg = list(packages)[0]
+            echo = "[%s-%s.src]" % (some_pkg.pkgbase, some_pkg.build_version)
+        return build_source(pkgbuild, packages, targetdir, echo, nice=nice)
+
+
+class SimulatedBuilder(Builder):
+    """Pretends to build, for testing and benchmarking the scheduling.
+    Writes empty or sparse package files of the given sizes.
+
+    Args:
+        durations (dict): pkgbase -> seconds a build takes
+        default_duration (float): for pkgbases not in durations
+        failures (iterable): pkgbases of which the build fails
+        source_failures (iterable): pkgbases of which the source package
+            build fails
+        sizes (dict): pkgbase -> size of each package file in bytes
+        max_rss (int or None): the peak RSS in KiB to report
+    """
+
+    def __init__(self, durations=None, default_duration=0.0, failures=(),
+                 source_failures=(), sizes=None, max_rss=None):
+        self.durations = durations or {}
+        self.default_duration = default_duration
+        self.failures = frozenset(failures)
+        self.source_failures = frozenset(source_failures)
+        self.sizes = sizes or {}
+        self.max_rss = max_rss
+        # (pkgbase, start, end) for each binary build, in order of start
+        self.builds = []
+        self._lock = threading.Lock()
+
+    def _write(self, packages, targetdir, names):
+        target = get_target_directory(targetdir)
+        with target.staging() as staging:
+            pkgbase = list(packages)[0].pkgbase
+            for name in names:
+                with open(os.path.join(staging, name), "wb") as h:
+                    h.truncate(self.sizes.get(pkgbase, 0))
+            return target.commit(staging)
+
+    def build(self, pkgbuild, packages, targetdir, install_lock=None,
+              usage=None, source=True):
+        some_pkg = list(packages)[0]
+        pkgbase = some_pkg.pkgbase
+        with self._lock:
+            entry = [pkgbase, time.time(), None]
+            self.builds.append(entry)
+        time.sleep(self.durations.get(pkgbase, self.default_duration))
+        entry[2] = time.time()
+        if usage is not None and self.max_rss is not None:
+            usage["max_rss"] = self.max_rss
+
+        results = set()
+        if source:
+            results.update(self.build_source(pkgbuild, packages, targetdir))
+        if pkgbase in self.failures:
+            raise BuildError("%s: simulated failure" % pkgbase)
+        if install_lock is not None:
+            with install_lock:
+                pass
+        results.update(self._write(packages, targetdir, [
+            "%s-%s-any.pkg.tar.zst" % (p.pkgname, p.build_version)
+            for p in packages]))
+        return results
+
+    def build_source(self, pkgbuild, packages, targetdir, nice=0):
+        some_pkg = list(packages)[0]
+        if some_pkg.pkgbase in self.source_failures:
+            raise BuildError("%s: simulated failure" % some_pkg.pkgbase)
+        return self._write(packages, targetdir, [
+            "%s-%s.src.tar.zst" % (some_pkg.pkgbase, some_pkg.build_version)])
+
+
+class SourceLane(object):
+    """Builds source packages from background threads with a low priority,
+    while the binary builds go on. A failed source package build only gets
+    reported, it doesn't affect anything else.
+
+    Args:
+        builder (Builder)
+        targetdir (str)
+        jobs (int): The maximum number of source builds at the same time
+        journal (BuildJournal or None): Gets the results recorded
+    """
+
+    NICE = 10
+
+    def __init__(self, builder, targetdir, jobs=1, journal=None):
+        self.builder = builder
+        self.targetdir = targetdir
+        self.journal = journal
+        # path -> set of result paths or the error message
+        self.done = {}
+        self.failed = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        for i in range(max(jobs, 1)):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        for path, packages, key in iter(self._queue.get, None):
+            try:
+                results = self.builder.build_source(
+                    path, packages, self.targetdir, nice=self.NICE)
+            except BuildError as e:
+                if self.journal is not None:
+                    self.journal.source_fail(path, key)
+                with self._lock:
+                    self.failed[path] = str(e)
+                print("SOURCE FAILED %s" % path)
+            else:
+                if self.journal is not None:
+                    self.journal.source_done(path, key, results)
+                with self._lock:
+                    self.done[path] = results
+                print("SOURCE DONE %s" % path)
+
+    def submit(self, path, packages, key=None):
+        """Queues the source package build of a PKGBUILD file
+
+        Args:
+            path (str): The PKGBUILD file
+            packages (set(SrcInfoPackage))
+            key (str or None): The journal key, see get_pkgbuild_key()
+        """
+
+        self._queue.put((path, packages, key))
+
+    def close(self):
+        """Waits for all queued builds to finish"""
+
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            # with a timeout, so KeyboardInterrupt works under Python 2
+            while thread.is_alive():
+                thread.join(1)
+
+
+def get_resumable(journal, pkgbuilds, keys, separate_sources=True):
+    """Finds the PKGBUILD files which don't have to be built again, as the
+    journal lists them as built and their packages are still unchanged
+
+    Args:
+        journal (BuildJournal)
+        pkgbuilds (list): [(path, set(SrcInfoPackage))]
+        keys (list(str)): The journal keys of pkgbuilds
+        separate_sources (bool): If source packages can be built on their
+            own, see build_pkgbuilds()
+    Returns:
+        tuple: (completed, sources_todo) where completed is a set of
+            indices of the PKGBUILD files with binary packages and
+            sources_todo a list of those missing the source package
+    """
+
+    target = get_target_directory(journal.targetdir)
+    binaries = journal.get_completed()
+    sources = journal.get_completed(source=True)
+
+    def is_intact(artifacts):
+        return artifacts is not None and \
+            all(name in target for name in artifacts) and \
+            journal.verify(artifacts)
+
+    completed = set()
+    sources_todo = []
+    for i, (path, packages) in enumerate(pkgbuilds):
+        entry = (path, keys[i])
+        if not is_intact(binaries.get(entry)):
+            continue
+        if is_intact(sources.get(entry)):
+            completed.add(i)
+        elif separate_sources:
+            completed.add(i)
+            sources_todo.append(i)
+    return completed, sources_todo
+
+
+def build_pkgbuilds(pkgbuilds, dependencies, builder, target_path, jobs=1,
+                    source_jobs=1, completed=(), durations=None,
+                    journal=None, keys=None, stats=None, sources_todo=()):
+    """Builds PKGBUILD files, see run_builds()
+
+    Args:
+        pkgbuilds (list): [(path, set(SrcInfoPackage))]
+        dependencies (list): see get_build_dependencies()
+        builder (Builder)
+        target_path (str): where the results end up
+        jobs (int): The maximum number of binary builds at the same time
+        source_jobs (int): The maximum number of source package builds at
+            the same time, next to the binary builds. If 0 they get built
+            together with the binary packages.
+        completed (iterable): see run_builds()
+        durations (list(float) or None): see run_builds()
+        journal (BuildJournal or None): Gets the events recorded
+        keys (list(str) or None): The journal keys of pkgbuilds
+        stats (BuildStats or None): Gets the usage of each build
+        sources_todo (iterable): Indices of completed PKGBUILD files of
+            which only the source package needs to be built. Needs
+            source_jobs > 0.
+    Returns:
+        tuple: (states, blocked_by, source_failed) where states and
+            blocked_by are like in run_builds() and source_failed maps
+            the paths of the PKGBUILD files of which the source package
+            failed to build to the error message
+    """
+
+    path_keys = dict(zip([path for path, packages in pkgbuilds], keys or []))
+    install_lock = threading.Lock() if jobs > 1 else None
+    source_lane = None
+    if source_jobs > 0:
+        source_lane = SourceLane(
+            builder, target_path, source_jobs, journal=journal)
+        for i in sources_todo:
+            path, packages = pkgbuilds[i]
+            source_lane.submit(path, packages, path_keys.get(path))
+
+    def build_func(path, packages):
+        key = path_keys.get(path)
+        if journal is not None:
+            journal.start(path, key)
+        usage = {}
+        start = time.time()
+        try:
+            results = builder.build(
+                path, packages, target_path, install_lock, usage=usage,
+                source=source_lane is None)
+        except BuildError:
+            if journal is not None:
+                journal.fail(path, key)
+            raise
+        if source_lane is not None:
+            # the sources are downloaded now, so this is mostly packing
+            source_lane.submit(path, packages, key)
+        if stats is not None:
+            stats.record(
+                list(packages)[0].pkgbase, time.time() - start,
+                usage.get("max_rss"),
+                sum(os.path.getsize(r) for r in results))
+            stats.save()
+        if journal is not None:
+            journal.done(path, key, results, source=source_lane is None)
+
+    try:
+        states, blocked_by = run_builds(
+            pkgbuilds, dependencies, build_func, jobs=jobs,
+            completed=completed, durations=durations)
+        source_failed = {}
+        if source_lane is not None:
+            print("Waiting for the source packages...")
+            source_lane.close()
+            source_failed = source_lane.failed
+    except BaseException:
+        # the build threads can't be stopped, but their commands can. They
+        # run in their own sessions, so ctrl+c doesn't reach them.
+        kill_process_groups()
+        raise
+    finally:
+        if journal is not None:
+            journal.close()
+        if stats is not None:
+            stats.save()
+
+    return states, blocked_by, source_failed
+
+
 def add_parser(subparsers):
     parser = subparsers.add_parser("build",
         help="Auto builds PKGBUILD files where the packages in the database "
@@ -236,6 +1023,26 @@ def add_parser(subparsers):
                        "be saved to")
     parser.add_argument('--dry-run', action='store_true',
                         help="Only show which packages will be build")
+    parser.add_argument(
+        '--source-jobs', type=int, default=1, metavar="N",
+        help="Number of source packages to build at the same time, next "
+             "to the binary packages and with a lower priority. 0 builds "
+             "them before the binary packages instead, one failing blocks "
+             "the binary build (default: %(default)s)")
+    parser.add_argument(
+        '--show-output', action='store_true',
+        help="Show the latest line of build output every few seconds, "
+             "the full output is in the logs in the target directory")
+    parser.add_argument(
+        '--resume', action='store_true',
+        help="Don't build PKGBUILD files again which the journal in the "
+             "target directory lists as built, if their packages are "
+             "still there unchanged")
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1, metavar="N",
+        help="Number of PKGBUILD files to build at the same time "
+             "(default: %(default)s)")
+    add_iter_packages_arguments(parser, jobs_option=False)
     parser.set_defaults(func=main)
 
 
@@ -247,15 +1054,21 @@ def main(args):
     repo_packages = dict((p.pkgname, p) for p in repo_packages)
 
     # Find packages which not are not VCS and which are out of date
-    packages_todo = set()
-    for package in iter_packages(repo_path):
+    packages_in_repo = []
+    for package in iter_packages_for_args(repo_path, args):
         if package.is_vcs:
             continue
         if package.pkgname in repo_packages:
-            repo_pkg = repo_packages[package.pkgname]
-            if version_is_newer_than(package.build_version,
-                                     repo_pkg.build_version):
-                packages_todo.add(package)
+            packages_in_repo.append(package)
+
+    print("Comparing versions...")
+    results = compare_versions(
+        [(p.build_version, repo_packages[p.pkgname].build_version)
+         for p in packages_in_repo])
+    packages_todo = set()
+    for package, result in zip(packages_in_repo, results):
+        if result == 1:
+            packages_todo.add(package)
 
     # Throw away PKGBUILDS which build a package which is available from
     # another PKGBUILD but newer there.
@@ -265,9 +1078,7 @@ def main(args):
     pkgbuilds_to_skip = set()
     for pkgname, packages in per_pkgname.items():
         # last is the newest
-        packages_by_version = sorted_with_cmp(
-            packages, lambda a, b: version_cmp(a.build_version,
-                                               b.build_version))
+        packages_by_version = sorted(packages, key=lambda p: p.version_key)
         for to_blacklist in packages_by_version[:-1]:
             if to_blacklist.pkgbuild_path != \
                     packages_by_version[-1].pkgbuild_path:
@@ -285,15 +1096,49 @@ def main(args):
 
     # Sort them according to their dependencies so no package is build
     # before any of its dependencies
-    pool, pkgbuilds = get_pkgbuilds_to_build_in_order(packages_todo)
+    pool, pkgbuilds, cycles = get_pkgbuilds_to_build_in_order(packages_todo)
+
+    for cycle in cycles:
+        print("WARNING: Dependency cycle between %s" % ", ".join(cycle))
 
-    print("%d PKGBUILDs to build" % len(pkgbuilds))
+    journal = BuildJournal(target_path)
+    keys = [get_pkgbuild_key(path, packages) for path, packages in pkgbuilds]
+    completed = set()
+    sources_todo = []
+    if args.resume:
+        completed, sources_todo = get_resumable(
+            journal, pkgbuilds, keys, args.source_jobs > 0)
+
+    print("%d PKGBUILDs to build" % (len(pkgbuilds) - len(completed)))
+    if sources_todo:
+        print("%d source packages missing from the last run" %
+              len(sources_todo))
+
+    jobs = args.jobs
+    dependencies = get_build_dependencies(pool, pkgbuilds)
+    stats = BuildStats()
+    durations = get_expected_durations(stats, pkgbuilds)
 
     if args.dry_run:
-        for path, packages in pkgbuilds:
+        for i, (path, packages) in enumerate(pkgbuilds):
+            if i in completed:
+                continue
             print(path)
             for package in packages:
                 print("    -> ", package.pkgname)
+        for i in sources_todo:
+            print("%s (only the source package)" % pkgbuilds[i][0])
+        if durations is not None:
+            todo = [0.0 if i in completed else d
+                    for i, d in enumerate(durations)]
+            print("Expected time with %d jobs: %s" % (
+                jobs, format_duration(
+                    simulate_builds(dependencies, todo, jobs))))
+            print("Critical path:")
+            for i in get_critical_path(dependencies, todo):
+                if i not in completed:
+                    print("    %s %s" % (
+                        format_duration(durations[i]), pkgbuilds[i][0]))
         return
 
     if pkgbuilds:
@@ -301,40 +1146,28 @@ def main(args):
             os.makedirs(target_path)
         except EnvironmentError:
             pass
+        journal.plan(zip([path for path, packages in pkgbuilds], keys))
 
-    failed_packages = set()
-    skipped = set()
-    for path, packages in pkgbuilds:
-        # In case some build failed, check if this one needs to be
-        # skipped because it depends on the failed one.
-        can_build = True
-        reason = set()
-        for failed in failed_packages:
-            for p in packages:
-                if failed in pool.get_transitive_dependencies(p):
-                    can_build = False
-                    reason.add(failed)
-        if not can_build:
-            skipped.update(packages)
-            print("SKIPPING %s because %s failed" % (path, ", ".join(reason)))
-            continue
-
-        # start the build
-        print("STARTING %s" % path)
-        try:
-            build(path, packages, target_path)
-        except BuildError:
-            print("FAILED")
-            failed_packages.update(packages)
-        else:
-            print("DONE")
+    states, blocked_by, source_failed = build_pkgbuilds(
+        pkgbuilds, dependencies, MakepkgBuilder(echo=args.show_output),
+        target_path, jobs=jobs, source_jobs=args.source_jobs,
+        completed=completed, durations=durations, journal=journal,
+        keys=keys, stats=stats, sources_todo=sources_todo)
 
     # Final report
     print("All done.")
-    if failed_packages:
-        print("The following packages failed to build:")
-        for p in sorted(failed_packages):
-            print(p.pkgname)
-        print("As a result, the following packages got skipped:")
-        for p in sorted(skipped):
-            print(p.pkgname)
+    failed = [path for (path, packages), state in zip(pkgbuilds, states)
+              if state == FAILED]
+    if failed:
+        print("The following PKGBUILDs failed to build (see the logs in "
+              "%s):" % target_path)
+        for path in sorted(failed):
+            print(path)
+        print("As a result, the following PKGBUILDs got skipped:")
+        for i in sorted(blocked_by, key=lambda i: pkgbuilds[i][0]):
+            roots = sorted(pkgbuilds[j][0] for j in blocked_by[i])
+            print("%s (because of %s)" % (pkgbuilds[i][0], ", ".join(roots)))
+    if source_failed:
+        print("The following source packages failed to build:")
+        for path in sorted(source_failed):
+            print(path)
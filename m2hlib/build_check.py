@@ -26,8 +26,8 @@ from __future__ import print_function
 
 import os
 
-from .utils import package_name_is_vcs, version_is_newer_than
-from .srcinfo import iter_packages
+from .utils import package_name_is_vcs, compare_versions
+from .srcinfo import add_iter_packages_arguments, iter_packages_for_args
 from .pacman import PacmanPackage
 
 
@@ -43,6 +43,7 @@ def add_parser(subparsers):
                         help="show packages not in the repo")
     parser.add_argument('--show-vcs', action='store_true',
                         help="show VCS packages")
+    add_iter_packages_arguments(parser)
     parser.set_defaults(func=main)
 
 
@@ -53,17 +54,23 @@ def main(args):
     repo_packages = dict((p.pkgname, p) for p in repo_packages)
 
     packages_todo = set()
-    for package in iter_packages(repo_path):
+    packages_in_repo = []
+    for package in iter_packages_for_args(repo_path, args):
         if not args.show_vcs and package_name_is_vcs(package.pkgname):
             continue
         if package.pkgname not in repo_packages:
             if args.show_missing:
                 packages_todo.add(package)
         else:
-            repo_pkg = repo_packages[package.pkgname]
-            if version_is_newer_than(package.build_version,
-                                     repo_pkg.build_version):
-                packages_todo.add(package)
+            packages_in_repo.append(package)
+
+    print("Comparing versions...")
+    results = compare_versions(
+        [(p.build_version, repo_packages[p.pkgname].build_version)
+         for p in packages_in_repo])
+    for package, result in zip(packages_in_repo, results):
+        if result == 1:
+            packages_todo.add(package)
 
     for package in sorted(packages_todo, key=lambda p: p.pkgname):
         if package.pkgname not in repo_packages:
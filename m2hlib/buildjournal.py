@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Christoph Reiter
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+"""An append-only record of what a build run did, so an interrupted run
+can continue where it stopped.
+"""
+
+from __future__ import print_function
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+
+JOURNAL_NAME = "m2h-build.journal"
+
+# Journal events
+PLAN = "plan"
+START = "start"
+DONE = "done"
+FAIL = "fail"
+SOURCE_DONE = "source-done"
+SOURCE_FAIL = "source-fail"
+
+
+def hash_file(path):
+    """
+    Args:
+        path (str)
+    Returns:
+        str: The sha256 hex digest of the file content
+    Raises:
+        EnvironmentError
+    """
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_pkgbuild_key(path, packages):
+    """
+    Args:
+        path (str): The PKGBUILD file
+        packages (iterable): SrcInfoPackage instances from it
+    Returns:
+        str: A key which changes if the version or the PKGBUILD file
+            itself changes
+    Raises:
+        EnvironmentError
+    """
+
+    some_pkg = sorted(packages, key=lambda p: p.pkgname)[0]
+    with open(path, "rb") as h:
+        digest = hashlib.sha1(h.read()).hexdigest()
+    return "%s-%s-%s" % (some_pkg.pkgbase, some_pkg.build_version, digest)
+
+
+class BuildJournal(object):
+    """A JSON lines file in the target directory. Every event gets flushed
+    and fsync'd before the call returns, a line cut off by a crash is
+    ignored when reading.
+
+    Args:
+        targetdir (str): The directory containing the build results
+    """
+
+    def __init__(self, targetdir):
+        self.targetdir = os.path.abspath(targetdir)
+        self.path = os.path.join(self.targetdir, JOURNAL_NAME)
+        self._lock = threading.Lock()
+        self._handle = None
+
+    def _write(self, event, **kwargs):
+        kwargs["event"] = event
+        kwargs["time"] = time.time()
+        line = json.dumps(kwargs, sort_keys=True) + "\n"
+        with self._lock:
+            if self._handle is None:
+                self._handle = open(self.path, "ab")
+                # don't append to a line cut off by a crash
+                if self._handle.tell() and not self._ends_with_newline():
+                    self._handle.write(b"\n")
+            self._handle.write(line.encode("utf-8"))
+            self._handle.flush()
+            os.fsync(self._handle.fileno())
+
+    def _ends_with_newline(self):
+        with open(self.path, "rb") as h:
+            h.seek(-1, os.SEEK_END)
+            return h.read(1) == b"\n"
+
+    def close(self):
+        with self._lock:
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+
+    def plan(self, entries):
+        """Records the start of a run
+
+        Args:
+            entries (list): [(path, key)] in build order
+        """
+
+        self._write(PLAN, pkgbuilds=[list(e) for e in entries])
+
+    def start(self, path, key):
+        self._write(START, path=path, key=key)
+
+    def _hash_artifacts(self, artifacts):
+        hashes = {}
+        for artifact in artifacts:
+            hashes[os.path.relpath(artifact, self.targetdir)] = \
+                [os.path.getsize(artifact), hash_file(artifact)]
+        return hashes
+
+    def done(self, path, key, artifacts, source=False):
+        """
+        Args:
+            path (str): The PKGBUILD file
+            key (str): see get_pkgbuild_key()
+            artifacts (iterable): paths of the build results
+            source (bool): If the results include the source package
+        Raises:
+            EnvironmentError
+        """
+
+        self._write(DONE, path=path, key=key, source=source,
+                    artifacts=self._hash_artifacts(artifacts))
+
+    def fail(self, path, key):
+        self._write(FAIL, path=path, key=key)
+
+    def source_done(self, path, key, artifacts):
+        """Records a source package built after the binary packages
+
+        Args:
+            path (str): The PKGBUILD file
+            key (str): see get_pkgbuild_key()
+            artifacts (iterable): paths of the build results
+        Raises:
+            EnvironmentError
+        """
+
+        self._write(SOURCE_DONE, path=path, key=key,
+                    artifacts=self._hash_artifacts(artifacts))
+
+    def source_fail(self, path, key):
+        self._write(SOURCE_FAIL, path=path, key=key)
+
+    def read(self):
+        """
+        Returns:
+            list(dict): All events, oldest first
+        """
+
+        events = []
+        try:
+            with open(self.path, "rb") as h:
+                for line in h:
+                    try:
+                        event = json.loads(line.decode("utf-8"))
+                    except ValueError:
+                        continue
+                    if isinstance(event, dict) and "event" in event:
+                        events.append(event)
+        except EnvironmentError:
+            pass
+        return events
+
+    def get_completed(self, source=False):
+        """
+        Args:
+            source (bool): Look at the source packages instead of the
+                binary packages
+        Returns:
+            dict: (path, key) -> artifacts for the PKGBUILD files of which
+                the binary (or source) packages were built successfully
+                last time they were built
+        """
+
+        binaries = {}
+        sources = {}
+        for event in self.read():
+            entry = (event.get("path"), event.get("key"))
+            name = event["event"]
+            artifacts = event.get("artifacts", {})
+            if name == DONE:
+                binaries[entry] = artifacts
+                if event.get("source"):
+                    sources[entry] = artifacts
+            elif name == SOURCE_DONE:
+                sources[entry] = artifacts
+            elif name in (START, FAIL):
+                binaries.pop(entry, None)
+                sources.pop(entry, None)
+            elif name == SOURCE_FAIL:
+                sources.pop(entry, None)
+        return sources if source else binaries
+
+    def verify(self, artifacts):
+        """
+        Args:
+            artifacts (dict): as returned by get_completed()
+        Returns:
+            bool: If all artifacts still exist with the same content
+        """
+
+        for name, (size, digest) in artifacts.items():
+            path = os.path.join(self.targetdir, name)
+            try:
+                if os.path.getsize(path) != size or hash_file(path) != digest:
+                    return False
+            except EnvironmentError:
+                return False
+        return True
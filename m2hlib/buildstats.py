@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Christoph Reiter
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+"""Remembers how long building a PKGBUILD took and how much it used, to
+plan the next builds.
+"""
+
+from __future__ import print_function
+
+import os
+import json
+import time
+import threading
+
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+STATS_PATH = os.path.join(DIR, "_buildstats.json")
+
+# Number of builds per pkgbase which are remembered
+MAX_SAMPLES = 5
+
+
+class BuildStats(object):
+    """Per pkgbase the wall time, peak RSS and size of the results of the
+    last MAX_SAMPLES successful builds, in a JSON file.
+    """
+
+    def __init__(self, path=STATS_PATH):
+        self.path = path
+        self._entries = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        try:
+            with open(self.path, "rb") as h:
+                self._entries.update(json.loads(h.read().decode("utf-8")))
+        except (EnvironmentError, ValueError):
+            pass
+
+    def record(self, pkgbase, duration, max_rss=None, size=None):
+        """
+        Args:
+            pkgbase (str)
+            duration (float): wall time in seconds
+            max_rss (int or None): peak resident set size in KiB
+            size (int or None): size of all resulting files in bytes
+        """
+
+        sample = {"time": time.time(), "duration": duration,
+                  "max_rss": max_rss, "size": size}
+        with self._lock:
+            self._load()
+            samples = self._entries.setdefault(pkgbase, [])
+            samples.append(sample)
+            del samples[:-MAX_SAMPLES]
+            self._dirty = True
+
+    def get_samples(self, pkgbase):
+        """
+        Returns:
+            list(dict): The remembered builds, oldest first
+        """
+
+        with self._lock:
+            self._load()
+            return list(self._entries.get(pkgbase, []))
+
+    def get_duration(self, pkgbase):
+        """
+        Returns:
+            float or None: The median wall time of the remembered builds,
+                None if there are none
+        """
+
+        durations = sorted(s["duration"] for s in self.get_samples(pkgbase))
+        if not durations:
+            return None
+        return durations[len(durations) // 2]
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            temp_path = self.path + ".%d.tmp" % os.getpid()
+            with open(temp_path, "wb") as h:
+                h.write(json.dumps(self._entries).encode("utf-8"))
+            getattr(os, "replace", os.rename)(temp_path, self.path)
+            self._dirty = False
+
+
+def format_duration(seconds):
+    """
+    Args:
+        seconds (float)
+    Returns:
+        str: like "1:02:03"
+    """
+
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (
+        seconds // 3600, seconds // 60 % 60, seconds % 60)
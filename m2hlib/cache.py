@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Christoph Reiter
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+"""Shows statistics about and maintains the srcinfo cache"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+from .srcinfocache import get_cache, get_fingerprint_index, \
+    get_package_snapshot, export_bundle, import_bundle, BundleError
+
+
+def format_size(size):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024 or unit == "GiB":
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+
+
+def add_parser(subparsers):
+    parser = subparsers.add_parser("cache",
+        help="Shows statistics about and maintains the srcinfo cache")
+    parser.set_defaults(func=lambda *x: parser.print_help())
+    actions = parser.add_subparsers(title="actions")
+
+    stats = actions.add_parser("stats", help="Shows cache statistics")
+    stats.set_defaults(func=main_stats)
+
+    compact = actions.add_parser("compact",
+        help="Evicts old entries and shrinks the cache on disk")
+    compact.add_argument('--max-age-runs', type=int,
+        help="Evict entries not used in this many runs")
+    compact.add_argument('--max-entries', type=int,
+        help="Evict the least recently used entries above this count")
+    compact.set_defaults(func=main_compact)
+
+    clear = actions.add_parser("clear", help="Removes all cache entries")
+    clear.set_defaults(func=main_clear)
+
+    export = actions.add_parser("export",
+        help="Writes all cache entries to a compressed bundle, which can "
+             "be imported on another machine")
+    export.add_argument("path", help="The bundle file to create")
+    export.set_defaults(func=main_export)
+
+    import_ = actions.add_parser("import",
+        help="Adds the entries of bundles created by 'export' which aren't "
+             "cached yet")
+    import_.add_argument("paths", metavar="path", nargs="+",
+        help="The bundle files to import")
+    import_.set_defaults(func=main_import)
+
+
+def print_stats(cache):
+    stats = cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    ratio = (100.0 * stats["hits"] / lookups) if lookups else 0.0
+
+    print("%-16s %s" % ("Backend:", type(cache).__name__))
+    print("%-16s %s" % ("Path:", stats["path"]))
+    print("%-16s %d" % ("Entries:", stats["entries"]))
+    print("%-16s %s" % ("Size on disk:", format_size(stats["size"])))
+    if stats["runs"] is not None:
+        print("%-16s %d" % ("Runs:", stats["runs"]))
+    print("%-16s %d (%.1f%%)" % ("Hits:", stats["hits"], ratio))
+    print("%-16s %d (%.1f%%)" % (
+        "Misses:", stats["misses"], (100.0 - ratio) if lookups else 0.0))
+    print("%-16s %d" % ("Fingerprints:", len(get_fingerprint_index())))
+
+
+def main_stats(args):
+    print_stats(get_cache())
+
+
+def main_compact(args):
+    cache = get_cache()
+    if args.max_age_runs is not None:
+        cache.max_age_runs = args.max_age_runs
+    if args.max_entries is not None:
+        cache.max_entries = args.max_entries
+    size = cache.stats()["size"]
+    count = cache.compact()
+    print("Evicted %d entries, %s -> %s" % (
+        count, format_size(size), format_size(cache.stats()["size"])))
+
+
+def main_clear(args):
+    get_cache().clear()
+    index = get_fingerprint_index()
+    index.clear()
+    index.save()
+    get_package_snapshot().clear()
+    print("Cache cleared")
+
+
+def main_export(args):
+    count = export_bundle(get_cache(), args.path)
+    print("Exported %d entries to %s (%s)" % (
+        count, args.path, format_size(os.path.getsize(args.path))))
+
+
+def main_import(args):
+    cache = get_cache()
+    failed = False
+    for path in args.paths:
+        try:
+            added, total = import_bundle(cache, path)
+        except (BundleError, EnvironmentError) as e:
+            print("ERROR: %s" % e, file=sys.stderr)
+            failed = True
+            continue
+        print("Imported %d new entries from %s (%d already cached)" % (
+            added, path, total - added))
+    cache.flush()
+    if failed:
+        return 1
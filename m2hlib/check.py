@@ -24,19 +24,20 @@ from __future__ import print_function
 
 import os
 
-from .srcinfo import iter_packages
+from .srcinfo import add_iter_packages_arguments, iter_packages_for_args
 
 
 def add_parser(subparsers):
     parser = subparsers.add_parser("check")
     parser.add_argument("repo_path")
+    add_iter_packages_arguments(parser)
     parser.set_defaults(func=main)
 
 
 
 def main(args):
     repo_path = os.path.abspath(args.repo_path)
-    packages = list(iter_packages(repo_path))
+    packages = list(iter_packages_for_args(repo_path, args))
     nomatch = set()
     for p in packages:
         dirname = os.path.basename(os.path.dirname(p.pkgbuild_path))
@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Christoph Reiter
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+"""A dependency graph of srcinfo packages, with provides and version
+constraints resolved.
+"""
+
+from __future__ import print_function
+
+import re
+import heapq
+
+from .utils import version_cmp, EPOCH_SEPARATOR
+
+
+_DEPENDENCY_RE = re.compile(r"^([^<>=]+?)\s*(<=|>=|=|<|>)\s*(.+)$")
+
+# what version_cmp() has to return for a constraint to be satisfied
+_CONSTRAINTS = {
+    "=": (0,),
+    ">=": (0, 1),
+    "<=": (0, -1),
+    ">": (1,),
+    "<": (-1,),
+}
+
+
+def parse_dependency(dependency):
+    """Parses a depends/provides entry like "foo>=1.0".
+
+    Args:
+        dependency (str)
+    Returns:
+        tuple: (name, operator, version), operator and version are None
+            if there is no constraint. A pacman style epoch ("1:2.0") is
+            converted to the one used by MSYS2 ("1~2.0").
+    """
+
+    match = _DEPENDENCY_RE.match(dependency)
+    if match is None:
+        return dependency.strip(), None, None
+    name, operator, version = match.groups()
+    version = re.sub(r"^([0-9]+):", r"\1" + EPOCH_SEPARATOR, version)
+    return name, operator, version
+
+
+def version_satisfies(version, operator, constraint):
+    """
+    Args:
+        version (str or None): The version of the provider, None if it
+            has no version
+        operator (str or None)
+        constraint (str or None)
+    Returns:
+        bool: If version satisfies the constraint. Like pacman, providers
+            without a version only satisfy dependencies without a
+            constraint.
+    """
+
+    if operator is None:
+        return True
+    if version is None:
+        return False
+    return version_cmp(version, constraint) in _CONSTRAINTS[operator]
+
+
+def iter_bits(bits):
+    """
+    Args:
+        bits (int): a bitset
+    Returns:
+        iterable(int): The positions of the set bits, lowest first
+    """
+
+    # going through the binary string is linear, shifting the int isn't
+    text = bin(bits)[:1:-1]
+    i = text.find("1")
+    while i != -1:
+        yield i
+        i = text.find("1", i + 1)
+
+
+class DependencyGraph(object):
+    """An index of the dependency relations between packages.
+
+    Every package gets an integer ID, edges are stored as adjacency lists
+    of IDs in both directions. depends and makedepends entries get resolved
+    to the packages providing them: a package with that name if one
+    satisfies the constraint, otherwise all packages with a matching
+    provides entry.
+
+    The transitive closures in both directions get computed on first use,
+    in topological order of the strongly connected components, and are
+    stored as one integer bitset per package. Adding packages updates
+    them as long as no existing edge goes away.
+
+    Args:
+        packages (iterable): SrcInfoPackage instances
+    """
+
+    def __init__(self, packages=()):
+        self.packages = []
+        self._ids = {}
+        # name -> [(id, version)] for package names and provides
+        self._providers = {}
+        # name -> {dependency: [id]} for depends entries referencing name
+        self._users = {}
+        # dependency -> [id], the same lists as in _users
+        self._dependency_ids = {}
+        # dependency -> tuple(id)
+        self._resolved = {}
+        self._deps = []
+        self._rdeps = []
+        self._closures = None
+        self._rclosures = None
+
+        self.add_packages(packages)
+
+    def __len__(self):
+        return len(self.packages)
+
+    def add_package(self, package):
+        """Adds a package and resolves dependencies on it.
+
+        Args:
+            package (SrcInfoPackage)
+        """
+
+        self.add_packages([package])
+
+    def add_packages(self, packages):
+        """Like add_package(), but faster for many packages.
+
+        Args:
+            packages (iterable): SrcInfoPackage instances
+        """
+
+        new = []
+        for package in packages:
+            if package in self._ids:
+                continue
+            i = len(self.packages)
+            self.packages.append(package)
+            self._ids[package] = i
+            self._deps.append(())
+            self._rdeps.append([])
+            new.append(i)
+        if self._closures is not None:
+            self._closures.extend(0 for i in new)
+            self._rclosures.extend(0 for i in new)
+
+        # re-resolve the dependencies the new packages might satisfy
+        names = set()
+        for i in new:
+            package = self.packages[i]
+            provided = [(package.pkgname, package.build_version)]
+            for provide in package.provides:
+                name, operator, version = parse_dependency(provide)
+                if operator != "=":
+                    version = None
+                provided.append((name, version))
+            for name, version in provided:
+                self._providers.setdefault(name, []).append((i, version))
+                names.add(name)
+
+        changed = set()
+        for name in names:
+            for dependency, users in self._users.get(name, {}).items():
+                result = self._resolve(dependency)
+                if result != self._resolved[dependency]:
+                    self._resolved[dependency] = result
+                    changed.update(users)
+
+        for i in new:
+            package = self.packages[i]
+            for dependency in package.depends + package.makedepends:
+                self._dependency_users(dependency).append(i)
+            changed.add(i)
+
+        for i in sorted(changed):
+            self._update_edges(i)
+
+    def _dependency_users(self, dependency):
+        # the IDs of the packages with the dependency entry, resolves it
+        # the first time
+        users = self._dependency_ids.get(dependency)
+        if users is None:
+            name = parse_dependency(dependency)[0]
+            users = self._dependency_ids[dependency] = []
+            self._users.setdefault(name, {})[dependency] = users
+            self._resolved[dependency] = self._resolve(dependency)
+        return users
+
+    def _update_edges(self, i):
+        package = self.packages[i]
+        targets = set()
+        for dependency in package.depends + package.makedepends:
+            targets.update(self._resolved[dependency])
+        targets.discard(i)
+
+        old = set(self._deps[i])
+        self._deps[i] = tuple(sorted(targets))
+        for target in old - targets:
+            self._rdeps[target].remove(i)
+            # closures can't be updated for removed edges
+            self._closures = self._rclosures = None
+        for target in targets - old:
+            self._rdeps[target].append(i)
+            if self._closures is not None:
+                self._add_closure_edge(i, target)
+
+    def _add_closure_edge(self, source, target):
+        closures = self._closures
+        rclosures = self._rclosures
+        upstream = rclosures[source] | (1 << source)
+        downstream = closures[target] | (1 << target)
+        if closures[source] & downstream == downstream:
+            # already reachable through other edges
+            return
+        for j in iter_bits(upstream):
+            closures[j] |= downstream
+        for j in iter_bits(downstream):
+            rclosures[j] |= upstream
+
+    def _get_closures(self):
+        if self._closures is None:
+            order = topological_order(self._deps)
+            self._closures = _compute_closures(order, self._deps)
+            self._rclosures = _compute_closures(reversed(order), self._rdeps)
+        return self._closures, self._rclosures
+
+    def _resolve(self, dependency):
+        name, operator, constraint = parse_dependency(dependency)
+        candidates = self._providers.get(name, [])
+        direct = [i for i, version in candidates
+                  if self.packages[i].pkgname == name and
+                  version_satisfies(version, operator, constraint)]
+        if direct:
+            return tuple(direct)
+        return tuple(i for i, version in candidates
+                     if version_satisfies(version, operator, constraint))
+
+    def get_id(self, package):
+        """
+        Args:
+            package (SrcInfoPackage)
+        Returns:
+            int
+        Raises:
+            KeyError: if the package isn't part of the graph
+        """
+
+        return self._ids[package]
+
+    def resolve(self, dependency):
+        """
+        Args:
+            dependency (str): a depends entry like "foo>=1.0"
+        Returns:
+            list(SrcInfoPackage): The packages satisfying it
+        """
+
+        return [self.packages[i] for i in self._resolve(dependency)]
+
+    def get_unresolved(self, package):
+        """
+        Returns:
+            list(str): depends/makedepends entries of package which no
+                package in the graph satisfies
+        """
+
+        self.get_id(package)
+        return [d for d in package.depends + package.makedepends
+                if not self._resolved[d]]
+
+    def get_dependency_ids(self, i):
+        """
+        Returns:
+            tuple(int): IDs of the direct dependencies of the package with
+                ID i
+        """
+
+        return self._deps[i]
+
+    def get_reverse_dependency_ids(self, i):
+        """
+        Returns:
+            tuple(int): IDs of the packages directly depending on the
+                package with ID i
+        """
+
+        return tuple(self._rdeps[i])
+
+    def get_dependency_bits(self, i):
+        """
+        Returns:
+            int: A bitset of the IDs of all packages the package with ID i
+                depends on, directly or not
+        """
+
+        return self._get_closures()[0][i] & ~(1 << i)
+
+    def get_reverse_dependency_bits(self, i):
+        """
+        Returns:
+            int: A bitset of the IDs of all packages depending on the
+                package with ID i, directly or not
+        """
+
+        return self._get_closures()[1][i] & ~(1 << i)
+
+    def depends_on(self, package, other):
+        """
+        Args:
+            package (SrcInfoPackage)
+            other (SrcInfoPackage)
+        Returns:
+            bool: If package needs other to build, directly or not
+        """
+
+        i = self.get_id(package)
+        j = self.get_id(other)
+        return i != j and bool((self._get_closures()[0][i] >> j) & 1)
+
+    def get_dependencies(self, package, transitive=False):
+        """
+        Args:
+            package (SrcInfoPackage)
+            transitive (bool): Include the dependencies of dependencies
+        Returns:
+            set(SrcInfoPackage): The packages needed to build package
+        """
+
+        i = self.get_id(package)
+        if transitive:
+            ids = iter_bits(self.get_dependency_bits(i))
+        else:
+            ids = self._deps[i]
+        return set(self.packages[j] for j in ids)
+
+    def get_reverse_dependencies(self, package, transitive=False):
+        """
+        Args:
+            package (SrcInfoPackage)
+            transitive (bool): Include the reverse dependencies of reverse
+                dependencies
+        Returns:
+            set(SrcInfoPackage): The packages needing package to build
+        """
+
+        i = self.get_id(package)
+        if transitive:
+            ids = iter_bits(self.get_reverse_dependency_bits(i))
+        else:
+            ids = self._rdeps[i]
+        return set(self.packages[j] for j in ids)
+
+
+def _compute_closures(components, edges):
+    # components have to come after the ones their edges point to
+    closures = [0] * len(edges)
+    for component in components:
+        bits = 0
+        for i in component:
+            for j in edges[i]:
+                bits |= closures[j] | (1 << j)
+        for i in component:
+            closures[i] = bits
+    return closures
+
+
+def get_transitive_closures(edges):
+    """
+    Args:
+        edges (list): For each node the nodes it has edges to
+    Returns:
+        list(int): For each node a bitset of the nodes reachable from it.
+            Nodes in a cycle can reach themselves.
+    """
+
+    return _compute_closures(topological_order(edges), edges)
+
+
+def strongly_connected_components(edges):
+    """Tarjan's algorithm, without recursion.
+
+    Args:
+        edges (list): For each node ID the IDs it has an edge to
+    Returns:
+        list(list(int)): The strongly connected components. A component
+            comes after all components it has edges to.
+    """
+
+    count = len(edges)
+    index = [-1] * count
+    low = [0] * count
+    on_stack = bytearray(count)
+    stack = []
+    components = []
+    counter = 0
+
+    for root in range(count):
+        if index[root] != -1:
+            continue
+        work = [(root, 0)]
+        while work:
+            v, pos = work[-1]
+            if pos == 0:
+                index[v] = low[v] = counter
+                counter += 1
+                stack.append(v)
+                on_stack[v] = 1
+            targets = edges[v]
+            if pos < len(targets):
+                work[-1] = (v, pos + 1)
+                w = targets[pos]
+                if index[w] == -1:
+                    work.append((w, 0))
+                elif on_stack[w] and index[w] < low[v]:
+                    low[v] = index[w]
+                continue
+            work.pop()
+            if work:
+                u = work[-1][0]
+                if low[v] < low[u]:
+                    low[u] = low[v]
+            if low[v] == index[v]:
+                component = []
+                while True:
+                    w = stack.pop()
+                    on_stack[w] = 0
+                    component.append(w)
+                    if w == v:
+                        break
+                components.append(component)
+    return components
+
+
+def topological_order(edges):
+    """Orders nodes so that each node comes after the nodes it has edges to.
+
+    Nodes which are part of a cycle are grouped together. If more than one
+    component can come next the one with the smallest node ID wins, so the
+    result only depends on the graph.
+
+    Args:
+        edges (list): For each node ID the IDs it has an edge to
+    Returns:
+        list(list(int)): Sorted strongly connected components, each one
+            sorted by node ID
+    """
+
+    edges = [tuple(e) for e in edges]
+    components = [
+        sorted(c) for c in strongly_connected_components(edges)]
+    component_of = [0] * len(edges)
+    for c, component in enumerate(components):
+        for v in component:
+            component_of[v] = c
+
+    # Kahn's algorithm on the condensed graph
+    pending = [0] * len(components)
+    users = [[] for c in components]
+    for c, component in enumerate(components):
+        targets = set(component_of[w] for v in component for w in edges[v])
+        targets.discard(c)
+        pending[c] = len(targets)
+        for t in targets:
+            users[t].append(c)
+
+    ready = [(component[0], c) for c, component in enumerate(components)
+             if not pending[c]]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        c = heapq.heappop(ready)[1]
+        order.append(components[c])
+        for u in users[c]:
+            pending[u] -= 1
+            if not pending[u]:
+                heapq.heappush(ready, (components[u][0], u))
+    return order
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Christoph Reiter
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+"""Queries a git work tree for what changed, using the git executable"""
+
+from __future__ import print_function
+
+import os
+import subprocess
+
+
+def _git(path, args):
+    with open(os.devnull, 'wb') as devnull:
+        return subprocess.check_output(
+            ["git"] + args, cwd=path, stderr=devnull)
+
+
+def _split_paths(output):
+    return [p for p in output.decode("utf-8").split("\0") if p]
+
+
+def get_head(path):
+    """
+    Args:
+        path (str): A directory
+    Returns:
+        str or None: The commit checked out in the git work tree containing
+            path, or None if there is none or git isn't available
+    """
+
+    try:
+        return _git(path, ["rev-parse", "--verify", "-q", "HEAD"]).decode(
+            "ascii").strip()
+    except (EnvironmentError, subprocess.CalledProcessError):
+        return None
+
+
+def get_changed_paths(path, commit):
+    """Returns all files below path which differ in the work tree compared
+    to `commit`, including staged, deleted and untracked ones (but not
+    ignored ones).
+
+    Args:
+        path (str): A directory in a git work tree
+        commit (str)
+    Returns:
+        set(str) or None: Paths relative to path, using "/" as separator.
+            None if the changes couldn't be determined, for example because
+            commit no longer exists.
+    """
+
+    try:
+        changed = _split_paths(_git(
+            path, ["diff", "--name-only", "--no-renames", "--relative", "-z",
+                   commit, "--", "."]))
+        untracked = _split_paths(_git(
+            path, ["ls-files", "--others", "--exclude-standard", "-z",
+                   "--", "."]))
+    except (EnvironmentError, subprocess.CalledProcessError):
+        return None
+
+    return set(changed) | set(untracked)
@@ -24,19 +24,24 @@ from __future__ import print_function
 
 import subprocess
 
-from .utils import package_name_is_vcs, package_name_get_repo
+from .utils import package_name_is_vcs, package_name_get_repo, VersionKey, \
+    intern_string
 
 
 class PacmanPackage(object):
 
+    __slots__ = ("repo", "pkgname", "epoch", "pkgver", "pkgrel",
+                 "_version_key")
+
     def __init__(self, repo, pkgname, version):
-        self.repo = repo
+        self.repo = intern_string(repo)
         assert package_name_get_repo(pkgname) == repo
-        self.pkgname = pkgname
+        self.pkgname = intern_string(pkgname)
         self.epoch = None
         if "~" in version:
             self.epoch, version = version.split("~", 1)
         self.pkgver, self.pkgrel = version.rsplit("-", 1)
+        self._version_key = None
 
     def __repr__(self):
         return "<%s %s %s>" % (
@@ -55,6 +60,14 @@ class PacmanPackage(object):
             version = "%s~%s" % (self.epoch, version)
         return version
 
+    @property
+    def version_key(self):
+        """VersionKey: The build version, parsed for sorting and comparing"""
+
+        if self._version_key is None:
+            self._version_key = VersionKey(self.build_version)
+        return self._version_key
+
     @classmethod
     def get_all_packages(cls, remote_versions=False):
         """Returns a set of packages with the version they are installed
@@ -0,0 +1,620 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Christoph Reiter
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+"""Creates srcinfo text for simple PKGBUILD files without running makepkg.
+
+Only plain variable and array assignments, parameter expansion and
+function definitions are supported. Anything else raises UnsupportedError,
+in which case makepkg has to be used instead.
+"""
+
+from __future__ import print_function
+
+import re
+import fnmatch
+from collections import OrderedDict
+
+
+class UnsupportedError(Exception):
+    """Raised if a PKGBUILD can't be evaluated without bash"""
+
+
+# The variables makepkg-mingw sets up, in the order it runs makepkg
+ENVIRONMENTS = [
+    OrderedDict([
+        ("MSYSTEM", "MINGW64"),
+        ("CARCH", "x86_64"),
+        ("CHOST", "x86_64-w64-mingw32"),
+        ("MINGW_CHOST", "x86_64-w64-mingw32"),
+        ("MINGW_PREFIX", "/mingw64"),
+        ("MINGW_PACKAGE_PREFIX", "mingw-w64-x86_64"),
+    ]),
+    OrderedDict([
+        ("MSYSTEM", "MINGW32"),
+        ("CARCH", "i686"),
+        ("CHOST", "i686-w64-mingw32"),
+        ("MINGW_CHOST", "i686-w64-mingw32"),
+        ("MINGW_PREFIX", "/mingw32"),
+        ("MINGW_PACKAGE_PREFIX", "mingw-w64-i686"),
+    ]),
+]
+
+_HASH_ATTRIBUTES = [
+    "md5sums", "sha1sums", "sha224sums", "sha256sums", "sha384sums",
+    "sha512sums"]
+
+# same order as in makepkg's srcinfo.sh
+SINGLE_VALUED = [
+    "pkgdesc", "pkgver", "pkgrel", "epoch", "url", "install", "changelog"]
+
+MULTI_VALUED = [
+    "arch", "groups", "license", "checkdepends", "makedepends", "depends",
+    "optdepends", "provides", "conflicts", "replaces", "noextract",
+    "options", "backup", "source", "validpgpkeys"] + _HASH_ATTRIBUTES
+
+ARCH_ATTRIBUTES = [
+    "source", "provides", "conflicts", "depends", "replaces", "optdepends",
+    "makedepends", "checkdepends"] + _HASH_ATTRIBUTES
+
+_NAME = r"[A-Za-z_][A-Za-z0-9_]*"
+_ASSIGNMENT_RE = re.compile(r"(%s)(\+?=)" % _NAME)
+_FUNCTION_RE = re.compile(
+    r"(?:function[ \t]+)?([A-Za-z_][A-Za-z0-9_+.@-]*)[ \t]*\([ \t]*\)\s*\{")
+_HEREDOC_RE = re.compile(r"<<(-?)[ \t]*(['\"]?)([^ \t\n;&|<>()'\"]+)\2")
+_NESTED_FUNCTION_RE = re.compile(
+    r"^(?:function[ \t]+)?[A-Za-z_][A-Za-z0-9_+.@-]*[ \t]*\([ \t]*\)",
+    re.M)
+_BRACED_RE = re.compile(r"(%s)(?:\[(@|\*|[0-9]+)\])?(.*)$" % _NAME, re.S)
+_OPERATOR_RE = re.compile(r"(%%|%|##|#|//|/|:-|-)(.*)$", re.S)
+_OVERRIDE_RE = re.compile(
+    r"^[ \t]*(?:(?:declare|local)(?:[ \t]+-[A-Za-z]+)*[ \t]+)?(%s)\+?=" %
+    "|".join(SINGLE_VALUED + MULTI_VALUED), re.M)
+_SPACE_RE = re.compile(r"[ \t\n\r\f\v]+")
+_PKGREL_RE = re.compile(r"^[0-9]+(\.[0-9]+)?$")
+
+
+def _glob_regex(pattern):
+    if "(" in pattern or "\\" in pattern:
+        # extglob or escapes
+        raise UnsupportedError("unsupported pattern %r" % pattern)
+    return re.compile(fnmatch.translate(pattern))
+
+
+def _remove_affix(value, operator, pattern):
+    regex = _glob_regex(pattern)
+    n = len(value)
+    if operator == "#":
+        for i in range(0, n + 1):
+            if regex.match(value[:i]):
+                return value[i:]
+    elif operator == "##":
+        for i in range(n, -1, -1):
+            if regex.match(value[:i]):
+                return value[i:]
+    elif operator == "%":
+        for i in range(n, -1, -1):
+            if regex.match(value[i:]):
+                return value[:i]
+    elif operator == "%%":
+        for i in range(0, n + 1):
+            if regex.match(value[i:]):
+                return value[:i]
+    return value
+
+
+def _replace(value, pattern, replacement, replace_all):
+    if not pattern:
+        return value
+    if pattern[0] in "#%":
+        raise UnsupportedError("unsupported pattern %r" % pattern)
+    regex = _glob_regex(pattern)
+
+    result = []
+    i = 0
+    while i < len(value):
+        for j in range(len(value), i, -1):
+            if regex.match(value[i:j]):
+                result.append(replacement)
+                i = j
+                break
+        else:
+            result.append(value[i])
+            i += 1
+            continue
+        if not replace_all:
+            break
+    result.append(value[i:])
+    return "".join(result)
+
+
+class _Evaluator(object):
+    """Evaluates the top level of a PKGBUILD, or a part of it"""
+
+    def __init__(self, text, variables, functions):
+        self.text = text
+        self.pos = 0
+        self.variables = variables
+        self.functions = functions
+
+    def _error(self, message):
+        line = self.text.count("\n", 0, self.pos) + 1
+        return UnsupportedError("line %d: %s" % (line, message))
+
+    def _peek(self, offset=0):
+        return self.text[self.pos + offset:self.pos + offset + 1]
+
+    def _skip_blank(self, newlines=True):
+        blank = " \t\n" if newlines else " \t"
+        while self.pos < len(self.text):
+            c = self.text[self.pos]
+            if c in blank:
+                self.pos += 1
+            elif c == "\\" and self._peek(1) == "\n":
+                self.pos += 2
+            elif c == "#":
+                end = self.text.find("\n", self.pos)
+                self.pos = len(self.text) if end == -1 else end
+            else:
+                break
+
+    def run(self):
+        while True:
+            self._skip_blank()
+            if self.pos >= len(self.text):
+                break
+
+            # bash only allows ";" after a command, so ";;" or a leading
+            # ";" would be a syntax error
+            if self._peek() == ";":
+                raise self._error("unexpected ;")
+
+            match = _FUNCTION_RE.match(self.text, self.pos)
+            if match is not None:
+                self._function(match)
+            else:
+                match = _ASSIGNMENT_RE.match(self.text, self.pos)
+                if match is None:
+                    raise self._error("unsupported statement")
+                self.pos = match.end()
+                self._assignment(match.group(1), match.group(2) == "+=")
+
+            self._skip_blank(newlines=False)
+            if self._peek() == ";":
+                self.pos += 1
+
+    def _function(self, match):
+        name = match.group(1)
+        end = self._function_end(match.end())
+        body = self.text[match.end():end]
+        if _NESTED_FUNCTION_RE.search(body):
+            raise self._error("function %s defines a function" % name)
+        self.pos = end + 1
+        self.functions[name] = body
+
+    def _function_end(self, pos):
+        """Returns the position of the brace closing the function body
+        starting at pos, skipping quotes, comments and here documents.
+        """
+
+        text = self.text
+        # "{" is a brace group or ${}, "(" a $() inside double quotes
+        stack = ["{"]
+        heredocs = []
+        i = pos
+        while i < len(text):
+            c = text[i]
+            top = stack[-1]
+            if top == '"':
+                if c == "\\":
+                    i += 1
+                elif c == '"':
+                    stack.pop()
+                elif c == "$" and text[i + 1:i + 2] == "(":
+                    stack.append("(")
+                    i += 1
+                elif c == "`":
+                    stack.append("`")
+                i += 1
+                continue
+
+            if c == "\\":
+                i += 1
+            elif c == "'":
+                i = text.find("'", i + 1)
+                if i == -1:
+                    break
+            elif c == '"':
+                stack.append('"')
+            elif c == "`":
+                if top == "`":
+                    stack.pop()
+                else:
+                    stack.append("`")
+            elif c == "#" and (i == 0 or text[i - 1] in " \t\n;&|()"):
+                i = text.find("\n", i)
+                if i == -1:
+                    break
+                continue
+            elif c == "<" and text.startswith("<<", i) and \
+                    not text.startswith("<<<", i):
+                heredoc = _HEREDOC_RE.match(text, i)
+                if heredoc is None:
+                    break
+                heredocs.append((heredoc.group(1), heredoc.group(3)))
+                i = heredoc.end()
+                continue
+            elif c == "\n" and heredocs:
+                for dash, delimiter in heredocs:
+                    while True:
+                        if i == -1 or i + 1 >= len(text):
+                            raise self._error(
+                                "here document %s not terminated" %
+                                delimiter)
+                        line_end = text.find("\n", i + 1)
+                        if line_end == -1:
+                            line_end = len(text)
+                        line = text[i + 1:line_end]
+                        i = line_end
+                        if (line.lstrip("\t") if dash else line) == \
+                                delimiter:
+                            break
+                del heredocs[:]
+                continue
+            elif c == "{" or (c == "(" and top == "("):
+                stack.append(c)
+            elif c == "}" and top == "{":
+                stack.pop()
+                if not stack:
+                    return i
+            elif c == ")" and top == "(":
+                stack.pop()
+            i += 1
+
+        raise self._error("end of function not found")
+
+    def _assignment(self, name, append):
+        is_array = self._peek() == "("
+        if is_array:
+            self.pos += 1
+            values = []
+            while True:
+                self._skip_blank()
+                c = self._peek()
+                if not c:
+                    raise self._error("unterminated array")
+                elif c == ")":
+                    self.pos += 1
+                    break
+                elif c == ";":
+                    raise self._error("unexpected ;")
+                values.extend(self._word(True))
+        else:
+            values = self._word(False)
+
+        if append:
+            old = self.variables.get(name, [])
+            if is_array or not old:
+                values = old + values
+            else:
+                values = [old[0] + values[0]] + old[1:]
+        self.variables[name] = values
+
+        # "foo=bar command" would run a command
+        self._skip_blank(newlines=False)
+        c = self._peek()
+        if c and c not in "\n;" and \
+                _ASSIGNMENT_RE.match(self.text, self.pos) is None:
+            raise self._error("unsupported statement")
+
+    def _lookup(self, name):
+        try:
+            return self.variables[name]
+        except KeyError:
+            raise self._error("undefined variable %s" % name)
+
+    def _word(self, in_array):
+        """Returns a list of words, in case of arrays empty or more than
+        one.
+        """
+
+        start = self.pos
+        parts = []
+        quoted = False
+        while self.pos < len(self.text):
+            c = self.text[self.pos]
+            if c in " \t\n;":
+                break
+            elif c == ")":
+                if in_array:
+                    break
+                raise self._error("unexpected )")
+            elif c in "(&|<>`":
+                raise self._error("unsupported character %r" % c)
+            elif c in "*?[{" or (c == "~" and self.pos == start):
+                raise self._error("unsupported expansion %r" % c)
+            elif c == "'":
+                end = self.text.find("'", self.pos + 1)
+                if end == -1:
+                    raise self._error("unterminated quote")
+                parts.append(self.text[self.pos + 1:end])
+                self.pos = end + 1
+                quoted = True
+            elif c == '"':
+                self.pos += 1
+                fields = self._double_quoted()
+                if isinstance(fields, list):
+                    if parts or self._peek() not in ("", " ", "\t", "\n",
+                                                      ";", ")"):
+                        raise self._error("unsupported array expansion")
+                    return fields if in_array else [" ".join(fields)]
+                parts.append(fields)
+                quoted = True
+            elif c == "\\":
+                if self._peek(1) == "\n":
+                    self.pos += 2
+                    continue
+                parts.append(self._peek(1))
+                self.pos += 2
+                quoted = True
+            elif c == "$":
+                self.pos += 1
+                value = self._expansion()
+                values = value if isinstance(value, list) else [value]
+                for v in values:
+                    if _SPACE_RE.search(v) or any(g in v for g in "*?["):
+                        # would be split into multiple words or globbed
+                        raise self._error("unquoted expansion %r" % v)
+                if isinstance(value, list):
+                    if not in_array:
+                        value = " ".join(value)
+                    elif parts or self._peek() not in ("", " ", "\t",
+                                                       "\n", ";", ")"):
+                        raise self._error("unsupported array expansion")
+                    else:
+                        return [v for v in value if v]
+                parts.append(value)
+            else:
+                parts.append(c)
+                self.pos += 1
+
+        word = "".join(parts)
+        if in_array and not word and not quoted:
+            return []
+        return [word]
+
+    def _double_quoted(self):
+        """Returns a string, or a list in case of "${array[@]}" """
+
+        parts = []
+        while True:
+            c = self._peek()
+            if not c:
+                raise self._error("unterminated quote")
+            elif c == '"':
+                self.pos += 1
+                break
+            elif c == "`":
+                raise self._error("unsupported command substitution")
+            elif c == "\\":
+                n = self._peek(1)
+                if n == "\n":
+                    pass
+                elif n in '$`"\\':
+                    parts.append(n)
+                else:
+                    parts.append(c + n)
+                self.pos += 2
+            elif c == "$":
+                self.pos += 1
+                value = self._expansion()
+                if isinstance(value, list):
+                    if not parts and self._peek() == '"':
+                        self.pos += 1
+                        return value
+                    raise self._error("unsupported array expansion")
+                parts.append(value)
+            else:
+                parts.append(c)
+                self.pos += 1
+        return "".join(parts)
+
+    def _expansion(self):
+        """Expands what follows a "$". Returns a string, or a list for
+        ${array[@]}
+        """
+
+        c = self._peek()
+        if c == "{":
+            # bash only counts nested "${", a "{" on its own doesn't need a
+            # matching "}"
+            depth = 1
+            end = self.pos + 1
+            while end < len(self.text):
+                c = self.text[end]
+                if c == "$" and self.text[end + 1:end + 2] == "{":
+                    depth += 1
+                    end += 1
+                elif c == "{":
+                    raise self._error("unsupported { in ${")
+                elif c == "}":
+                    depth -= 1
+                    if depth == 0:
+                        break
+                end += 1
+            else:
+                raise self._error("unterminated ${")
+            content = self.text[self.pos + 1:end]
+            self.pos = end + 1
+            return self._braced(content)
+
+        match = re.compile(_NAME).match(self.text, self.pos)
+        if match is not None:
+            self.pos = match.end()
+            values = self._lookup(match.group())
+            return values[0] if values else ""
+        elif c and c not in " \t\n\"":
+            raise self._error("unsupported expansion $%s" % c)
+        return "$"
+
+    def _sub_expand(self, text):
+        if any(c in text for c in "'\"`\\"):
+            raise self._error("unsupported quoting in %r" % text)
+        evaluator = _Evaluator(
+            '"%s"' % text, self.variables, self.functions)
+        evaluator.pos = 1
+        return evaluator._double_quoted()
+
+    def _braced(self, content):
+        match = _BRACED_RE.match(content)
+        if match is None:
+            raise self._error("unsupported expansion ${%s}" % content)
+        name, index, rest = match.groups()
+
+        operator = argument = None
+        if rest:
+            match = _OPERATOR_RE.match(rest)
+            if match is None or index in ("@", "*"):
+                raise self._error("unsupported expansion ${%s}" % content)
+            operator, argument = match.groups()
+
+        if operator in (":-", "-") and name not in self.variables:
+            return self._sub_expand(argument)
+        values = self._lookup(name)
+
+        if index == "@":
+            return list(values)
+        elif index == "*":
+            # one word, joined with the first character of the default IFS
+            return " ".join(values)
+        elif index is not None:
+            index = int(index)
+            value = values[index] if index < len(values) else ""
+        else:
+            value = values[0] if values else ""
+
+        if operator is None:
+            return value
+        elif operator in (":-", "-"):
+            if operator == ":-" and not value:
+                return self._sub_expand(argument)
+            return value
+        elif operator in ("/", "//"):
+            pattern, replacement = (argument.split("/", 1) + [""])[:2]
+            return _replace(
+                value, self._sub_expand(pattern),
+                self._sub_expand(replacement), operator == "//")
+        else:
+            return _remove_affix(
+                value, operator, self._sub_expand(argument))
+
+
+def evaluate(text, environment):
+    """Evaluates the top level of a PKGBUILD
+
+    Args:
+        text (str): The PKGBUILD content
+        environment (dict): Variables defined before the PKGBUILD is read
+    Returns:
+        tuple: (variables, functions) where variables maps names to lists
+            of values and functions maps function names to their body
+    Raises:
+        UnsupportedError
+    """
+
+    variables = OrderedDict((k, [v]) for k, v in environment.items())
+    functions = OrderedDict()
+    _Evaluator(text, variables, functions).run()
+    return variables, functions
+
+
+def _format_attribute(name, values):
+    return "".join(
+        "\t%s = %s\n" % (name, _SPACE_RE.sub(" ", v).strip())
+        for v in values)
+
+
+def format_srcinfo(variables, functions):
+    """Creates the srcinfo text makepkg would for one environment
+
+    Args:
+        variables (dict): see evaluate()
+        functions (dict): see evaluate()
+    Returns:
+        str
+    Raises:
+        UnsupportedError: In case makepkg would extract more or would fail
+    """
+
+    pkgnames = variables.get("pkgname")
+    if not pkgnames or not pkgnames[0]:
+        raise UnsupportedError("pkgname missing")
+
+    for name in ("pkgver", "pkgrel"):
+        if not variables.get(name, [""])[0]:
+            raise UnsupportedError("%s missing" % name)
+    pkgver = variables["pkgver"][0]
+    if any(c in pkgver for c in ":/- \t\n") or \
+            not _PKGREL_RE.match(variables["pkgrel"][0]):
+        # let makepkg complain
+        raise UnsupportedError("invalid version")
+
+    for name in variables:
+        for attr in ARCH_ATTRIBUTES:
+            if name.startswith(attr + "_"):
+                raise UnsupportedError("arch specific %s" % name)
+
+    for name, body in functions.items():
+        if name.startswith("package_") and _OVERRIDE_RE.search(body):
+            raise UnsupportedError("%s overrides variables" % name)
+
+    pkgbase = variables.get("pkgbase", [""])[0] or pkgnames[0]
+    text = "pkgbase = %s\n" % pkgbase
+    for name in SINGLE_VALUED:
+        value = variables.get(name, [""])[0]
+        if value:
+            text += _format_attribute(name, [value])
+    for name in MULTI_VALUED:
+        values = variables.get(name, [])
+        if values and values[0]:
+            text += _format_attribute(name, values)
+    text += "\n"
+
+    for pkgname in pkgnames:
+        text += "pkgname = %s\n\n" % pkgname
+
+    return text
+
+
+def get_srcinfo_for_text(text):
+    """Creates the srcinfo text makepkg-mingw --printsrcinfo would
+
+    Args:
+        text (str): The PKGBUILD content
+    Returns:
+        str
+    Raises:
+        UnsupportedError: In case the PKGBUILD can't be evaluated statically
+    """
+
+    return "".join(
+        format_srcinfo(*evaluate(text, environment))
+        for environment in ENVIRONMENTS)
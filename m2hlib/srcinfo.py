@@ -24,44 +24,120 @@ from __future__ import print_function
 
 import sys
 import os
-import json
-import threading
-from collections import OrderedDict
 import hashlib
 import subprocess
-from multiprocessing.pool import ThreadPool
 from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from . import gitrepo
+from .depgraph import DependencyGraph, parse_dependency
+from .srcinfocache import get_cache, get_fingerprint_index, \
+    get_package_snapshot, stat_key, is_racy
+from .pkgbuild import get_srcinfo_for_text, UnsupportedError
+from .utils import progress, package_name_is_vcs, package_name_get_repo, \
+    VersionKey, intern_string, intern_strings, check_output_timeout, \
+    CommandTimeoutError, EXECUTORS
 
-from .utils import progress, package_name_is_vcs, package_name_get_repo
+
+# Seconds after which makepkg gets killed, it usually takes less than one
+DEFAULT_TIMEOUT = 120
 
 
 class SrcInfoPool(object):
 
     def __init__(self):
         self._packages = {}
+        self._graph = None
 
     def add_package(self, package):
         name = package.pkgname
         self._packages.setdefault(name, set()).add(package)
+        if self._graph is not None:
+            self._graph.add_package(package)
+
+    def get_graph(self):
+        """
+        Returns:
+            DependencyGraph: The dependency graph of all packages
+        """
+
+        if self._graph is None:
+            packages = []
+            for name in sorted(self._packages):
+                packages.extend(sorted(
+                    self._packages[name], key=lambda p: p.pkgbuild_path))
+            self._graph = DependencyGraph(packages)
+        return self._graph
+
+    def depends_on(self, package, other):
+        """
+        Returns:
+            bool: If package needs other to build, directly or not
+        """
+
+        return self.get_graph().depends_on(package, other)
 
     def get_transitive_dependencies(self, package):
-        packages_todo = set([package])
-        packages_done = set()
-        deps = set()
-
-        while packages_todo:
-            p = packages_todo.pop()
-            packages_done.add(p)
-            new_deps = set(p.depends + p.makedepends)
-            deps.update(new_deps)
-            for d in new_deps:
-                for new_p in self._packages.get(d, set()):
-                    if new_p not in packages_done:
-                        packages_todo.add(new_p)
+        """
+        Returns:
+            set(str): The names of all packages needed to build package,
+                including dependencies not provided by any package in the
+                pool
+        """
+
+        graph = self.get_graph()
+        packages = graph.get_dependencies(package, transitive=True)
+        deps = set(p.pkgname for p in packages)
+        for p in packages | set([package]):
+            for dependency in graph.get_unresolved(p):
+                deps.add(parse_dependency(dependency)[0])
         return deps
 
 
+# srcinfo keys which get stored, mapped to (attribute, is_list)
+SRCINFO_FIELDS = {
+    "pkgdesc": ("pkgdesc", False),
+    "pkgver": ("pkgver", False),
+    "pkgrel": ("pkgrel", False),
+    "epoch": ("epoch", False),
+    "arch": ("arch", True),
+    "groups": ("groups", True),
+    "depends": ("depends", True),
+    "makedepends": ("makedepends", True),
+    "checkdepends": ("checkdepends", True),
+    "optdepends": ("optdepends", True),
+    "provides": ("provides", True),
+    "conflicts": ("conflicts", True),
+    "replaces": ("replaces", True),
+    "source": ("sources", True),
+}
+
+_LIST_KEYS = sorted(
+    (key, attr) for key, (attr, is_list) in SRCINFO_FIELDS.items() if is_list)
+
+_LIST_ATTRIBUTES = tuple(attr for key, attr in _LIST_KEYS)
+
+
 class SrcInfoPackage(object):
+    """A package built by a PKGBUILD. All list values (depends, sources...)
+    are tuples of interned strings.
+    """
+
+    __slots__ = ("pkgbuild_path", "pkgbase", "pkgname", "pkgver", "pkgrel",
+                 "epoch", "pkgdesc", "_version_key") + _LIST_ATTRIBUTES
 
     def __init__(self, pkgbuild_path, pkgbase, pkgname, pkgver, pkgrel):
         self.pkgbuild_path = pkgbuild_path
@@ -70,9 +146,10 @@ class SrcInfoPackage(object):
         self.pkgver = pkgver
         self.pkgrel = pkgrel
         self.epoch = None
-        self.depends = []
-        self.makedepends = []
-        self.sources = []
+        self.pkgdesc = None
+        for attr in _LIST_ATTRIBUTES:
+            setattr(self, attr, ())
+        self._version_key = None
 
     def __repr__(self):
         return "<%s %s %s %s>" % (
@@ -94,46 +171,134 @@ class SrcInfoPackage(object):
             version = "%s~%s" % (self.epoch, version)
         return version
 
+    @property
+    def version_key(self):
+        """VersionKey: The build version, parsed for sorting and comparing"""
+
+        if self._version_key is None:
+            self._version_key = VersionKey(self.build_version)
+        return self._version_key
+
+    # everything except pkgbuild_path, see to_row()
+    ROW_ATTRIBUTES = ("pkgbase", "pkgname", "pkgver", "pkgrel", "epoch",
+                      "pkgdesc") + _LIST_ATTRIBUTES
+
+    def to_row(self):
+        """
+        Returns:
+            tuple: The values of ROW_ATTRIBUTES, for serializing
+        """
+
+        return tuple([getattr(self, attr) for attr in self.ROW_ATTRIBUTES])
+
+    @classmethod
+    def from_row(cls, pkgbuild_path, row, memo=None):
+        """The reverse of to_row(). The strings get interned, like the ones
+        of for_srcinfo().
+
+        Args:
+            memo (dict or None): Pass the same dict for the rows of one
+                PKGBUILD, so lists shared between them stay shared
+        """
+
+        if memo is None:
+            memo = {}
+        package = cls(pkgbuild_path, None, None, None, None)
+        for attr, value in zip(cls.ROW_ATTRIBUTES, row):
+            if isinstance(value, tuple):
+                key = id(value)
+                if key not in memo:
+                    memo[key] = intern_strings(value)
+                value = memo[key]
+            elif value is not None:
+                value = intern_string(value)
+            setattr(package, attr, value)
+        return package
+
     @classmethod
     def for_srcinfo(cls, pkgbuild_path, srcinfo):
+        """Parses srcinfo text, which can contain multiple pkgbase sections
+
+        Values set in a pkgname section replace the ones of the pkgbase
+        section for that package. All other values are shared between the
+        packages of a pkgbase section, including the lists.
+
+        Returns:
+            set(SrcInfoPackage)
+        """
+
         packages = set()
+        fields = SRCINFO_FIELDS
+        base = None
+        package = None
+        # the lists of the current section, by attribute
+        lists = {}
 
         for line in srcinfo.splitlines():
-            line = line.strip()
-            if line.startswith("pkgbase = "):
-                pkgver = pkgrel = epoch = None
-                depends = []
-                makedepends = []
-                sources = []
-                pkgbase = line.split(" = ", 1)[-1]
-            elif line.startswith("depends = "):
-                depends.append(line.split(" = ", 1)[-1])
-            elif line.startswith("makedepends = "):
-                makedepends.append(line.split(" = ", 1)[-1])
-            elif line.startswith("source = "):
-                sources.append(line.split(" = ", 1)[-1])
-            elif line.startswith("pkgver = "):
-                pkgver = line.split(" = ", 1)[-1]
-            elif line.startswith("pkgrel = "):
-                pkgrel = line.split(" = ", 1)[-1]
-            elif line.startswith("epoch = "):
-                epoch = line.split(" = ", 1)[-1]
-            elif line.startswith("pkgname = "):
-                pkgname = line.split(" = ", 1)[-1]
-                package = cls(pkgbuild_path, pkgbase, pkgname, pkgver, pkgrel)
-                package.epoch = epoch
-                package.depends = depends
-                package.makedepends = makedepends
-                package.sources = sources
-                packages.add(package)
+            key, sep, value = line.strip().partition(" = ")
+            field = fields.get(key)
+            if field is not None:
+                if base is None:
+                    continue
+                attr, is_list = field
+                if is_list:
+                    values = lists.get(attr)
+                    if values is None:
+                        lists[attr] = [value]
+                    else:
+                        values.append(value)
+                elif package is None:
+                    base[attr] = intern_string(value)
+                else:
+                    setattr(package, attr, intern_string(value))
+            elif key == "pkgbase" or key == "pkgname":
+                # the previous section is done, freeze its lists. Lists
+                # set in a pkgname section replace the pkgbase ones.
+                if package is not None:
+                    for attr, values in lists.items():
+                        setattr(package, attr, intern_strings(values))
+                elif base is not None:
+                    for attr, values in lists.items():
+                        base[attr] = intern_strings(values)
+                lists = {}
+
+                if key == "pkgbase":
+                    package = None
+                    base = dict(pkgbase=intern_string(value), pkgver=None,
+                                pkgrel=None)
+                elif base is not None:
+                    package = cls(pkgbuild_path, base["pkgbase"],
+                                  intern_string(value), base["pkgver"],
+                                  base["pkgrel"])
+                    for attr, base_value in base.items():
+                        setattr(package, attr, base_value)
+                    packages.add(package)
+            elif not sep and base is not None and key.endswith(" ="):
+                # "key = " with the space stripped, makepkg writes that
+                # when a pkgname section clears a value
+                field = fields.get(key[:-2])
+                if field is None:
+                    continue
+                attr, is_list = field
+                if is_list:
+                    lists[attr] = []
+                elif package is None:
+                    base[attr] = None
+                else:
+                    setattr(package, attr, None)
+
+        if package is not None:
+            for attr, values in lists.items():
+                setattr(package, attr, intern_strings(values))
 
         return packages
 
     @classmethod
-    def for_pkgbuild(cls, pkgbuild_path):
+    def for_pkgbuild(cls, pkgbuild_path, paranoid=False,
+                     timeout=DEFAULT_TIMEOUT):
         packages = set()
 
-        srcinfo = get_srcinfo_for_pkgbuild(pkgbuild_path)
+        srcinfo = get_srcinfo_for_pkgbuild(pkgbuild_path, paranoid, timeout)
         if srcinfo is None:
             return packages
 
@@ -141,99 +306,501 @@ class SrcInfoPackage(object):
         return packages
 
 
-DIR = os.path.dirname(os.path.realpath(__file__))
-CACHE = OrderedDict()
-CACHE_LOCK = threading.Lock()
+# describes the package snapshot content, change when it changes
+_SNAPSHOT_SCHEMA = ("srcinfo", 2, SrcInfoPackage.ROW_ATTRIBUTES)
 
 
-def _load_cache():
-    with CACHE_LOCK:
-        if CACHE:
-            return
-        try:
-            with open(os.path.join(DIR, "_srcinfocache.json"), "rb") as h:
-                cache = json.loads(h.read(), object_pairs_hook=OrderedDict)
-        except EnvironmentError:
-            return
-        CACHE.update(cache)
+def _get_pkgbuild_digest(pkgbuild_path, paranoid=False):
+    """Returns the fingerprint from before reading the file and the digest
+    """
 
+    index = get_fingerprint_index()
+    fingerprint = index.stat(pkgbuild_path)
+    digest = None
+    if not paranoid:
+        digest = index.lookup(pkgbuild_path, fingerprint)
 
-def _save_cache():
-    with CACHE_LOCK:
-        with open(os.path.join(DIR, "_srcinfocache.json"), "wb") as h:
-            cache = OrderedDict(sorted(CACHE.items()))
-            h.write(json.dumps(cache, indent=2).encode("utf-8"))
+    if digest is None:
+        with open(pkgbuild_path, "rb") as f:
+            h = hashlib.new("SHA1")
+            h.update(f.read())
+            digest = h.hexdigest()
+        index.update(pkgbuild_path, fingerprint, digest)
 
+    return fingerprint, digest
 
-def get_srcinfo_for_pkgbuild(pkgbuild_path):
-    """Given a path to a PKGBUILD file returns the srcinfo text
+
+def generate_srcinfo(pkgbuild_path, timeout=DEFAULT_TIMEOUT):
+    """Creates the srcinfo text for a PKGBUILD file, without using the
+    cache. Tries the static evaluation first and falls back to makepkg.
 
     Args:
         pkgbuild_path (str): Path to PKGBUILD
+        timeout (float or None): Seconds after which makepkg gets killed
     Return:
         str or None: srcinfo text or None in case it failed.
     """
 
     with open(pkgbuild_path, "rb") as f:
-        h = hashlib.new("SHA1")
-        h.update(f.read())
-        digest = h.hexdigest()
-
-    _load_cache()
+        data = f.read()
+
+    # try without bash first, most PKGBUILDs are simple enough
+    try:
+        return get_srcinfo_for_text(data.decode("utf-8"))
+    except (UnicodeDecodeError, UnsupportedError):
+        pass
+
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            return check_output_timeout(
+                ["bash", "/usr/bin/makepkg-mingw", "--printsrcinfo", "-p",
+                 os.path.basename(pkgbuild_path)],
+                timeout=timeout,
+                cwd=os.path.dirname(pkgbuild_path),
+                stderr=devnull).decode("utf-8")
+    except subprocess.CalledProcessError as e:
+        print(
+            "ERROR: %s %s" % (pkgbuild_path, e.output.splitlines()),
+            file=sys.stderr)
+    except CommandTimeoutError as e:
+        print("ERROR: %s timed out after %s seconds" % (
+            pkgbuild_path, e.timeout), file=sys.stderr)
+
+
+def get_srcinfo_for_pkgbuild(pkgbuild_path, paranoid=False,
+                             timeout=DEFAULT_TIMEOUT):
+    """Given a path to a PKGBUILD file returns the srcinfo text
 
-    with CACHE_LOCK:
-        text = CACHE.get(digest)
+    Args:
+        pkgbuild_path (str): Path to PKGBUILD
+        paranoid (bool): Always hash the PKGBUILD, even if the file
+            didn't change according to the fingerprint index
+        timeout (float or None): Seconds after which makepkg gets killed
+    Return:
+        str or None: srcinfo text or None in case it failed.
+    """
 
+    digest = _get_pkgbuild_digest(pkgbuild_path, paranoid)[1]
+    cache = get_cache()
+    text = cache.get(digest)
     if text is None:
-        try:
-            with open(os.devnull, 'wb') as devnull:
-                text = subprocess.check_output(
-                    ["bash", "/usr/bin/makepkg-mingw", "--printsrcinfo", "-p",
-                     os.path.basename(pkgbuild_path)],
-                    cwd=os.path.dirname(pkgbuild_path),
-                    stderr=devnull).decode("utf-8")
-        except subprocess.CalledProcessError as e:
-            print(
-                "ERROR: %s %s" % (pkgbuild_path, e.output.splitlines()),
-                file=sys.stderr)
-            return
-
-        with CACHE_LOCK:
-            CACHE[digest] = text
-
-        _save_cache()
-
+        text = generate_srcinfo(pkgbuild_path, timeout)
+        if text is not None:
+            cache.set(digest, text)
     return text
 
 
-def iter_packages(repo_path):
+def _generate_srcinfo_job(job):
+    pkgbuild_path, digest, timeout = job
+    return pkgbuild_path, digest, generate_srcinfo(pkgbuild_path, timeout)
+
+
+def add_iter_packages_arguments(parser, jobs_option=True):
+    """Adds the arguments which get passed to iter_packages() by
+    iter_packages_for_args()
+
+    Args:
+        jobs_option (bool): If False the number of jobs is set with
+            --parse-jobs instead of -j/--jobs, for commands which use
+            those for something else
+    """
+
+    parser.add_argument(
+        '--paranoid', action='store_true',
+        help="Hash all PKGBUILD files, even if they look unchanged")
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help="In a git work tree only look at the PKGBUILD files which "
+             "changed since the last incremental run")
+    parser.add_argument(
+        *(['-j', '--jobs'] if jobs_option else ['--parse-jobs']),
+        dest="parse_jobs", type=int, default=None, metavar="N",
+        help="Number of PKGBUILD files to process in parallel "
+             "(default: depends on --executor)")
+    parser.add_argument(
+        '--executor', choices=list(EXECUTORS), default="thread",
+        help="Run makepkg from threads or from processes, which also "
+             "evaluate PKGBUILD files in parallel (default: thread)")
+    parser.add_argument(
+        '--timeout', type=float, default=DEFAULT_TIMEOUT, metavar="SECONDS",
+        help="Give up on a PKGBUILD file if makepkg takes longer than this, "
+             "0 disables the limit (default: %(default)s)")
+
+
+def iter_packages_for_args(repo_path, args):
+    return iter_packages(
+        repo_path, paranoid=args.paranoid, jobs=args.parse_jobs,
+        executor=args.executor, timeout=args.timeout or None,
+        incremental=args.incremental)
+
+
+# Directories which never contain PKGBUILD files. The src and pkg
+# directories makepkg leaves behind sit next to a PKGBUILD, and directories
+# with a PKGBUILD don't get searched any further anyway.
+SKIP_DIRS = frozenset([".git", ".hg", ".svn"])
+
+
+def _scan_dir(path):
+    """Returns (pkgbuild_path, subdirs, mtime). The content only gets listed
+    if there is no PKGBUILD, in which case pkgbuild_path is None and
+    subdirs are the sorted directories to search next.
+    """
+
+    pkgbuild_path = os.path.join(path, "PKGBUILD")
+    if os.path.isfile(pkgbuild_path):
+        return pkgbuild_path, [], None
+
+    # before listing, so changes while listing get noticed next time
+    mtime = _get_dir_mtime(path)
+    names = []
+    try:
+        if scandir is not None:
+            for entry in scandir(path):
+                if entry.name not in SKIP_DIRS and \
+                        entry.is_dir(follow_symlinks=False):
+                    names.append(entry.name)
+        else:
+            for name in os.listdir(path):
+                sub = os.path.join(path, name)
+                if name not in SKIP_DIRS and os.path.isdir(sub) and \
+                        not os.path.islink(sub):
+                    names.append(name)
+    except EnvironmentError:
+        return None, [], None
+
+    names.sort()
+    return None, [os.path.join(path, n) for n in names], mtime
+
+
+def _find_pkgbuilds(repo_path, dirs):
+    """Yields PKGBUILD paths in a deterministic order, directories get
+    searched in parallel. Directories containing a PKGBUILD aren't searched
+    any further.
+
+    Args:
+        repo_path (str)
+        dirs (dict): gets filled with the mtimes of the directories which
+            got searched (see _get_dir_mtime()), relative to repo_path
+    """
+
+    pool = ThreadPool(cpu_count() * 2)
+
+    def walk(paths):
+        # imap() scans ahead, but returns results in order
+        for i, result in enumerate(pool.imap(_scan_dir, paths)):
+            pkgbuild_path, subdirs, mtime = result
+            path = paths[i]
+            if pkgbuild_path is not None:
+                yield pkgbuild_path
+            else:
+                dirs[_to_relpath(repo_path, path)] = mtime
+                for sub_path in walk(subdirs):
+                    yield sub_path
+
+    try:
+        for path in walk([repo_path]):
+            yield path
+    finally:
+        pool.terminate()
+
+
+def _get_dir_mtime(path):
+    # the mtime changes when entries get added or removed, None if that
+    # can't be trusted yet
+    try:
+        mtime = stat_key(os.stat(path))[1]
+    except EnvironmentError:
+        return None
+    if is_racy(mtime):
+        return None
+    return mtime
+
+
+def _to_relpath(repo_path, path):
+    # all paths are built by joining repo_path, so skip os.path.relpath()
+    if path == repo_path:
+        return ""
+    prefix = os.path.join(repo_path, "")
+    assert path.startswith(prefix)
+    return path[len(prefix):].replace(os.sep, "/")
+
+
+def _from_relpath(repo_path, relpath):
+    if not relpath:
+        return repo_path
+    return os.path.join(repo_path, *relpath.split("/"))
+
+
+def _get_affected_pkgbuilds(changed, entries):
+    """Returns the PKGBUILD files which need to be looked at again, given
+    changed files and the PKGBUILD files known from the last run.
+    """
+
+    affected = set()
+    for path in changed:
+        parts = path.split("/")
+        if parts[-1] == "PKGBUILD":
+            affected.add(path)
+        # anything in the same or a parent directory
+        for i in range(len(parts)):
+            candidate = "/".join(parts[:i] + ["PKGBUILD"])
+            if candidate in entries:
+                affected.add(candidate)
+    return affected
+
+
+def _has_parent_pkgbuild(repo_path, relpath):
+    # _find_pkgbuilds() doesn't look below directories with a PKGBUILD
+    parts = relpath.split("/")[:-2]
+    for i in range(len(parts) + 1):
+        path = os.path.join(repo_path, *(parts[:i] + ["PKGBUILD"]))
+        if os.path.isfile(path):
+            return True
+    return False
+
+
+def _find_pkgbuilds_validated(repo_path, content):
+    """Like _find_pkgbuilds(), but skips the search if none of the searched
+    directories changed since the snapshot was taken. Snapshot entries of
+    files which didn't change according to their fingerprint get reused.
+
+    Returns:
+        tuple: (pkgbuild_paths, dirs, reused). `pkgbuild_paths` is an
+            iterable, `reused` maps PKGBUILD paths to snapshot entries.
+    """
+
+    if content is None:
+        dirs = {}
+        return _find_pkgbuilds(repo_path, dirs), dirs, {}
+
+    dirs = content["dirs"]
+    valid = True
+    for relpath, mtime in dirs.items():
+        if mtime is None or \
+                _get_dir_mtime(_from_relpath(repo_path, relpath)) != mtime:
+            valid = False
+            break
 
     pkgbuild_paths = []
-    if os.path.isfile(repo_path) and os.path.basename(repo_path) == "PKGBUILD":
-        pkgbuild_paths.append(repo_path)
+    reused = {}
+    for relpath, entry in content["entries"].items():
+        path = _from_relpath(repo_path, relpath)
+        try:
+            fingerprint = stat_key(os.stat(path))
+        except EnvironmentError:
+            # gone, something else could be found in its place
+            valid = False
+            continue
+        pkgbuild_paths.append(path)
+        if entry[0] == fingerprint and entry[2] is not None:
+            reused[path] = entry
+
+    if not valid:
+        dirs = {}
+        return _find_pkgbuilds(repo_path, dirs), dirs, reused
+    pkgbuild_paths.sort()
+    return pkgbuild_paths, dirs, reused
+
+
+def _find_pkgbuilds_incremental(repo_path, content):
+    """Like _find_pkgbuilds(), but only looks at the files which git reports
+    as changed since the snapshot was taken and reuses the rest. Falls back
+    to _find_pkgbuilds_validated().
+
+    Returns:
+        tuple: (pkgbuild_paths, dirs, reused, git_state). `git_state` is
+            the state to save in the snapshot for the next run, or None if
+            repo_path isn't in a git work tree. `dirs` is None if no search
+            happened.
+    """
+
+    commit = gitrepo.get_head(repo_path)
+    dirty = None
+    if commit is not None:
+        dirty = gitrepo.get_changed_paths(repo_path, commit)
+    if dirty is None:
+        return _find_pkgbuilds_validated(repo_path, content) + (None,)
+    git_state = (commit, sorted(dirty))
+
+    if content is None or content["git"] is None:
+        return _find_pkgbuilds_validated(repo_path, content) + (git_state,)
+    last_commit, last_dirty = content["git"]
+    entries = content["entries"]
+
+    if last_commit == commit:
+        changed = set(dirty)
     else:
-        print("Searching for PKGBUILD files in %s" % repo_path)
-        for base, dirs, files in os.walk(repo_path):
-            for f in files:
-                if f == "PKGBUILD":
-                    # in case we find a PKGBUILD, don't go deeper
-                    del dirs[:]
-                    path = os.path.join(base, f)
-                    pkgbuild_paths.append(path)
-        pkgbuild_paths.sort()
-
-    if not pkgbuild_paths:
-        print("No PKGBUILD files found here")
-        return
+        changed = gitrepo.get_changed_paths(repo_path, last_commit)
+        if changed is None:
+            return _find_pkgbuilds_validated(repo_path, content) + \
+                (git_state,)
+    # things changed in the work tree last time could have been reverted
+    changed.update(last_dirty)
+
+    affected = _get_affected_pkgbuilds(changed, entries)
+    reused = {}
+    for relpath, entry in entries.items():
+        if relpath in affected:
+            continue
+        if entry[2] is None:
+            # failed last time, try again
+            affected.add(relpath)
+        else:
+            reused[_from_relpath(repo_path, relpath)] = entry
+
+    pkgbuild_paths = list(reused)
+    for relpath in affected:
+        path = _from_relpath(repo_path, relpath)
+        if os.path.isfile(path) and \
+                not _has_parent_pkgbuild(repo_path, relpath):
+            pkgbuild_paths.append(path)
+    pkgbuild_paths.sort()
+
+    return pkgbuild_paths, None, reused, git_state
+
+
+def iter_packages(repo_path, paranoid=False, jobs=None, executor="thread",
+                  timeout=DEFAULT_TIMEOUT, incremental=False):
+    """Yields the packages of all PKGBUILD files in repo_path.
+
+    The packages of unchanged PKGBUILD files come from the package snapshot
+    of the last run, if there is one. Cached srcinfo gets used right away,
+    the missing ones get passed to an executor (see EXECUTORS) while the
+    search is still going on. Stopping early kills all running makepkg
+    instances.
+
+    Args:
+        repo_path (str): A directory or a PKGBUILD file
+        paranoid (bool): see get_srcinfo_for_pkgbuild(), also ignores the
+            snapshot
+        jobs (int or None): Number of workers, None for the executor default
+        executor (str): "thread" or "process"
+        timeout (float or None): Seconds after which makepkg gets killed
+        incremental (bool): If repo_path is in a git work tree, find changed
+            PKGBUILD files by asking git instead of looking at all of them.
+            Note that ignored files are not found this way.
+    """
+
+    snapshot = None
+    content = None
+    git_state = None
+    dirs = None
+    reused = {}
+    if os.path.isfile(repo_path) and os.path.basename(repo_path) == "PKGBUILD":
+        pkgbuild_paths = [repo_path]
     else:
-        print("Found %d PKGBUILD files" % len(pkgbuild_paths))
+        snapshot = get_package_snapshot()
+        if not paranoid:
+            content = snapshot.load(repo_path, _SNAPSHOT_SCHEMA)
+        if incremental:
+            print("Searching for changed PKGBUILD files in %s" % repo_path)
+            pkgbuild_paths, dirs, reused, git_state = \
+                _find_pkgbuilds_incremental(repo_path, content)
+        else:
+            print("Searching for PKGBUILD files in %s" % repo_path)
+            pkgbuild_paths, dirs, reused = _find_pkgbuilds_validated(
+                repo_path, content)
+
+    cache = get_cache()
+    cache.begin_run()
+    pool = None
+    generated = None
+    jobs_queue = queue.Queue()
+    finished = False
+    found = []
+    unchanged = 0
+    missing = 0
+    # (fingerprint, digest, rows) for each PKGBUILD, for the snapshot
+    entries = {}
+
+    def get_packages(path, entry, text):
+        if text is None:
+            memo = {}
+            packages = [SrcInfoPackage.from_row(path, row, memo)
+                        for row in entry[2]]
+        else:
+            packages = SrcInfoPackage.for_srcinfo(path, text)
+            entry = entry[:2] + (tuple(p.to_row() for p in packages),)
+        entries[path] = entry
+        return packages
 
-    pool = ThreadPool(cpu_count() * 2)
-    pool_iter = pool.imap_unordered(SrcInfoPackage.for_pkgbuild, pkgbuild_paths)
-    print("Parsing PKGBUILD files...")
-    with progress(len(pkgbuild_paths)) as update:
-        for i, packages in enumerate(pool_iter):
-            update(i + 1)
-            for package in packages:
-                yield package
-    pool.close()
+    # the cache entries behind the reused packages, so they stay cached
+    reused_digests = []
+
+    try:
+        for path in pkgbuild_paths:
+            found.append(path)
+            entry = reused.get(path)
+            if entry is not None:
+                unchanged += 1
+                reused_digests.append(entry[1])
+                for package in get_packages(path, entry, None):
+                    yield package
+                continue
+
+            fingerprint, digest = _get_pkgbuild_digest(path, paranoid)
+            if is_racy(fingerprint[1]):
+                fingerprint = None
+            entry = (fingerprint, digest, None)
+            text = cache.get(digest)
+            if text is not None:
+                for package in get_packages(path, entry, text):
+                    yield package
+                continue
+
+            # start generating right away, while the search continues
+            entries[path] = entry
+            if pool is None:
+                pool = EXECUTORS[executor](jobs)
+                generated = pool.imap_unordered(
+                    _generate_srcinfo_job, iter(jobs_queue.get, None))
+            jobs_queue.put((path, digest, timeout))
+            missing += 1
+        jobs_queue.put(None)
+        cache.touch(reused_digests)
+
+        if not found:
+            print("No PKGBUILD files found here")
+        elif unchanged:
+            print("Found %d PKGBUILD files, %d unchanged since the last "
+                  "run" % (len(found), unchanged))
+        else:
+            print("Found %d PKGBUILD files" % len(found))
+
+        if generated is not None:
+            print("Parsing PKGBUILD files...")
+            with progress(missing) as update:
+                for done, (path, digest, text) in enumerate(generated):
+                    update(done + 1)
+                    if text is None:
+                        continue
+                    cache.set(digest, text)
+                    for package in get_packages(path, entries[path], text):
+                        yield package
+        finished = True
+    finally:
+        # unblocks the pool in case we stopped early
+        jobs_queue.put(None)
+        if pool is not None:
+            pool.shutdown(wait=finished)
+        if hasattr(pkgbuild_paths, "close"):
+            pkgbuild_paths.close()
+        cache.end_run()
+        index = get_fingerprint_index()
+        if os.path.isdir(repo_path):
+            index.prune(repo_path, found)
+        index.save()
+
+    if snapshot is not None:
+        if dirs is None:
+            # not searched, the next non-incremental run has to
+            dirs = {"": None}
+        if git_state is None and content is not None:
+            # still valid, see _find_pkgbuilds_incremental()
+            git_state = content["git"]
+        snapshot.save(repo_path, _SNAPSHOT_SCHEMA, {
+            "dirs": dirs,
+            "git": git_state,
+            "entries": dict((_to_relpath(repo_path, path), entry)
+                            for path, entry in entries.items()),
+        })
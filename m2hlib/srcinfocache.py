@@ -0,0 +1,1025 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Christoph Reiter
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+"""Storage for srcinfo texts, keyed by the digest of the PKGBUILD"""
+
+from __future__ import print_function
+
+import os
+import re
+import gzip
+import json
+import time
+import zlib
+import struct
+import atexit
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import closing
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+JSON_PATH = os.path.join(DIR, "_srcinfocache.json")
+SQLITE_PATH = os.path.join(DIR, "_srcinfocache.db")
+FINGERPRINTS_PATH = os.path.join(DIR, "_fingerprints.json")
+SNAPSHOT_PATH = os.path.join(DIR, "_snapshot.bin")
+
+
+def _get_disk_size(paths):
+    size = 0
+    for path in paths:
+        try:
+            size += os.path.getsize(path)
+        except EnvironmentError:
+            pass
+    return size
+
+
+class SrcInfoCache(object):
+    """Maps PKGBUILD digests to srcinfo texts. Needs to be thread safe."""
+
+    def get(self, digest):
+        """
+        Args:
+            digest (str)
+        Returns:
+            str or None: The srcinfo text or None if not cached
+        """
+
+        raise NotImplementedError
+
+    def set(self, digest, text):
+        """Adds an entry. Might only be written on flush().
+
+        Args:
+            digest (str)
+            text (str)
+        """
+
+        raise NotImplementedError
+
+    def touch(self, digests):
+        """Marks entries as used in the current run, without reading them.
+        For entries which got used through some other means, like the
+        package snapshot, so they don't get evicted.
+
+        Args:
+            digests (iterable): The digests of the entries
+        """
+
+        pass
+
+    def iter_entries(self):
+        """Yields all entries sorted by digest, without loading them all
+        into memory (if the backend supports that)
+
+        Yields:
+            tuple: (digest, text)
+        """
+
+        raise NotImplementedError
+
+    def merge(self, entries):
+        """Adds entries which aren't cached yet, existing ones are kept
+
+        Args:
+            entries (iterable): (digest, text) tuples
+        Returns:
+            int: The number of added entries
+        """
+
+        raise NotImplementedError
+
+    def flush(self):
+        """Writes out all pending changes"""
+
+        pass
+
+    def close(self):
+        self.flush()
+
+    def begin_run(self):
+        """Marks the start of a run over a PKGBUILD repo. Entries not used
+        in a number of runs can get evicted.
+        """
+
+        pass
+
+    def end_run(self):
+        """Writes out all pending changes and evicts old entries"""
+
+        self.flush()
+
+    def compact(self):
+        """Evicts old entries and shrinks the storage
+
+        Returns:
+            int: The number of evicted entries
+        """
+
+        return 0
+
+    def clear(self):
+        """Removes all entries and statistics"""
+
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        Returns:
+            dict: with the keys "path", "entries", "size" (bytes on disk),
+                "runs", "hits" and "misses". Values can be None if not
+                supported.
+        """
+
+        raise NotImplementedError
+
+
+class JSONCache(SrcInfoCache):
+    """Keeps everything in memory and writes one JSON file on flush().
+    Doesn't track usage, so nothing gets evicted.
+    """
+
+    def __init__(self, path=JSON_PATH):
+        self.path = path
+        self._entries = None
+        self._dirty = False
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = OrderedDict()
+        try:
+            with open(self.path, "rb") as h:
+                self._entries.update(json.loads(
+                    h.read().decode("utf-8"), object_pairs_hook=OrderedDict))
+        except EnvironmentError:
+            pass
+
+    def get(self, digest):
+        with self._lock:
+            self._load()
+            text = self._entries.get(digest)
+            if text is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+            return text
+
+    def set(self, digest, text):
+        with self._lock:
+            self._load()
+            self._entries[digest] = text
+            self._dirty = True
+
+    def iter_entries(self):
+        with self._lock:
+            self._load()
+            entries = sorted(self._entries.items())
+        for entry in entries:
+            yield entry
+
+    def merge(self, entries):
+        count = 0
+        with self._lock:
+            self._load()
+            for digest, text in entries:
+                if digest not in self._entries:
+                    self._entries[digest] = text
+                    count += 1
+            self._dirty = self._dirty or bool(count)
+        return count
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            with open(self.path, "wb") as h:
+                cache = OrderedDict(sorted(self._entries.items()))
+                h.write(json.dumps(cache, indent=2).encode("utf-8"))
+            self._dirty = False
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self._dirty = True
+            self._hits = self._misses = 0
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            self._load()
+            return {
+                "path": self.path,
+                "entries": len(self._entries),
+                "size": _get_disk_size([self.path]),
+                "runs": None,
+                "hits": self._hits,
+                "misses": self._misses,
+            }
+
+
+class SQLiteCache(SrcInfoCache):
+    """Stores entries in a SQLite database in WAL mode, so multiple
+    processes can read and write it at the same time.
+
+    New entries and usage information get committed in batches of
+    batch_size and on flush(). When the database gets created the entries
+    of the JSON cache at json_path are imported.
+
+    At the end of each run entries not used in the last max_age_runs runs
+    get evicted, and the least recently used ones if there are more than
+    max_entries. Entries used in the current run are always kept, so a
+    repo with more PKGBUILD files than max_entries doesn't thrash the
+    cache. The default max_entries leaves room for a few full checkouts
+    of MINGW-packages and MSYS2-packages.
+    """
+
+    SCHEMA_VERSION = 2
+
+    def __init__(self, path=SQLITE_PATH, json_path=JSON_PATH,
+                 batch_size=200, max_age_runs=100, max_entries=50000):
+        self.path = path
+        self.json_path = json_path
+        self.batch_size = batch_size
+        self.max_age_runs = max_age_runs
+        self.max_entries = max_entries
+        self._pending = OrderedDict()
+        self._touched = set()
+        self._hits = 0
+        self._misses = 0
+        self._run = None
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is not None:
+            return self._conn
+
+        conn = sqlite3.connect(
+            self.path, timeout=60, isolation_level=None,
+            check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            row = conn.execute(
+                "SELECT value FROM meta WHERE key = 'version'").fetchone()
+            if row is None:
+                conn.execute(
+                    "CREATE TABLE srcinfo (digest TEXT PRIMARY KEY, "
+                    "text TEXT NOT NULL, last_run INTEGER NOT NULL, "
+                    "atime REAL NOT NULL)")
+                conn.execute(
+                    "CREATE INDEX srcinfo_usage ON srcinfo (last_run, atime)")
+                conn.executemany(
+                    "INSERT INTO meta VALUES (?, ?)",
+                    [("version", str(self.SCHEMA_VERSION)), ("runs", "0"),
+                     ("hits", "0"), ("misses", "0")])
+                self._import_json(conn)
+            elif int(row[0]) == 1:
+                conn.execute(
+                    "ALTER TABLE srcinfo "
+                    "ADD COLUMN last_run INTEGER NOT NULL DEFAULT 0")
+                conn.execute(
+                    "ALTER TABLE srcinfo "
+                    "ADD COLUMN atime REAL NOT NULL DEFAULT 0")
+                conn.execute(
+                    "CREATE INDEX srcinfo_usage ON srcinfo (last_run, atime)")
+                conn.executemany(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                    [("version", str(self.SCHEMA_VERSION)), ("runs", "0"),
+                     ("hits", "0"), ("misses", "0")])
+            elif int(row[0]) != self.SCHEMA_VERSION:
+                raise Exception(
+                    "Unsupported cache version %s in %s" % (row[0], self.path))
+            if self._run is None:
+                self._run = self._get_meta(conn, "runs")
+        except Exception:
+            conn.execute("ROLLBACK")
+            conn.close()
+            raise
+        else:
+            conn.execute("COMMIT")
+
+        self._conn = conn
+        return conn
+
+    def _get_meta(self, conn, key):
+        return int(conn.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)).fetchone()[0])
+
+    def _add_meta(self, conn, key, value):
+        conn.execute(
+            "UPDATE meta SET value = CAST(value AS INTEGER) + ? "
+            "WHERE key = ?", (value, key))
+
+    def _import_json(self, conn):
+        if self.json_path is None:
+            return
+        try:
+            with open(self.json_path, "rb") as h:
+                entries = json.loads(h.read().decode("utf-8"))
+        except EnvironmentError:
+            return
+        conn.executemany(
+            "INSERT OR IGNORE INTO srcinfo VALUES (?, ?, 0, 0)",
+            entries.items())
+
+    def _commit_pending(self):
+        if not (self._pending or self._touched or self._hits or
+                self._misses):
+            return
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO srcinfo VALUES (?, ?, ?, ?)",
+                [(d, t, self._run, now) for d, t in self._pending.items()])
+            conn.executemany(
+                "UPDATE srcinfo SET last_run = ?, atime = ? "
+                "WHERE digest = ?",
+                [(self._run, now, d) for d in self._touched])
+            self._add_meta(conn, "hits", self._hits)
+            self._add_meta(conn, "misses", self._misses)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        self._pending.clear()
+        self._touched.clear()
+        self._hits = self._misses = 0
+
+    def _evict(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            runs = self._get_meta(conn, "runs")
+            count = conn.execute(
+                "DELETE FROM srcinfo WHERE last_run < ?",
+                (runs - self.max_age_runs,)).rowcount
+            count += conn.execute(
+                "DELETE FROM srcinfo WHERE last_run < ? AND digest IN "
+                "(SELECT digest FROM srcinfo ORDER BY last_run DESC, "
+                "atime DESC LIMIT -1 OFFSET ?)",
+                (runs, self.max_entries)).rowcount
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        return count
+
+    def get(self, digest):
+        with self._lock:
+            text = self._pending.get(digest)
+            if text is not None:
+                self._hits += 1
+                return text
+            row = self._connect().execute(
+                "SELECT text FROM srcinfo WHERE digest = ?",
+                (digest,)).fetchone()
+            if row is None:
+                self._misses += 1
+                return
+            self._hits += 1
+            self._touched.add(digest)
+            if len(self._touched) >= self.batch_size:
+                self._commit_pending()
+            return row[0]
+
+    def set(self, digest, text):
+        with self._lock:
+            self._pending[digest] = text
+            if len(self._pending) >= self.batch_size:
+                self._commit_pending()
+
+    def touch(self, digests):
+        with self._lock:
+            self._touched.update(digests)
+            if len(self._touched) >= self.batch_size:
+                self._commit_pending()
+
+    def iter_entries(self):
+        with self._lock:
+            self._commit_pending()
+        last = ""
+        while True:
+            # page by key, so nothing stays locked between the pages
+            with self._lock:
+                rows = self._connect().execute(
+                    "SELECT digest, text FROM srcinfo WHERE digest > ? "
+                    "ORDER BY digest LIMIT ?",
+                    (last, self.batch_size)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield tuple(row)
+            last = rows[-1][0]
+
+    def _merge_batch(self, batch):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            count = 0
+            for digest, text in batch:
+                count += conn.execute(
+                    "INSERT OR IGNORE INTO srcinfo VALUES (?, ?, ?, ?)",
+                    (digest, text, self._run, 0)).rowcount
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        return count
+
+    def merge(self, entries):
+        with self._lock:
+            self._commit_pending()
+            self._connect()
+        count = 0
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) >= self.batch_size:
+                with self._lock:
+                    count += self._merge_batch(batch)
+                del batch[:]
+        if batch:
+            with self._lock:
+                count += self._merge_batch(batch)
+        return count
+
+    def flush(self):
+        with self._lock:
+            self._commit_pending()
+
+    def close(self):
+        with self._lock:
+            self._commit_pending()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def begin_run(self):
+        with self._lock:
+            self._commit_pending()
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._add_meta(conn, "runs", 1)
+                self._run = self._get_meta(conn, "runs")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            else:
+                conn.execute("COMMIT")
+
+    def end_run(self):
+        with self._lock:
+            self._commit_pending()
+            self._evict()
+
+    def compact(self):
+        with self._lock:
+            self._commit_pending()
+            count = self._evict()
+            conn = self._connect()
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            return count
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+            self._touched.clear()
+            self._hits = self._misses = 0
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM srcinfo")
+                conn.execute(
+                    "UPDATE meta SET value = '0' "
+                    "WHERE key IN ('runs', 'hits', 'misses')")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            else:
+                conn.execute("COMMIT")
+            self._run = 0
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def stats(self):
+        with self._lock:
+            conn = self._connect()
+            entries = conn.execute(
+                "SELECT COUNT(*) FROM srcinfo").fetchone()[0]
+            return {
+                "path": self.path,
+                "entries": entries + len(self._pending),
+                "size": _get_disk_size(
+                    [self.path, self.path + "-wal", self.path + "-shm"]),
+                "runs": self._get_meta(conn, "runs"),
+                "hits": self._get_meta(conn, "hits") + self._hits,
+                "misses": self._get_meta(conn, "misses") + self._misses,
+            }
+
+
+# Files changed this recently might get changed again without the mtime
+# changing, so don't trust their stat result.
+RACY_SECONDS = 2
+
+
+def is_racy(mtime_ns):
+    """
+    Args:
+        mtime_ns (int)
+    Returns:
+        bool: If a file with this mtime could change without the mtime
+            changing
+    """
+
+    return mtime_ns >= (time.time() - RACY_SECONDS) * 1e9
+
+
+def stat_key(st):
+    """
+    Args:
+        st (os.stat_result)
+    Returns:
+        list: (size, mtime in ns, inode), compare to find changed files
+    """
+
+    mtime_ns = getattr(st, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1e9)
+    return [st.st_size, mtime_ns, st.st_ino]
+
+
+class FingerprintIndex(object):
+    """Remembers the digest of files together with their size, mtime and
+    inode, so unchanged files don't have to be read and hashed again.
+    """
+
+    def __init__(self, path=FINGERPRINTS_PATH):
+        self.path = path
+        self._entries = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        try:
+            with open(self.path, "rb") as h:
+                self._entries.update(json.loads(h.read().decode("utf-8")))
+        except (EnvironmentError, ValueError):
+            pass
+
+    def stat(self, path):
+        """
+        Args:
+            path (str)
+        Returns:
+            object: A fingerprint of the file to pass to lookup()/update()
+        Raises:
+            EnvironmentError
+        """
+
+        return stat_key(os.stat(path))
+
+    def lookup(self, path, fingerprint):
+        """
+        Args:
+            path (str)
+            fingerprint (object): see stat()
+        Returns:
+            str or None: The digest if the file didn't change
+        """
+
+        path = os.path.abspath(path)
+        with self._lock:
+            self._load()
+            entry = self._entries.get(path)
+        if entry is not None and entry[:3] == fingerprint:
+            return entry[3]
+
+    def update(self, path, fingerprint, digest):
+        """Records the digest of a file
+
+        Args:
+            path (str)
+            fingerprint (object): see stat(), from before the file was read
+            digest (str)
+        """
+
+        if is_racy(fingerprint[1]):
+            return
+        path = os.path.abspath(path)
+        with self._lock:
+            self._load()
+            self._entries[path] = fingerprint + [digest]
+            self._dirty = True
+
+    def prune(self, root, paths):
+        """Removes all entries below root which aren't in paths
+
+        Args:
+            root (str)
+            paths (iterable): paths below root that still exist
+        """
+
+        root = os.path.join(os.path.abspath(root), "")
+        keep = set(os.path.abspath(p) for p in paths)
+        with self._lock:
+            self._load()
+            for path in list(self._entries):
+                if path.startswith(root) and path not in keep:
+                    del self._entries[path]
+                    self._dirty = True
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._dirty = True
+
+    def __len__(self):
+        with self._lock:
+            self._load()
+            return len(self._entries)
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            temp_path = self.path + ".%d.tmp" % os.getpid()
+            with open(temp_path, "wb") as h:
+                h.write(json.dumps(self._entries).encode("utf-8"))
+            getattr(os, "replace", os.rename)(temp_path, self.path)
+            self._dirty = False
+
+
+class PackageSnapshot(object):
+    """A binary snapshot of the parsed packages of a repo, so unchanged
+    PKGBUILD files don't have to be parsed again. Only one repo is
+    remembered.
+
+    The content is a dict, the srcinfo module decides what goes in there.
+    It gets thrown away if it was written by a different VERSION or for a
+    different repo or `schema`.
+    """
+
+    MAGIC = b"M2HSNAP"
+    VERSION = 2
+
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = path
+        # what is on disk, as far as we know
+        self._data = None
+
+    def _header(self):
+        return self.MAGIC + struct.pack("<I", self.VERSION)
+
+    def load(self, repo_path, schema):
+        """
+        Args:
+            repo_path (str)
+            schema (object): Describes the content, has to match the one
+                passed to save()
+        Returns:
+            dict or None: None if there is no usable snapshot
+        """
+
+        header = self._header()
+        try:
+            with open(self.path, "rb") as h:
+                raw = h.read()
+        except EnvironmentError:
+            return None
+        if not raw.startswith(header):
+            return None
+        try:
+            data = pickle.loads(raw[len(header):])
+        except Exception:
+            return None
+        self._data = data
+
+        if data.get("repo_path") != os.path.abspath(repo_path) or \
+                data.get("schema") != schema:
+            return None
+        return data["content"]
+
+    def save(self, repo_path, schema, content):
+        """Replaces the snapshot, see load()
+
+        Args:
+            repo_path (str)
+            schema (object)
+            content (dict)
+        """
+
+        data = {
+            "repo_path": os.path.abspath(repo_path),
+            "schema": schema,
+            "content": content,
+        }
+        if data == self._data:
+            return
+        temp_path = self.path + ".%d.tmp" % os.getpid()
+        with open(temp_path, "wb") as h:
+            h.write(self._header())
+            h.write(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+        getattr(os, "replace", os.rename)(temp_path, self.path)
+        self._data = data
+
+    def clear(self):
+        self._data = None
+        try:
+            os.remove(self.path)
+        except EnvironmentError:
+            pass
+
+
+class BundleError(Exception):
+    """Raised if a bundle is broken or in an unknown format"""
+
+
+BUNDLE_FORMAT = "m2h-srcinfo-bundle"
+BUNDLE_VERSION = 1
+
+_DIGEST_RE = re.compile(r"^[0-9a-f]{40}$")
+
+
+def _text_digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def export_bundle(cache, path):
+    """Writes all cache entries to a gzip compressed bundle.
+
+    The bundle consists of JSON lines: a header, one [digest, text, sha256
+    of text] line per entry and a trailer with the entry count and the
+    sha256 of all entry lines.
+
+    Args:
+        cache (SrcInfoCache)
+        path (str)
+    Returns:
+        int: The number of exported entries
+    """
+
+    temp_path = path + ".%d.tmp" % os.getpid()
+    count = 0
+    checksum = hashlib.sha256()
+    try:
+        with closing(gzip.open(temp_path, "wb")) as h:
+            h.write(json.dumps({
+                "format": BUNDLE_FORMAT,
+                "version": BUNDLE_VERSION,
+            }).encode("utf-8") + b"\n")
+            for digest, text in cache.iter_entries():
+                line = json.dumps(
+                    [digest, text, _text_digest(text)]).encode("utf-8")
+                checksum.update(line)
+                h.write(line + b"\n")
+                count += 1
+            h.write(json.dumps({
+                "entries": count,
+                "sha256": checksum.hexdigest(),
+            }).encode("utf-8") + b"\n")
+        getattr(os, "replace", os.rename)(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return count
+
+
+def iter_bundle(path):
+    """Yields the entries of a bundle written by export_bundle(), checking
+    each of them. The whole bundle is only known to be fine once all
+    entries are consumed.
+
+    Args:
+        path (str)
+    Yields:
+        tuple: (digest, text)
+    Raises:
+        BundleError
+        EnvironmentError
+    """
+
+    checksum = hashlib.sha256()
+    count = 0
+    trailer = None
+    with closing(gzip.open(path, "rb")) as h:
+        try:
+            lines = iter(h)
+            try:
+                header = json.loads(next(lines).decode("utf-8"))
+            except StopIteration:
+                raise BundleError("%s is empty" % path)
+            if not isinstance(header, dict) or \
+                    header.get("format") != BUNDLE_FORMAT:
+                raise BundleError("%s is not a srcinfo bundle" % path)
+            if header.get("version") != BUNDLE_VERSION:
+                raise BundleError("%s has the unsupported version %r" % (
+                    path, header.get("version")))
+
+            for line in lines:
+                line = line.rstrip(b"\n")
+                value = json.loads(line.decode("utf-8"))
+                if isinstance(value, dict):
+                    trailer = value
+                    break
+                if not isinstance(value, list) or len(value) != 3:
+                    raise BundleError(
+                        "%s: entry %d is invalid" % (path, count + 1))
+                digest, text, text_digest = value
+                if not _DIGEST_RE.match(digest) or \
+                        _text_digest(text) != text_digest:
+                    raise BundleError(
+                        "%s: entry %d is corrupted" % (path, count + 1))
+                checksum.update(line)
+                count += 1
+                yield digest, text
+
+            if next(lines, None) is not None:
+                raise BundleError("%s: data after the end" % path)
+        except (ValueError, TypeError, AttributeError, IOError, EOFError,
+                zlib.error) as e:
+            # IOError/EOFError/zlib.error from gzip for broken or truncated
+            # files, the rest for invalid lines
+            raise BundleError("%s is corrupted: %s" % (path, e))
+
+    if trailer is None:
+        raise BundleError("%s is truncated" % path)
+    if trailer.get("entries") != count or \
+            trailer.get("sha256") != checksum.hexdigest():
+        raise BundleError("%s: checksum mismatch" % path)
+
+
+def import_bundle(cache, path):
+    """Merges the entries of a bundle into cache, see SrcInfoCache.merge().
+    The bundle gets read once and checked completely before anything is
+    merged, the merged entries are the checked ones.
+
+    Args:
+        cache (SrcInfoCache)
+        path (str)
+    Returns:
+        tuple: (added, total) number of entries
+    Raises:
+        BundleError
+        EnvironmentError
+    """
+
+    entries = list(iter_bundle(path))
+    return cache.merge(entries), len(entries)
+
+
+CACHE_BACKENDS = OrderedDict([
+    ("sqlite", SQLiteCache),
+    ("json", JSONCache),
+])
+
+_cache = None
+_cache_lock = threading.Lock()
+_fingerprint_index = None
+_package_snapshot = None
+
+
+def get_cache():
+    """Returns the cache used by default, SQLite if available.
+
+    Returns:
+        SrcInfoCache
+    """
+
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            if sqlite3 is not None:
+                backend = CACHE_BACKENDS["sqlite"]
+            else:
+                backend = CACHE_BACKENDS["json"]
+            set_cache(backend())
+        return _cache
+
+
+def set_cache(cache):
+    """Replaces the cache returned by get_cache(). Pending changes of the
+    old one get written out.
+
+    Args:
+        cache (SrcInfoCache)
+    """
+
+    global _cache
+
+    if _cache is not None:
+        _cache.close()
+    _cache = cache
+
+
+def _close_cache():
+    # registered once, for whichever cache and index are current at exit
+    if _cache is not None:
+        _cache.close()
+    if _fingerprint_index is not None:
+        _fingerprint_index.save()
+
+
+atexit.register(_close_cache)
+
+
+def get_fingerprint_index():
+    """
+    Returns:
+        FingerprintIndex: The index stored next to the srcinfo cache
+    """
+
+    with _cache_lock:
+        if _fingerprint_index is None:
+            set_fingerprint_index(FingerprintIndex())
+        return _fingerprint_index
+
+
+def set_fingerprint_index(index):
+    """Replaces the index returned by get_fingerprint_index()
+
+    Args:
+        index (FingerprintIndex)
+    """
+
+    global _fingerprint_index
+
+    if _fingerprint_index is not None:
+        _fingerprint_index.save()
+    _fingerprint_index = index
+
+
+def get_package_snapshot():
+    """
+    Returns:
+        PackageSnapshot: The snapshot stored next to the srcinfo cache
+    """
+
+    global _package_snapshot
+
+    with _cache_lock:
+        if _package_snapshot is None:
+            _package_snapshot = PackageSnapshot()
+        return _package_snapshot
+
+
+def set_package_snapshot(snapshot):
+    """Replaces the snapshot returned by get_package_snapshot()
+
+    Args:
+        snapshot (PackageSnapshot)
+    """
+
+    global _package_snapshot
+
+    _package_snapshot = snapshot
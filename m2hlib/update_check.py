@@ -25,9 +25,10 @@ from __future__ import print_function
 import os
 from multiprocessing.pool import ThreadPool
 
-from .utils import package_name_is_vcs, progress, version_is_newer_than
+from .utils import package_name_is_vcs, progress, version_is_newer_than, \
+    compare_versions
 from .pacman import PacmanPackage
-from .srcinfo import iter_packages
+from .srcinfo import add_iter_packages_arguments, iter_packages_for_args
 
 
 def msys2_package_should_skip(package_name):
@@ -188,16 +189,21 @@ def add_parser(subparsers):
              "PKGBUILD files instead of the database if given.")
     parser.add_argument("--all", help="check all packages",
                         action="store_true")
+    add_iter_packages_arguments(parser)
     parser.set_defaults(func=main)
 
 
-def version_is_newer_than_lax(a, b):
+def _lax_version_pair(a, b):
     # workaround for 2.28 not matching 2.28.0, while there is a difference
     if b == a + ".0":
         a += ".0"
     if a == b + ".0":
         b += ".0"
-    return version_is_newer_than(a, b)
+    return a, b
+
+
+def version_is_newer_than_lax(a, b):
+    return version_is_newer_than(*_lax_version_pair(a, b))
 
 
 def main(args):
@@ -213,7 +219,7 @@ def main(args):
         repo_path = os.path.abspath(args.repo_path)
         new_packages = []
         package_names = set([p.pkgname for p in packages])
-        for package in iter_packages(repo_path):
+        for package in iter_packages_for_args(repo_path, args):
             if package.pkgname in package_names:
                 new_packages.append(package)
         packages = new_packages
@@ -231,8 +237,8 @@ def main(args):
     pool.close()
     pool.join()
 
-    print("%-30s %-20s %-20s %s" % ("Name", "Local", "Arch", "Arch Package"))
-    print("%-30s %-20s %-20s %s" % ("-" * 30, "-" * 20 , "-" * 20, "-" * 20))
+    rows = []
+    pairs = []
     for p in sorted(packages, key=lambda p: p.pkgname):
         arch_name = package_get_arch_name(p.pkgname)
         arch_info = arch_versions.get(arch_name)
@@ -240,11 +246,20 @@ def main(args):
         if arch_info is not None:
             arch_version, arch_url = arch_info
             arch_version = extract_upstream_version(arch_version)
-            if not version_is_newer_than_lax(arch_version, pkgver):
-                continue
+            pairs.append(_lax_version_pair(arch_version, pkgver))
         else:
             arch_version = "???"
             arch_url = ""
+            pairs.append(None)
+        rows.append((p.pkgname.split("-", 3)[-1], pkgver, arch_version,
+                     arch_url))
+
+    print("Comparing versions...")
+    results = iter(compare_versions([p for p in pairs if p is not None]))
 
-        print("%-30s %-20s %-20s %s" % (
-            p.pkgname.split("-", 3)[-1], pkgver, arch_version, arch_url))
+    print("%-30s %-20s %-20s %s" % ("Name", "Local", "Arch", "Arch Package"))
+    print("%-30s %-20s %-20s %s" % ("-" * 30, "-" * 20 , "-" * 20, "-" * 20))
+    for row, pair in zip(rows, pairs):
+        if pair is not None and next(results) != 1:
+            continue
+        print("%-30s %-20s %-20s %s" % row)
@@ -28,7 +28,7 @@ from multiprocessing.pool import ThreadPool
 
 import requests
 
-from .srcinfo import iter_packages
+from .srcinfo import add_iter_packages_arguments, iter_packages_for_args
 from .utils import progress
 from .pacman import PacmanPackage
 
@@ -42,6 +42,7 @@ def add_parser(subparsers):
     parser.add_argument('--all', action='store_true',
                         help="Also check packages which are not in the "
                              "package database")
+    add_iter_packages_arguments(parser)
     parser.set_defaults(func=main)
 
 
@@ -73,7 +74,7 @@ def main(args):
     repo_packages = PacmanPackage.get_all_packages()
     repo_package_names = set(p.pkgname for p in repo_packages)
 
-    for package in iter_packages(repo_path):
+    for package in iter_packages_for_args(repo_path, args):
         # only check packages which are in the repo, all others are many
         # times broken in other ways.
         if not args.all and package.pkgname not in repo_package_names:
@@ -22,9 +22,16 @@
 
 from __future__ import print_function
 
+import os
+import re
 import sys
+import signal
+import threading
 import subprocess
+from collections import OrderedDict
 from contextlib import contextmanager
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 
 
 def package_name_is_vcs(package_name):
@@ -48,8 +55,264 @@ def package_name_get_repo(pkgname):
         return "msys"
 
 
+_STRINGS = {}
+
+
+def intern_string(string):
+    """Returns a shared instance of `string`. Package and dependency names
+    are repeated in many packages, this keeps only one copy of each around.
+
+    Unlike intern() this also works for unicode under Python 2.
+
+    Args:
+        string (str)
+    Returns:
+        str
+    """
+
+    return _STRINGS.setdefault(string, string)
+
+
+def intern_strings(strings):
+    """
+    Args:
+        strings (list(str))
+    Returns:
+        tuple(str): The interned strings
+    """
+
+    setdefault = _STRINGS.setdefault
+    return tuple([setdefault(s, s) for s in strings])
+
+
+# The epoch separator used by MSYS2, where ":" isn't allowed in file names
+EPOCH_SEPARATOR = "~"
+
+_SEGMENT_RE = re.compile(r"([^0-9A-Za-z]*)([0-9]+|[A-Za-z]+)")
+
+# What rpmvercmp() finds at the position where it stops comparing segments
+_END, _SEP, _ALPHA, _DIGIT = range(4)
+
+
+def _separator_length(sep):
+    # vercmp counts bytes, not characters
+    try:
+        sep.encode("ascii")
+    except UnicodeError:
+        return len(sep.encode("utf-8"))
+    return len(sep)
+
+
+def _parse_version_part(part):
+    """Splits a version part into alpha/numeric segments the same way
+    rpmvercmp() walks them.
+
+    Args:
+        part (str)
+    Returns:
+        tuple: (segments, trailing) where segments is a tuple of
+            (separator_length, is_numeric, value) and trailing the length
+            of the separators after the last segment
+    """
+
+    segments = []
+    end = 0
+    for match in _SEGMENT_RE.finditer(part):
+        sep, seg = match.groups()
+        if seg.isdigit():
+            # leading zeros don't count, and longer numbers always win
+            segments.append((_separator_length(sep), True, int(seg)))
+        else:
+            segments.append((_separator_length(sep), False, seg))
+        end = match.end()
+    return tuple(segments), _separator_length(part[end:])
+
+
+def _parse_evr(version):
+    """Splits a version into epoch, version and release like parseEVR() in
+    libalpm.
+
+    Args:
+        version (str)
+    Returns:
+        tuple: (epoch, version, release), all parsed with
+            _parse_version_part(). release is None if missing.
+    """
+
+    i = 0
+    while i < len(version) and version[i] in "0123456789":
+        i += 1
+
+    epoch = "0"
+    if version[i:i + 1] == EPOCH_SEPARATOR:
+        epoch = version[:i] or "0"
+        version = version[i + 1:]
+
+    release = None
+    if "-" in version:
+        version, release = version.rsplit("-", 1)
+        release = _parse_version_part(release)
+
+    return (_parse_version_part(epoch), _parse_version_part(version),
+            release)
+
+
+def _next_char_class(segments, trailing, index, skip_separators):
+    if index < len(segments):
+        sep_len, is_numeric, value = segments[index]
+        if sep_len and not skip_separators:
+            return _SEP
+        return _DIGIT if is_numeric else _ALPHA
+    elif trailing and not skip_separators:
+        return _SEP
+    return _END
+
+
+def _rpmvercmp(a, b):
+    """Compares two results of _parse_version_part() like rpmvercmp() in
+    libalpm.
+
+    Returns:
+        int: same as cmp()
+    """
+
+    segments_a, trailing_a = a
+    segments_b, trailing_b = b
+
+    n = min(len(segments_a), len(segments_b))
+    for i in range(n):
+        sep_a, numeric_a, value_a = segments_a[i]
+        sep_b, numeric_b, value_b = segments_b[i]
+        if sep_a != sep_b:
+            return -1 if sep_a < sep_b else 1
+        if numeric_a != numeric_b:
+            # numeric segments are always newer than alpha ones
+            return 1 if numeric_a else -1
+        if value_a != value_b:
+            return -1 if value_a < value_b else 1
+
+    # One side ran out of segments. vercmp only skips the separators in
+    # front of the next segment if there is text left on both sides.
+    skip = ((n < len(segments_a) or trailing_a) and
+            (n < len(segments_b) or trailing_b))
+    char_a = _next_char_class(segments_a, trailing_a, n, skip)
+    char_b = _next_char_class(segments_b, trailing_b, n, skip)
+
+    if char_a == _END and char_b == _END:
+        return 0
+    # a remaining alpha string never beats an empty one
+    if (char_a == _END and char_b != _ALPHA) or char_a == _ALPHA:
+        return -1
+    return 1
+
+
+def _evr_cmp(a, b):
+    """Compares two results of _parse_evr()
+
+    Returns:
+        int: same as cmp()
+    """
+
+    epoch_a, version_a, release_a = a
+    epoch_b, version_b, release_b = b
+
+    result = _rpmvercmp(epoch_a, epoch_b)
+    if result == 0:
+        result = _rpmvercmp(version_a, version_b)
+        # the release is only compared if both have one
+        if result == 0 and release_a is not None and release_b is not None:
+            result = _rpmvercmp(release_a, release_b)
+    return result
+
+
+class VersionKey(object):
+    """A version parsed once, which compares the same way vercmp does.
+
+    Can be passed as key to sorted(), max() or used with bisect.
+
+    Args:
+        version (str)
+    """
+
+    __slots__ = ("version", "_evr")
+
+    def __init__(self, version):
+        self.version = version
+        self._evr = _parse_evr(version)
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.version)
+
+    def __hash__(self):
+        # versions only compare equal if their epoch and version segments
+        # are equal, the release and trailing separators may differ
+        epoch, version, release = self._evr
+        return hash((epoch[0], version[0]))
+
+    def _cmp(self, other):
+        if self.version == other.version:
+            return 0
+        return _evr_cmp(self._evr, other._evr)
+
+    def __eq__(self, other):
+        if not isinstance(other, VersionKey):
+            return NotImplemented
+        return self._cmp(other) == 0
+
+    def __ne__(self, other):
+        if not isinstance(other, VersionKey):
+            return NotImplemented
+        return self._cmp(other) != 0
+
+    def __lt__(self, other):
+        return self._cmp(other) < 0
+
+    def __le__(self, other):
+        return self._cmp(other) <= 0
+
+    def __gt__(self, other):
+        return self._cmp(other) > 0
+
+    def __ge__(self, other):
+        return self._cmp(other) >= 0
+
+
+_VERSION_CMP_CACHE = {}
+_VERSION_CMP_CACHE_SIZE = 100000
+
+
 def version_cmp(v1, v2):
+    """Compares two versions the same way pacman's vercmp does, but without
+    spawning a process. Results are memoized.
+
+    Args:
+        v1 (str): 1st version
+        v2 (str): 2nd version
+    Returns:
+        int: same as cmp()
     """
+
+    # fast path
+    if v1 == v2:
+        return 0
+
+    key = (v1, v2)
+    try:
+        return _VERSION_CMP_CACHE[key]
+    except KeyError:
+        pass
+
+    result = _evr_cmp(_parse_evr(v1), _parse_evr(v2))
+    if len(_VERSION_CMP_CACHE) >= _VERSION_CMP_CACHE_SIZE:
+        _VERSION_CMP_CACHE.clear()
+    _VERSION_CMP_CACHE[key] = result
+    return result
+
+
+def version_cmp_pacman(v1, v2):
+    """Like version_cmp() but asks pacman's vercmp. Slow, as it spawns a
+    process for every call.
+
     Args:
         v1 (str): 1st version
         v2 (str): 2nd version
@@ -65,6 +328,53 @@ def version_cmp(v1, v2):
         subprocess.check_output(["vercmp", v1, v2]).decode("ascii"))
 
 
+def _compare_version_pairs(pairs):
+    keys = {}
+
+    def get_key(version):
+        key = keys.get(version)
+        if key is None:
+            key = keys[version] = VersionKey(version)
+        return key
+
+    return [get_key(a)._cmp(get_key(b)) for a, b in pairs]
+
+
+def compare_versions(pairs, processes=None, chunk_size=5000):
+    """Compares many version pairs at once. Each distinct pair is compared
+    and each distinct version is parsed only once.
+
+    Args:
+        pairs (iterable): (v1, v2) tuples
+        processes (int or None): If given, inputs with more than chunk_size
+            distinct pairs get compared in chunks using a process pool of
+            that size.
+        chunk_size (int)
+    Returns:
+        list(int): same as cmp() for each pair, in order
+    """
+
+    pairs = list(pairs)
+    unique = list(OrderedDict.fromkeys(pairs))
+
+    if processes is not None and processes > 1 and len(unique) > chunk_size:
+        chunks = [unique[i:i + chunk_size]
+                  for i in range(0, len(unique), chunk_size)]
+        pool = Pool(processes)
+        try:
+            results = []
+            for chunk_results in pool.map(_compare_version_pairs, chunks):
+                results.extend(chunk_results)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = _compare_version_pairs(unique)
+
+    lookup = dict(zip(unique, results))
+    return [lookup[pair] for pair in pairs]
+
+
 def version_is_newer_than(v1, v2):
     """
     Args:
@@ -103,3 +413,213 @@ def progress(total):
     update(0)
     yield update
     update(0, True)
+
+
+class CommandTimeoutError(Exception):
+    """Raised by check_output_timeout() if the command took too long"""
+
+    def __init__(self, cmd, timeout):
+        super(CommandTimeoutError, self).__init__(cmd, timeout)
+        self.cmd = cmd
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Command '%s' timed out after %s seconds" % (
+            " ".join(self.cmd), self.timeout)
+
+
+# process group IDs of the commands started by popen_process_group()
+_process_groups = set()
+_process_groups_lock = threading.Lock()
+
+
+def _kill_process_group(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def kill_process_groups():
+    """Kills all commands started by popen_process_group() which are still
+    running in this process, including everything they started.
+    """
+
+    with _process_groups_lock:
+        pgids = list(_process_groups)
+    for pgid in pgids:
+        _kill_process_group(pgid)
+
+
+def popen_process_group(args, **kwargs):
+    """Like subprocess.Popen(), but the command runs in its own session and
+    process group, so everything it starts can be killed with
+    kill_process_group(). Pass the process to release_process_group() once
+    it is done.
+
+    Returns:
+        subprocess.Popen
+    Raises:
+        EnvironmentError
+    """
+
+    if sys.version_info[0] >= 3:
+        kwargs["start_new_session"] = True
+    else:
+        kwargs["preexec_fn"] = os.setsid
+
+    proc = subprocess.Popen(args, **kwargs)
+    with _process_groups_lock:
+        _process_groups.add(proc.pid)
+    return proc
+
+
+def kill_process_group(proc):
+    """Kills a command started by popen_process_group() and everything it
+    started. Has to be called before the process gets waited for.
+    """
+
+    _kill_process_group(proc.pid)
+
+
+def release_process_group(proc):
+    """Stops tracking a process started by popen_process_group()"""
+
+    with _process_groups_lock:
+        _process_groups.discard(proc.pid)
+
+
+def check_output_timeout(args, timeout=None, **kwargs):
+    """Like subprocess.check_output(), but the command runs in its own
+    process group. If it doesn't finish within `timeout` seconds the whole
+    group gets killed, so that nothing it started is left behind.
+
+    Args:
+        args (list(str))
+        timeout (float or None): No timeout if None
+    Returns:
+        bytes: stdout
+    Raises:
+        subprocess.CalledProcessError
+        CommandTimeoutError
+    """
+
+    proc = popen_process_group(args, stdout=subprocess.PIPE, **kwargs)
+
+    timed_out = []
+    timer = None
+    if timeout is not None:
+        def on_timeout():
+            timed_out.append(True)
+            _kill_process_group(proc.pid)
+        timer = threading.Timer(timeout, on_timeout)
+        timer.daemon = True
+        timer.start()
+
+    try:
+        output = proc.communicate()[0]
+    finally:
+        if timer is not None:
+            timer.cancel()
+        release_process_group(proc)
+
+    if timed_out:
+        raise CommandTimeoutError(args, timeout)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(
+            proc.returncode, args, output=output)
+    return output
+
+
+class Executor(object):
+    """Runs a function over many items in a pool of workers.
+
+    Args:
+        jobs (int or None): The number of workers, defaults to
+            default_jobs()
+    """
+
+    def __init__(self, jobs=None):
+        if jobs is None:
+            jobs = self.default_jobs()
+        self.jobs = jobs
+        self._pool = self._create_pool(jobs)
+
+    @classmethod
+    def default_jobs(cls):
+        raise NotImplementedError
+
+    def _create_pool(self, jobs):
+        raise NotImplementedError
+
+    def imap_unordered(self, func, iterable):
+        """Like Pool.imap_unordered()"""
+
+        return self._pool.imap_unordered(func, iterable)
+
+    def shutdown(self, wait=True):
+        """Stops the workers.
+
+        Args:
+            wait (bool): If True waits for all pending work to finish,
+                otherwise kills all running commands and the workers.
+        """
+
+        if wait:
+            self._pool.close()
+        else:
+            self._terminate()
+        self._pool.join()
+
+    def _terminate(self):
+        raise NotImplementedError
+
+
+class ThreadExecutor(Executor):
+    """Uses threads, for work which mostly waits for other processes"""
+
+    @classmethod
+    def default_jobs(cls):
+        return cpu_count() * 2
+
+    def _create_pool(self, jobs):
+        return ThreadPool(jobs)
+
+    def _terminate(self):
+        # threads can't be killed, but what they wait for can
+        kill_process_groups()
+        self._pool.terminate()
+
+
+def _on_worker_sigterm(*args):
+    kill_process_groups()
+    os._exit(1)
+
+
+def _init_process_worker():
+    # ctrl+c is handled by the main process, which then terminates us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _on_worker_sigterm)
+
+
+class ProcessExecutor(Executor):
+    """Uses processes, for work done in Python. The function and items have
+    to be picklable.
+    """
+
+    @classmethod
+    def default_jobs(cls):
+        return cpu_count()
+
+    def _create_pool(self, jobs):
+        return Pool(jobs, initializer=_init_process_worker)
+
+    def _terminate(self):
+        # the workers kill their commands on SIGTERM
+        self._pool.terminate()
+
+
+EXECUTORS = OrderedDict([
+    ("thread", ThreadExecutor),
+    ("process", ProcessExecutor),
+])
@@ -0,0 +1,11 @@
+#!/bin/bash
+# Regenerates the .SRCINFO files next to the PKGBUILD fixtures with
+# makepkg-mingw, run from an MSYS2 shell.
+
+set -e
+
+cd "$(dirname "$0")"
+for dir in */; do
+    (cd "$dir" && bash /usr/bin/makepkg-mingw --printsrcinfo -p PKGBUILD \
+        > .SRCINFO)
+done
@@ -20,7 +20,77 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
 
-from m2hlib import utils, pacman, srcinfo
+import io
+import os
+import sys
+import gzip
+import json
+import time
+import pickle
+import random
+import shutil
+import argparse
+import threading
+import subprocess
+
+import pytest
+
+from m2hlib import utils, pacman, srcinfo, pkgbuild, srcinfocache, depgraph
+from m2hlib import cache as m2h_cache
+from m2hlib import build as m2h_build
+from m2hlib import buildjournal, buildstats
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+
+def _has_makepkg_mingw():
+    return os.path.exists("/usr/bin/makepkg-mingw")
+
+
+def _has_vercmp():
+    try:
+        subprocess.check_output(["vercmp", "1", "2"])
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+# from pacman's vercmptest.sh, with "~" as epoch separator
+VERCMP_CASES = [
+    ("1.5.0", "1.5.0", 0), ("1.5.1", "1.5.0", 1), ("1.5.1", "1.5", 1),
+    ("1.5.0-1", "1.5.0-1", 0), ("1.5.0-1", "1.5.0-2", -1),
+    ("1.5.0-1", "1.5.1-1", -1), ("1.5.0-2", "1.5.1-1", -1),
+    ("1.5-1", "1.5.1-1", -1), ("1.5-2", "1.5.1-1", -1),
+    ("1.5-2", "1.5.1-2", -1), ("1.5", "1.5-1", 0), ("1.5-1", "1.5", 0),
+    ("1.1-1", "1.1", 0), ("1.0-1", "1.1", -1), ("1.1-1", "1.0", 1),
+    ("1.5b-1", "1.5-1", -1), ("1.5b", "1.5", -1), ("1.5b-1", "1.5", -1),
+    ("1.5b", "1.5.1", -1), ("1.0a", "1.0alpha", -1),
+    ("1.0alpha", "1.0b", -1), ("1.0b", "1.0beta", -1),
+    ("1.0beta", "1.0rc", -1), ("1.0rc", "1.0", -1), ("1.5.a", "1.5", 1),
+    ("1.5.b", "1.5.a", 1), ("1.5.1", "1.5.b", 1), ("1.5.b-1", "1.5.b", 0),
+    ("1.5-1", "1.5.b", -1), ("2.0", "2_0", 0), ("2.0_a", "2_0.a", 0),
+    ("2.0a", "2.0.a", -1), ("2___a", "2_a", 1), ("0~1.0", "0~1.0", 0),
+    ("0~1.0", "0~1.1", -1), ("1~1.0", "0~1.0", 1), ("1~1.0", "0~1.1", 1),
+    ("1~1.0", "2~1.1", -1), ("1~1.0", "0~1.0-1", 1),
+    ("1~1.0-1", "0~1.1-1", 1), ("0~1.0", "1.0", 0), ("0~1.0", "1.1", -1),
+    ("0~1.1", "1.0", 1), ("1~1.0", "1.0", 1), ("1~1.0", "1.1", 1),
+    ("1~1.1", "1.1", 1), ("1.0.", "1.0", 1), ("1.0-", "1.0-1", -1),
+    ("007", "7", 0), ("10", "9", 1), ("", "1", -1), ("a", "", -1),
+]
+
+
+def _get_version_corpus():
+    versions = set()
+    for a, b, r in VERCMP_CASES:
+        versions.update([a, b])
+    with open(srcinfocache.JSON_PATH, "rb") as h:
+        cache = json.loads(h.read().decode("utf-8"))
+    for text in cache.values():
+        for package in srcinfo.SrcInfoPackage.for_srcinfo("", text):
+            versions.add(package.build_version)
+            versions.add(package.pkgver)
+    return sorted(versions)
 
 
 def test_utils():
@@ -37,6 +107,55 @@ def test_utils():
     assert not utils.version_is_newer_than("1.0-1", "1.0-1")
 
 
+def test_version_cmp():
+    for a, b, result in VERCMP_CASES:
+        assert utils.version_cmp(a, b) == result, (a, b)
+        assert utils.version_cmp(b, a) == -result, (b, a)
+
+
+def test_version_key():
+    import bisect
+
+    for a, b, result in VERCMP_CASES:
+        ka, kb = utils.VersionKey(a), utils.VersionKey(b)
+        assert (ka > kb) == (result == 1), (a, b)
+        assert (ka < kb) == (result == -1), (a, b)
+        assert (ka == kb) == (result == 0), (a, b)
+        if result == 0:
+            assert hash(ka) == hash(kb)
+
+    versions = ["1.10-1", "1~0.1-1", "1.9-1", "1.9-2", "1.9rc1-1"]
+    expected = ["1.9rc1-1", "1.9-1", "1.9-2", "1.10-1", "1~0.1-1"]
+    assert sorted(versions, key=utils.VersionKey) == expected
+    assert max(versions, key=utils.VersionKey) == "1~0.1-1"
+    keys = [utils.VersionKey(v) for v in expected]
+    assert bisect.bisect(keys, utils.VersionKey("1.9.1-1")) == 3
+
+    pkg = pacman.PacmanPackage("mingw64", "mingw-w64-x86_64-perl", "1~2-1")
+    assert pkg.version_key is pkg.version_key
+    assert pkg.version_key > utils.VersionKey("5.22.0-1")
+
+
+def test_compare_versions():
+    pairs = [(a, b) for a, b, r in VERCMP_CASES] * 3
+    expected = [r for a, b, r in VERCMP_CASES] * 3
+    assert utils.compare_versions(pairs) == expected
+    assert utils.compare_versions(pairs, processes=2, chunk_size=10) == \
+        expected
+    assert utils.compare_versions([]) == []
+
+
+@pytest.mark.skipif(not _has_vercmp(), reason="vercmp not installed")
+def test_version_cmp_pacman():
+    versions = _get_version_corpus()
+    rand = random.Random(42)
+    pairs = list(zip(versions, versions[1:]))
+    pairs += [tuple(rand.sample(versions, 2)) for i in range(2000)]
+    for a, b in pairs:
+        assert utils.version_cmp(a, b) == utils.version_cmp_pacman(a, b), \
+            (a, b)
+
+
 def test_pacman():
     pacman.PacmanPackage.get_all_packages(False)
     pacman.PacmanPackage.get_all_packages(True)
@@ -129,3 +248,1451 @@ pkgname = mingw-w64-i686-gtk3
     assert "mingw-w64-i686-glib2" in packages[0].depends
     assert "mingw-w64-i686-pkg-config" in packages[0].makedepends
     assert packages[0].build_version == "3.22.16-1"
+    assert packages[0].arch == ("any",)
+    assert packages[0].pkgdesc.startswith("GObject-based")
+
+
+def test_srcinfo_overrides():
+    path = os.path.join(DATA_DIR, "pkgbuilds", "expat", ".SRCINFO")
+    with open(path, "rb") as h:
+        text = h.read().decode("utf-8")
+    # only the first pkgbase section
+    text = text[:text.index("pkgbase = ", 1)]
+    packages = dict((p.pkgname, p) for p in
+                    srcinfo.SrcInfoPackage.for_srcinfo("foo", text))
+    assert sorted(packages) == ["expat", "libexpat", "libexpat-devel"]
+
+    expat = packages["expat"]
+    lib = packages["libexpat"]
+    devel = packages["libexpat-devel"]
+    assert expat.depends == ()
+    assert lib.depends == ("gcc-libs",)
+    assert devel.depends == ("libexpat=2.2.0",)
+    assert devel.pkgdesc == "Libexpat headers and libraries"
+    assert lib.pkgdesc == expat.pkgdesc == "An XML parser library"
+    assert lib.groups == ("libraries",)
+    assert expat.arch == ("i686", "x86_64")
+    assert len(expat.sources) == 3
+    # not overridden, so shared
+    assert expat.sources is lib.sources is devel.sources
+    assert expat.arch is devel.arch
+
+    packages = srcinfo.SrcInfoPackage.for_srcinfo("foo", """\
+pkgbase = foo
+\tpkgver = 1
+\tpkgrel = 1
+\tepoch = 2
+\tcheckdepends = check
+\tprovides = bar=1
+\tconflicts = bar
+\treplaces = baz
+\toptdepends = opt: for things
+
+pkgname = foo
+""")
+    package, = packages
+    assert package.build_version == "2~1-1"
+    assert package.checkdepends == ("check",)
+    assert package.provides == ("bar=1",)
+    assert package.conflicts == ("bar",)
+    assert package.replaces == ("baz",)
+    assert package.optdepends == ("opt: for things",)
+
+    # an empty value clears the pkgbase value for that package
+    packages = dict((p.pkgname, p) for p in
+                    srcinfo.SrcInfoPackage.for_srcinfo("foo", """\
+pkgbase = foo
+\tpkgver = 1
+\tpkgrel = 1
+\tpkgdesc = foo
+\tdepends = bar
+\tdepends = baz
+
+pkgname = foo-a
+\tdepends =\x20
+\tpkgdesc =\x20
+
+pkgname = foo-b
+"""))
+    assert packages["foo-a"].depends == ()
+    assert packages["foo-a"].pkgdesc is None
+    assert packages["foo-b"].depends == ("bar", "baz")
+    assert packages["foo-b"].pkgdesc == "foo"
+
+
+def test_compact_packages():
+    text = """\
+pkgbase = foo
+\tpkgver = 1
+\tpkgrel = 1
+\tdepends = mingw-w64-x86_64-gcc-libs
+
+pkgname = foo
+"""
+    # build the strings at runtime, so they start out as different objects
+    name = "".join(["mingw-w64-x86_64-", "gcc-libs"])
+    a, = srcinfo.SrcInfoPackage.for_srcinfo("a", text)
+    b, = srcinfo.SrcInfoPackage.for_srcinfo("b", text[:])
+    c = pacman.PacmanPackage("mingw64", name, "1-1")
+
+    assert isinstance(a.depends, tuple)
+    assert a.depends[0] is b.depends[0] is c.pkgname
+    assert utils.intern_string(name) is c.pkgname
+    assert utils.intern_strings([name]) == (name,)
+
+    # packages restored from a snapshot share the strings as well
+    rows = pickle.loads(pickle.dumps([a.to_row(), a.to_row()]))
+    memo = {}
+    d, e = [srcinfo.SrcInfoPackage.from_row("a", row, memo) for row in rows]
+    assert d.depends[0] is c.pkgname
+    assert d.pkgbase is a.pkgbase
+    assert d.depends is e.depends
+    assert d.to_row() == a.to_row()
+
+    for package in [a, c]:
+        assert not hasattr(package, "__dict__")
+        with pytest.raises(AttributeError):
+            package.foo = 42
+
+
+def _make_package(name, version="1.0", depends=(), makedepends=(),
+                  provides=()):
+    package = srcinfo.SrcInfoPackage(
+        os.path.join(name, "PKGBUILD"), name, name, version, "1")
+    package.depends = tuple(depends)
+    package.makedepends = tuple(makedepends)
+    package.provides = tuple(provides)
+    return package
+
+
+def test_parse_dependency():
+    parse = depgraph.parse_dependency
+    assert parse("foo") == ("foo", None, None)
+    assert parse("foo>=1.0") == ("foo", ">=", "1.0")
+    assert parse("foo<2") == ("foo", "<", "2")
+    assert parse("foo = 1.0-2") == ("foo", "=", "1.0-2")
+    assert parse("foo>1:2.0") == ("foo", ">", "1~2.0")
+
+    satisfies = depgraph.version_satisfies
+    assert satisfies(None, None, None)
+    assert not satisfies(None, ">=", "1.0")
+    assert satisfies("1.2-1", ">=", "1.0")
+    assert satisfies("1~0.1-1", ">", "2.0")
+    assert not satisfies("1.0-1", "<", "1.0")
+    assert satisfies("1.0", "<=", "1.0")
+
+
+def test_dependency_graph():
+    glib = _make_package("glib2", "2.54.0")
+    old_glib = _make_package("glib2-compat", "2.40.0", provides=["glib2=2.40"])
+    gtk = _make_package("gtk3", depends=["glib2>=2.50", "missing"])
+    old = _make_package("old", depends=["glib2<2.50"])
+    cc = _make_package("gcc", provides=["cc"])
+    clang = _make_package("clang", provides=["cc=5.0"])
+    app = _make_package("app", depends=["gtk3"], makedepends=["cc"])
+    versioned = _make_package("tool", makedepends=["cc>=4"])
+
+    pool = srcinfo.SrcInfoPool()
+    for p in [glib, old_glib, gtk, old, cc, clang, app, versioned]:
+        pool.add_package(p)
+    graph = pool.get_graph()
+
+    assert graph.resolve("glib2>=2.50") == [glib]
+    assert graph.resolve("glib2<2.50") == [old_glib]
+    assert set(graph.resolve("cc")) == set([cc, clang])
+    assert graph.resolve("cc>=4") == [clang]
+    assert graph.resolve("nope") == []
+    assert graph.get_unresolved(gtk) == ["missing"]
+
+    assert graph.get_dependencies(app) == set([gtk, cc, clang])
+    assert graph.get_dependencies(app, transitive=True) == \
+        set([gtk, cc, clang, glib])
+    assert graph.get_reverse_dependencies(glib, transitive=True) == \
+        set([gtk, app])
+    assert graph.get_reverse_dependencies(old_glib) == set([old])
+
+    assert pool.get_transitive_dependencies(app) == \
+        set(["gtk3", "gcc", "clang", "glib2", "missing"])
+
+    assert pool.depends_on(app, glib)
+    assert not pool.depends_on(glib, app)
+    assert not pool.depends_on(app, app)
+
+    # adding a package updates the graph, a package with the same name
+    # replaces the providers
+    new_cc = _make_package("cc")
+    pool.add_package(new_cc)
+    assert pool.get_graph() is graph
+    assert graph.resolve("cc") == [new_cc]
+    assert graph.get_dependencies(app) == set([gtk, new_cc])
+    assert not pool.depends_on(app, cc)
+    assert pool.depends_on(app, new_cc)
+
+    missing = _make_package("missing", depends=["app"])
+    pool.add_package(missing)
+    assert graph.get_unresolved(gtk) == []
+    assert pool.depends_on(missing, glib)
+    assert pool.depends_on(app, missing)
+    assert graph.get_reverse_dependencies(app, transitive=True) == \
+        set([gtk, missing])
+
+
+def test_dependency_graph_large():
+    rand = random.Random(42)
+    count = 10000
+    names = ["pkg%d" % i for i in range(count)]
+    packages = []
+    for i, name in enumerate(names):
+        deps = rand.sample(names[:i], min(i, rand.randint(0, 4)))
+        deps = [d + ">=1.0" if rand.random() < 0.3 else d for d in deps]
+        if i and rand.random() < 0.01:
+            # a cycle
+            deps.append(names[rand.randint(i, count - 1)])
+        packages.append(_make_package(name, depends=deps))
+    graph = depgraph.DependencyGraph(packages)
+
+    by_name = dict((p.pkgname, p) for p in packages)
+
+    def naive(package):
+        done = set()
+        todo = [package]
+        while todo:
+            for dep in todo.pop().depends:
+                dep = by_name[depgraph.parse_dependency(dep)[0]]
+                if dep not in done:
+                    done.add(dep)
+                    todo.append(dep)
+        done.discard(package)
+        return done
+
+    rdeps = dict((p, set()) for p in packages)
+    for p in packages:
+        assert graph.get_unresolved(p) == []
+        for dep in graph.get_dependencies(p):
+            rdeps[dep].add(p)
+
+    for p in rand.sample(packages, 200):
+        deps = graph.get_dependencies(p, transitive=True)
+        assert deps == naive(p)
+        for other in rand.sample(packages, 20):
+            assert graph.depends_on(p, other) == (other in deps)
+        assert graph.get_reverse_dependencies(p) == rdeps[p]
+        for dep in rand.sample(sorted(deps, key=graph.get_id),
+                               min(len(deps), 2)):
+            assert p in graph.get_reverse_dependencies(dep, transitive=True)
+
+
+def test_dependency_graph_incremental():
+    rand = random.Random(1)
+    count = 500
+    names = ["pkg%d" % i for i in range(count)]
+    packages = []
+    for name in names:
+        deps = rand.sample(names, rand.randint(0, 3))
+        provides = ["virt%d" % rand.randint(0, 50)]
+        deps.append("virt%d" % rand.randint(0, 50))
+        packages.append(_make_package(name, depends=deps, provides=provides))
+    rand.shuffle(packages)
+
+    graph = depgraph.DependencyGraph(packages[:100])
+    graph.get_dependency_bits(0)
+    for p in packages[100:]:
+        graph.add_package(p)
+        if rand.random() < 0.1:
+            graph.depends_on(p, p)
+    graph.add_package(packages[0])
+    assert len(graph) == count
+
+    fresh = depgraph.DependencyGraph(packages)
+    for p in packages:
+        assert graph.get_dependencies(p, transitive=True) == \
+            fresh.get_dependencies(p, transitive=True)
+        assert graph.get_reverse_dependencies(p, transitive=True) == \
+            fresh.get_reverse_dependencies(p, transitive=True)
+        assert graph.get_reverse_dependencies(p) == \
+            fresh.get_reverse_dependencies(p)
+
+    assert list(depgraph.iter_bits(0)) == []
+    assert list(depgraph.iter_bits(0b100101 | 1 << 200)) == [0, 2, 5, 200]
+
+
+def test_topological_order():
+    scc = depgraph.strongly_connected_components
+    order = depgraph.topological_order
+
+    assert order([]) == []
+    assert order([(), (), ()]) == [[0], [1], [2]]
+    assert order([(1,), (2,), ()]) == [[2], [1], [0]]
+    # 3 depends on the cycle 0 -> 1 -> 2 -> 0, 4 on nothing
+    edges = [(1,), (2,), (0,), (0,), ()]
+    assert sorted(sorted(c) for c in scc(edges)) == [[0, 1, 2], [3], [4]]
+    assert order(edges) == [[0, 1, 2], [3], [4]]
+    assert order([(0,), ()]) == [[0], [1]]
+
+    closures = depgraph.get_transitive_closures(edges)
+    assert [sorted(depgraph.iter_bits(c)) for c in closures] == [
+        [0, 1, 2], [0, 1, 2], [0, 1, 2], [0, 1, 2], []]
+
+    rand = random.Random(0)
+    count = 5000
+    edges = [rand.sample(range(count), rand.randint(0, 3))
+             for i in range(count)]
+    result = order(edges)
+    assert sorted(v for c in result for v in c) == list(range(count))
+    position = {}
+    for p, component in enumerate(result):
+        for v in component:
+            position[v] = p
+    for v, targets in enumerate(edges):
+        for w in targets:
+            assert position[w] <= position[v]
+    assert order(edges) == result
+
+
+def test_build_order():
+    glib = _make_package("glib2")
+    gtk = _make_package("gtk3", depends=["glib2>=1.0"])
+    app = _make_package("app", depends=["gtk3"], makedepends=["cc"])
+    gcc = _make_package("gcc", provides=["cc"])
+    a = _make_package("a", depends=["b"])
+    b = _make_package("b", depends=["a"])
+
+    pool, pkgbuilds, cycles = m2h_build.get_pkgbuilds_to_build_in_order(
+        [glib, gtk, app, gcc, a, b])
+    order = [path for path, packages in pkgbuilds]
+    assert len(order) == 6
+    assert order.index(glib.pkgbuild_path) < order.index(gtk.pkgbuild_path)
+    assert order.index(gtk.pkgbuild_path) < order.index(app.pkgbuild_path)
+    assert order.index(gcc.pkgbuild_path) < order.index(app.pkgbuild_path)
+    assert cycles == [[a.pkgbuild_path, b.pkgbuild_path]]
+    assert dict(pkgbuilds)[gtk.pkgbuild_path] == set([gtk])
+
+
+def test_run_builds(capsys):
+    base = _make_package("base")
+    left = _make_package("left", depends=["base"])
+    right = _make_package("right", depends=["base"])
+    top = _make_package("top", depends=["left", "right"])
+    other = _make_package("other")
+    broken = _make_package("broken")
+    after = _make_package("after", depends=["broken"])
+    after_after = _make_package("after-after", depends=["after", "other"])
+    a = _make_package("a", depends=["b"])
+    b = _make_package("b", depends=["a"])
+
+    pool, pkgbuilds, cycles = m2h_build.get_pkgbuilds_to_build_in_order(
+        [base, left, right, top, other, broken, after, after_after, a, b])
+    paths = [path for path, packages in pkgbuilds]
+    deps = m2h_build.get_build_dependencies(pool, pkgbuilds)
+    index = paths.index
+    assert deps[index(top.pkgbuild_path)] == \
+        set([index(left.pkgbuild_path), index(right.pkgbuild_path)])
+    # the cycle gets built in order
+    assert deps[index(b.pkgbuild_path)] == set([index(a.pkgbuild_path)])
+    assert deps[index(a.pkgbuild_path)] == set()
+
+    lock = threading.Lock()
+    running = set()
+    started = []
+    stats = {"max": 0}
+
+    def build_func(path, packages):
+        with lock:
+            for i in deps[index(path)]:
+                assert paths[i] in started
+            running.add(path)
+            stats["max"] = max(stats["max"], len(running))
+        time.sleep(0.02)
+        with lock:
+            running.remove(path)
+            started.append(path)
+        if path == broken.pkgbuild_path:
+            raise m2h_build.BuildError
+
+    states, blocked_by = m2h_build.run_builds(
+        pkgbuilds, deps, build_func, jobs=4)
+    result = dict(zip(paths, states))
+    assert blocked_by == {
+        index(after.pkgbuild_path): set([index(broken.pkgbuild_path)]),
+        index(after_after.pkgbuild_path): set([index(broken.pkgbuild_path)]),
+    }
+    assert result[broken.pkgbuild_path] == m2h_build.FAILED
+    assert result[after.pkgbuild_path] == m2h_build.SKIPPED
+    assert result[after_after.pkgbuild_path] == m2h_build.SKIPPED
+    assert result[top.pkgbuild_path] == m2h_build.DONE
+    assert states.count(m2h_build.DONE) == 7
+    assert 1 < stats["max"] <= 4
+    assert after.pkgbuild_path not in started
+    out = capsys.readouterr()[0]
+    assert "SKIPPING %s because %s failed" % (
+        after_after.pkgbuild_path, broken.pkgbuild_path) in out
+
+    del started[:]
+    stats["max"] = 0
+    states = m2h_build.run_builds(pkgbuilds, deps, build_func, jobs=1)[0]
+    assert stats["max"] == 1
+    assert started == [p for p, s in zip(paths, states)
+                       if s != m2h_build.SKIPPED]
+
+
+def test_run_builds_blocked(capsys):
+    # two failing roots, "x" is downstream of both
+    pkgbuilds = [(name, set()) for name in ["r1", "r2", "ok", "a", "x", "y"]]
+    deps = [set(), set(), set(), set([0]), set([3, 1]), set([4, 2])]
+    assert m2h_build.get_reverse_dependencies(deps) == \
+        [[3], [4], [5], [4], [5], []]
+
+    def build_func(path, packages):
+        if path.startswith("r"):
+            raise m2h_build.BuildError
+
+    states, blocked_by = m2h_build.run_builds(pkgbuilds, deps, build_func)
+    assert states == [m2h_build.FAILED, m2h_build.FAILED, m2h_build.DONE] + \
+        [m2h_build.SKIPPED] * 3
+    assert blocked_by == {3: set([0]), 4: set([0, 1]), 5: set([0, 1])}
+    out = capsys.readouterr()[0]
+    assert "STARTING x" not in out
+    assert out.count("SKIPPING y") == 1
+
+
+def test_build_journal(tmpdir):
+    target = str(tmpdir)
+    artifact = tmpdir.join("foo-1.0-1-any.pkg.tar.xz")
+    artifact.write("data")
+    pkgbuild_path = tmpdir.join("PKGBUILD")
+    pkgbuild_path.write("pkgname=foo")
+    package = _make_package("foo")
+    key = buildjournal.get_pkgbuild_key(str(pkgbuild_path), [package])
+
+    journal = buildjournal.BuildJournal(target)
+    journal.plan([("a", key), ("b", "other")])
+    journal.start("a", key)
+    journal.done("a", key, [str(artifact)])
+    journal.start("b", "other")
+    journal.close()
+    # a line cut off by a crash
+    with open(journal.path, "ab") as h:
+        h.write(b'{"event": "done", "path": "b", "ke')
+
+    journal = buildjournal.BuildJournal(target)
+    completed = journal.get_completed()
+    assert list(completed) == [("a", key)]
+    assert journal.verify(completed[("a", key)])
+    journal.fail("a", key)
+    journal.close()
+    assert journal.get_completed() == {}
+    assert [e["event"] for e in journal.read()] == \
+        ["plan", "start", "done", "start", "fail"]
+
+    artifact.write("changed")
+    assert not journal.verify(completed[("a", key)])
+    artifact.remove()
+    assert not journal.verify(completed[("a", key)])
+
+    pkgbuild_path.write("pkgname=foo2")
+    assert buildjournal.get_pkgbuild_key(
+        str(pkgbuild_path), [package]) != key
+
+    # completed entries count as built
+    built = []
+    states = m2h_build.run_builds(
+        [("x", set()), ("y", set())], [set(), set([0])],
+        lambda path, packages: built.append(path), completed=[0])[0]
+    assert built == ["y"]
+    assert states == [m2h_build.DONE, m2h_build.DONE]
+
+
+def test_run_logged(tmpdir, capsys):
+    log_path = str(tmpdir.join("log"))
+    script = ("import sys; sys.stdout.write(''.join("
+              "str(i) + '\\n' for i in range(1000))); sys.exit(%d)")
+    with open(log_path, "wb") as log:
+        m2h_build.run_logged(
+            [sys.executable, "-c", script % 0], log, echo="[foo]")
+    with open(log_path, "rb") as h:
+        lines = h.read().decode("utf-8").splitlines()
+    assert lines[0].startswith("==> ")
+    assert lines[1:] == [str(i) for i in range(1000)]
+    # rate limited, so only the first line
+    assert capsys.readouterr()[0] == "[foo] 0\n"
+
+    with open(log_path, "wb") as log:
+        with pytest.raises(m2h_build.BuildError) as e:
+            m2h_build.run_logged([sys.executable, "-c", script % 3], log)
+    message = str(e.value).splitlines()
+    assert "exit status 3" in message[0]
+    assert message[1:] == \
+        [str(i) for i in range(1000 - m2h_build.TAIL_LINES, 1000)]
+
+    with open(log_path, "wb") as log:
+        with pytest.raises(m2h_build.BuildError):
+            m2h_build.run_logged([str(tmpdir.join("nope"))], log)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    try:
+        with open("/proc/%d/stat" % pid, "rb") as h:
+            # a zombie nobody reaped yet
+            return h.read().split(b") ")[-1][:1] != b"Z"
+    except EnvironmentError:
+        return True
+
+
+@pytest.mark.skipif(not hasattr(os, "killpg"), reason="no process groups")
+def test_run_logged_interrupt(tmpdir):
+    script = (
+        "import sys, subprocess; p = subprocess.Popen([sys.executable, "
+        "'-c', 'import time; time.sleep(60)']); print(p.pid); "
+        "sys.stdout.flush(); p.wait()")
+
+    class Log(object):
+
+        def __init__(self):
+            self.pid = None
+
+        def write(self, data):
+            if not data.startswith(b"==>"):
+                self.pid = int(data)
+                raise KeyboardInterrupt
+
+        def flush(self):
+            pass
+
+    log = Log()
+    with pytest.raises(KeyboardInterrupt):
+        m2h_build.run_logged([sys.executable, "-c", script], log)
+    # what the command started got killed as well
+    for i in range(50):
+        if not _is_running(log.pid):
+            break
+        time.sleep(0.1)
+    assert not _is_running(log.pid)
+
+
+def test_build_stats(tmpdir):
+    path = str(tmpdir.join("stats.json"))
+    stats = buildstats.BuildStats(path)
+    assert stats.get_duration("foo") is None
+    for duration in [10, 1, 30, 20, 2, 3]:
+        stats.record("foo", duration, max_rss=100, size=42)
+    stats.save()
+
+    stats = buildstats.BuildStats(path)
+    samples = stats.get_samples("foo")
+    assert len(samples) == buildstats.MAX_SAMPLES
+    assert samples[-1]["max_rss"] == 100
+    assert stats.get_duration("foo") == 3
+
+    assert buildstats.format_duration(3723.4) == "1:02:03"
+
+    packages = [("a", set([_make_package("foo")])),
+                ("b", set([_make_package("bar")]))]
+    assert m2h_build.get_expected_durations(stats, packages) == [3, 3]
+    assert m2h_build.get_expected_durations(
+        buildstats.BuildStats(str(tmpdir.join("nope"))), packages) is None
+
+
+def test_critical_path(capsys):
+    # 0 -> 1 -> 2 is long, 3 -> 4 is short but 3 comes first
+    deps = [set(), set([0]), set([1]), set(), set([3])]
+    durations = [10.0, 10.0, 10.0, 1.0, 1.0]
+    assert m2h_build.get_priorities(deps, durations) == \
+        [30.0, 20.0, 10.0, 2.0, 1.0]
+    assert m2h_build.get_critical_path(deps, durations) == [0, 1, 2]
+    assert m2h_build.simulate_builds(deps, durations, jobs=1) == 32.0
+    assert m2h_build.simulate_builds(deps, durations, jobs=2) == 30.0
+    assert m2h_build.simulate_builds([], [], jobs=2) == 0.0
+
+    # in reverse, so the index order would build the short chain first
+    pkgbuilds = [(str(i), set()) for i in range(5)][::-1]
+    reversed_deps = [set(4 - j for j in d) for d in deps[::-1]]
+    order = []
+    m2h_build.run_builds(
+        pkgbuilds, reversed_deps, lambda path, packages: order.append(path),
+        durations=durations[::-1])
+    assert order == ["0", "1", "2", "3", "4"]
+    assert "ETA 0:00:02" in capsys.readouterr()[0]
+
+
+def test_run_logged_usage(tmpdir):
+    usage = {}
+    with open(str(tmpdir.join("log")), "wb") as log:
+        m2h_build.run_logged(
+            [sys.executable, "-c", "x = b' ' * (50 * 1024 * 1024)"], log,
+            usage=usage)
+    if hasattr(os, "wait4") and sys.platform.startswith("linux"):
+        assert usage["max_rss"] > 50 * 1024
+
+
+def test_source_lane(tmpdir, capsys):
+    calls = []
+
+    class Builder(m2h_build.SimulatedBuilder):
+
+        def build_source(self, pkgbuild, packages, targetdir, nice=0):
+            calls.append((pkgbuild, nice))
+            return m2h_build.SimulatedBuilder.build_source(
+                self, pkgbuild, packages, targetdir, nice)
+
+    target_path = str(tmpdir)
+    lane = m2h_build.SourceLane(
+        Builder(source_failures=["bad"]), target_path, jobs=2)
+    for path in ["a", "bad", "b"]:
+        lane.submit(path, set([_make_package(path)]))
+    lane.close()
+
+    assert sorted(calls) == [
+        ("a", lane.NICE), ("b", lane.NICE), ("bad", lane.NICE)]
+    assert lane.done == {
+        "a": set([os.path.join(target_path, "a-1.0-1.src.tar.zst")]),
+        "b": set([os.path.join(target_path, "b-1.0-1.src.tar.zst")])}
+    assert lane.failed == {"bad": "bad: simulated failure"}
+    assert "SOURCE FAILED bad" in capsys.readouterr()[0]
+
+
+def test_build_pkgbuilds_simulated(tmpdir):
+    rand = random.Random(3)
+    packages = []
+    names = ["pkg%d" % i for i in range(60)]
+    for i, name in enumerate(names):
+        deps = rand.sample(names[:i], min(i, 3))
+        packages.append(_make_package(name, depends=deps))
+    pool, pkgbuilds, cycles = m2h_build.get_pkgbuilds_to_build_in_order(
+        packages)
+    dependencies = m2h_build.get_build_dependencies(pool, pkgbuilds)
+
+    builder = m2h_build.SimulatedBuilder(
+        default_duration=0.001, failures=["pkg10"],
+        source_failures=["pkg20"], sizes={"pkg1": 1024}, max_rss=42)
+    target_path = str(tmpdir.join("target"))
+    stats = buildstats.BuildStats(str(tmpdir.join("stats.json")))
+    states, blocked_by, source_failed = m2h_build.build_pkgbuilds(
+        pkgbuilds, dependencies, builder, target_path, jobs=4,
+        stats=stats)
+
+    index = dict((p.pkgname, i) for i, (path, ps) in enumerate(pkgbuilds)
+                 for p in ps)
+    failed = index["pkg10"]
+    assert states[failed] == m2h_build.FAILED
+    assert set(blocked_by) == set(
+        i for i in range(len(pkgbuilds))
+        if pool.depends_on(list(pkgbuilds[i][1])[0], packages[10]))
+    for i, state in enumerate(states):
+        assert (state == m2h_build.SKIPPED) == (i in blocked_by)
+    assert list(source_failed) == [pkgbuilds[index["pkg20"]][0]]
+
+    # every build started after its dependencies ended
+    times = dict((pkgbase, (start, end))
+                 for pkgbase, start, end in builder.builds)
+    for i, deps in enumerate(dependencies):
+        name = list(pkgbuilds[i][1])[0].pkgname
+        if name in times:
+            for j in deps:
+                dep = list(pkgbuilds[j][1])[0].pkgname
+                assert times[dep][1] <= times[name][0]
+
+    assert os.path.getsize(
+        os.path.join(target_path, "pkg1-1.0-1-any.pkg.tar.zst")) == 1024
+    assert stats.get_samples("pkg1")[0]["size"] == 1024
+    assert stats.get_samples("pkg1")[0]["max_rss"] == 42
+    assert stats.get_samples("pkg10") == []
+
+
+def test_build_pkgbuilds_resume_sources(tmpdir):
+    packages = [_make_package("a"), _make_package("b", depends=["a"]),
+                _make_package("c")]
+    pool, pkgbuilds, cycles = m2h_build.get_pkgbuilds_to_build_in_order(
+        packages)
+    dependencies = m2h_build.get_build_dependencies(pool, pkgbuilds)
+    keys = ["key-%s" % path for path, ps in pkgbuilds]
+    index = dict((list(ps)[0].pkgname, i)
+                 for i, (path, ps) in enumerate(pkgbuilds))
+    target_path = str(tmpdir.join("target").ensure(dir=True))
+
+    journal = buildjournal.BuildJournal(target_path)
+    builder = m2h_build.SimulatedBuilder(source_failures=["b"])
+    states, blocked_by, source_failed = m2h_build.build_pkgbuilds(
+        pkgbuilds, dependencies, builder, target_path, journal=journal,
+        keys=keys)
+    assert states == [m2h_build.DONE] * 3
+    assert list(source_failed) == [pkgbuilds[index["b"]][0]]
+    assert sorted(journal.get_completed()) == sorted(zip(
+        [path for path, ps in pkgbuilds], keys))
+
+    # the binary packages are there, but the source package of b isn't
+    completed, sources_todo = m2h_build.get_resumable(
+        journal, pkgbuilds, keys)
+    assert completed == set(range(3))
+    assert sources_todo == [index["b"]]
+    completed, sources_todo = m2h_build.get_resumable(
+        journal, pkgbuilds, keys, separate_sources=False)
+    assert completed == set([index["a"], index["c"]])
+    assert sources_todo == []
+
+    # only the source package gets built
+    builder = m2h_build.SimulatedBuilder()
+    completed, sources_todo = m2h_build.get_resumable(
+        journal, pkgbuilds, keys)
+    states, blocked_by, source_failed = m2h_build.build_pkgbuilds(
+        pkgbuilds, dependencies, builder, target_path, journal=journal,
+        keys=keys, completed=completed, sources_todo=sources_todo)
+    assert builder.builds == []
+    assert source_failed == {}
+    assert os.path.exists(
+        os.path.join(target_path, "b-1.0-1.src.tar.zst"))
+    assert m2h_build.get_resumable(journal, pkgbuilds, keys) == \
+        (set(range(3)), [])
+
+    # an interrupted run, before the source package got built
+    journal.start(pkgbuilds[index["c"]][0], keys[index["c"]])
+    journal.done(pkgbuilds[index["c"]][0], keys[index["c"]], [
+        os.path.join(target_path, "c-1.0-1-any.pkg.tar.zst")])
+    assert m2h_build.get_resumable(journal, pkgbuilds, keys) == \
+        (set(range(3)), [index["c"]])
+    journal.close()
+
+
+def test_target_directory(tmpdir, monkeypatch):
+    target_path = str(tmpdir.join("target"))
+    target = m2h_build.TargetDirectory(target_path)
+    assert len(target) == 0
+    with target.staging() as staging:
+        assert os.path.dirname(staging) == target_path
+        with open(os.path.join(staging, "foo.pkg.tar.xz"), "wb"):
+            pass
+        assert target.commit(staging) == \
+            set([os.path.join(target_path, "foo.pkg.tar.xz")])
+    assert os.listdir(target_path) == ["foo.pkg.tar.xz"]
+    assert "foo.pkg.tar.xz" in target
+    target.remove(os.path.join(target_path, "foo.pkg.tar.xz"))
+    assert "foo.pkg.tar.xz" not in target
+    assert os.listdir(target_path) == []
+
+    assert m2h_build.get_target_directory(target_path) is \
+        m2h_build.get_target_directory(target_path + os.sep)
+
+    # only what the build produced gets returned, not older files with
+    # the same name prefix
+    tmpdir.join("target", "glib2-1.0-1-any.pkg.tar.xz").write("old")
+    tmpdir.join("pkgbuild").ensure(dir=True)
+    pkgbuild_path = str(tmpdir.join("pkgbuild", "PKGBUILD"))
+
+    calls = []
+
+    def run_logged(args, log, cwd=None, echo=None, usage=None, nice=0):
+        calls.append(args)
+        for arg in args:
+            if arg.startswith("PKGDEST="):
+                dest = arg.split("=", 1)[1]
+                assert os.path.dirname(dest) == target_path
+                with open(os.path.join(dest, "glib2-1.1-1-any.pkg.tar.xz"),
+                          "wb"):
+                    pass
+
+    monkeypatch.setattr(m2h_build, "run_logged", run_logged)
+    package = _make_package("glib2", "1.1")
+    results = m2h_build.build_and_install_binary(
+        pkgbuild_path, set([package]), target_path)
+    assert results == set(
+        [os.path.join(target_path, "glib2-1.1-1-any.pkg.tar.xz")])
+    assert sorted(os.listdir(target_path)) == [
+        "glib2-1.0-1-any.pkg.tar.xz", "glib2-1.1-1-any.pkg.tar.xz",
+        "glib2-1.1-1.pkg.log"]
+
+    # with an install lock the steps get split up, none of them should
+    # install the checkdepends
+    target.remove(os.path.join(target_path, "glib2-1.1-1-any.pkg.tar.xz"))
+    del calls[:]
+    m2h_build.build_and_install_binary(
+        pkgbuild_path, set([package]), target_path,
+        install_lock=threading.Lock())
+    makepkg_calls = [args for args in calls if args[0] == "bash"]
+    assert len(makepkg_calls) == 2
+    assert all("--nocheck" in args for args in makepkg_calls)
+    assert calls[-1][:2] == ["pacman", "-U"]
+
+
+def test_build_arguments():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+    m2h_build.add_parser(subparsers)
+    args = parser.parse_args(["build", "-j", "8", "--parse-jobs", "2", ".",
+                              "target"])
+    assert args.jobs == 8
+    assert args.source_jobs == 1
+    assert not args.resume
+    assert args.parse_jobs == 2
+
+    parser = argparse.ArgumentParser()
+    srcinfo.add_iter_packages_arguments(parser)
+    assert parser.parse_args(["--jobs", "3"]).parse_jobs == 3
+
+
+def test_srcinfocache(tmpdir):
+    json_path = str(tmpdir.join("cache.json"))
+    db_path = str(tmpdir.join("cache.db"))
+
+    cache = srcinfocache.JSONCache(json_path)
+    assert cache.get("a") is None
+    cache.set("a", "text-a")
+    cache.flush()
+    assert srcinfocache.JSONCache(json_path).get("a") == "text-a"
+
+    # imports the JSON cache on creation
+    cache = srcinfocache.SQLiteCache(db_path, json_path, batch_size=2)
+    assert cache.get("a") == "text-a"
+    other = srcinfocache.SQLiteCache(db_path, json_path)
+    cache.set("b", "text-b")
+    assert cache.get("b") == "text-b"
+    assert other.get("b") is None
+    cache.set("c", "text-c")
+    assert other.get("b") == "text-b"
+    other.set("d", "text-d")
+    other.close()
+    cache.flush()
+    assert cache.get("d") == "text-d"
+    cache.close()
+
+    cache = srcinfocache.SQLiteCache(db_path, None)
+    assert [cache.get(k) for k in "abcd"] == [
+        "text-a", "text-b", "text-c", "text-d"]
+    cache.close()
+
+
+def test_set_cache(tmpdir, monkeypatch):
+    closed = []
+
+    class Cache(srcinfocache.JSONCache):
+
+        def close(self):
+            closed.append(self)
+            srcinfocache.JSONCache.close(self)
+
+    # replacing the cache doesn't pile up exit handlers, the one handler
+    # closes the current cache only
+    registered = []
+    monkeypatch.setattr(srcinfocache.atexit, "register", registered.append)
+    monkeypatch.setattr(srcinfocache, "_cache", None)
+    first = Cache(str(tmpdir.join("a.json")))
+    second = Cache(str(tmpdir.join("b.json")))
+    monkeypatch.setattr(srcinfocache, "_fingerprint_index", None)
+    srcinfocache.set_cache(first)
+    srcinfocache.set_cache(second)
+    srcinfocache.set_fingerprint_index(
+        srcinfocache.FingerprintIndex(str(tmpdir.join("index.json"))))
+    assert registered == []
+    assert closed == [first]
+    srcinfocache._close_cache()
+    assert closed == [first, second]
+
+
+def test_srcinfocache_eviction(tmpdir):
+    db_path = str(tmpdir.join("cache.db"))
+    cache = srcinfocache.SQLiteCache(
+        db_path, None, max_age_runs=2, max_entries=3)
+
+    cache.begin_run()
+    cache.set("a", "text-a")
+    cache.set("b", "text-b")
+    cache.end_run()
+    for i in range(2):
+        cache.begin_run()
+        assert cache.get("a") == "text-a"
+        assert cache.get("x") is None
+        cache.end_run()
+    cache.begin_run()
+    cache.end_run()
+    # b wasn't used in the last two runs
+    assert cache.get("b") is None
+    assert cache.get("a") == "text-a"
+
+    for key in "cdef":
+        cache.set(key, key)
+    cache.flush()
+    assert cache.stats()["entries"] == 5
+    # all used in the current run, none of them count as least recently
+    # used
+    assert cache.compact() == 0
+    cache.begin_run()
+    assert cache.compact() == 2
+    stats = cache.stats()
+    assert stats["entries"] == 3
+    assert stats["runs"] == 5
+    assert stats["hits"] == 3
+    assert stats["misses"] == 3
+    assert stats["size"] > 0
+
+    # more entries used in one run than max_entries, they all stay
+    for key in "ghijk":
+        cache.set(key, key)
+    cache.end_run()
+    assert cache.stats()["entries"] == 5
+    assert cache.get("g") == "g"
+
+    srcinfocache.set_cache(cache)
+    srcinfocache.set_fingerprint_index(
+        srcinfocache.FingerprintIndex(str(tmpdir.join("index.json"))))
+    srcinfocache.set_package_snapshot(
+        srcinfocache.PackageSnapshot(str(tmpdir.join("snapshot.bin"))))
+    m2h_cache.main_stats(None)
+    m2h_cache.main_clear(None)
+    stats = cache.stats()
+    assert stats["entries"] == stats["runs"] == stats["hits"] == 0
+    assert m2h_cache.format_size(1536) == "1.5 KiB"
+
+
+def test_srcinfocache_bundle(tmpdir, monkeypatch):
+    digests = ["%040x" % i for i in range(500)]
+    source = srcinfocache.SQLiteCache(
+        str(tmpdir.join("a.db")), None, batch_size=64)
+    for digest in digests:
+        source.set(digest, u"pkgbase = \xe4 %s\n" % digest)
+    source.set(digests[0], "first")
+    bundle_path = str(tmpdir.join("bundle.gz"))
+    assert srcinfocache.export_bundle(source, bundle_path) == 500
+    assert list(srcinfocache.iter_bundle(bundle_path)) == \
+        list(source.iter_entries())
+
+    targets = [
+        srcinfocache.SQLiteCache(str(tmpdir.join("b.db")), None,
+                                 batch_size=64),
+        srcinfocache.JSONCache(str(tmpdir.join("b.json"))),
+    ]
+    for target in targets:
+        target.set(digests[0], "local")
+        assert srcinfocache.import_bundle(target, bundle_path) == (499, 500)
+        assert srcinfocache.import_bundle(target, bundle_path) == (0, 500)
+        # existing entries win
+        assert target.get(digests[0]) == "local"
+        assert target.get(digests[1]) == source.get(digests[1])
+        assert target.stats()["entries"] == 500
+
+    # the bundle gets read only once, so what gets merged is what got
+    # checked
+    opened = []
+    real_open = gzip.open
+
+    def gzip_open(path, *args):
+        opened.append(path)
+        return real_open(path, *args)
+
+    monkeypatch.setattr(srcinfocache.gzip, "open", gzip_open)
+    target = srcinfocache.JSONCache(str(tmpdir.join("d.json")))
+    assert srcinfocache.import_bundle(target, bundle_path) == (500, 500)
+    assert opened == [bundle_path]
+    monkeypatch.undo()
+
+    with open(bundle_path, "rb") as h:
+        data = h.read()
+
+    def check_broken(data):
+        with open(bundle_path, "wb") as h:
+            h.write(data)
+        target = srcinfocache.JSONCache(str(tmpdir.join("c.json")))
+        with pytest.raises(srcinfocache.BundleError):
+            srcinfocache.import_bundle(target, bundle_path)
+        # nothing gets merged
+        assert target.stats()["entries"] == 0
+
+    def compress(data):
+        fileobj = io.BytesIO()
+        with gzip.GzipFile(fileobj=fileobj, mode="wb") as h:
+            h.write(data)
+        return fileobj.getvalue()
+
+    with gzip.GzipFile(bundle_path, "rb") as h:
+        lines = h.readlines()
+
+    check_broken(data[:len(data) // 2])
+    check_broken(data[:-20] + b"x" * 20)
+    check_broken(b"")
+    check_broken(compress(b'{"format": "foo"}\n'))
+    check_broken(compress(b"".join(lines[:-1])))
+    check_broken(compress(
+        b"".join(lines).replace(b"\\u00e4", b"\\u00e5", 1)))
+
+    srcinfocache.set_cache(targets[0])
+    with open(bundle_path, "wb") as h:
+        h.write(data)
+    m2h_cache.main_export(argparse.Namespace(path=bundle_path))
+    assert m2h_cache.main_import(
+        argparse.Namespace(paths=[bundle_path])) is None
+    assert m2h_cache.main_import(argparse.Namespace(
+        paths=[bundle_path, str(tmpdir.join("nope"))])) == 1
+
+
+def test_fingerprint_index(tmpdir):
+    index_path = str(tmpdir.join("index.json"))
+    pkgbuild_path = str(tmpdir.join("PKGBUILD"))
+    shutil.copy(
+        os.path.join(DATA_DIR, "pkgbuilds", "mingw-w64-fltk", "PKGBUILD"),
+        pkgbuild_path)
+
+    index = srcinfocache.FingerprintIndex(index_path)
+    fingerprint = index.stat(pkgbuild_path)
+    # just modified, so can't be trusted
+    index.update(pkgbuild_path, fingerprint, "digest")
+    assert index.lookup(pkgbuild_path, fingerprint) is None
+
+    os.utime(pkgbuild_path, (0, 0))
+    fingerprint = index.stat(pkgbuild_path)
+    index.update(pkgbuild_path, fingerprint, "digest")
+    assert index.lookup(pkgbuild_path, fingerprint) == "digest"
+    index.save()
+
+    index = srcinfocache.FingerprintIndex(index_path)
+    assert index.lookup(pkgbuild_path, fingerprint) == "digest"
+    with open(pkgbuild_path, "ab") as h:
+        h.write(b"\n")
+    os.utime(pkgbuild_path, (0, 0))
+    assert index.lookup(pkgbuild_path, index.stat(pkgbuild_path)) is None
+
+    index.prune(str(tmpdir), [pkgbuild_path])
+    assert index.lookup(pkgbuild_path, fingerprint) == "digest"
+    index.prune(str(tmpdir), [])
+    assert index.lookup(pkgbuild_path, fingerprint) is None
+
+    # uses the index to find the cache entry
+    srcinfocache.set_cache(srcinfocache.JSONCache(str(tmpdir.join("c"))))
+    srcinfocache.set_fingerprint_index(index)
+    text = srcinfo.get_srcinfo_for_pkgbuild(pkgbuild_path)
+    assert "pkgname = mingw-w64-i686-fltk" in text
+    fingerprint = index.stat(pkgbuild_path)
+    digest = index.lookup(pkgbuild_path, fingerprint)
+    assert srcinfocache.get_cache().get(digest) == text
+    srcinfocache.get_cache().set(digest, "changed")
+    assert srcinfo.get_srcinfo_for_pkgbuild(pkgbuild_path) == "changed"
+    index.update(pkgbuild_path, fingerprint, "other")
+    assert srcinfo.get_srcinfo_for_pkgbuild(pkgbuild_path) == text
+    assert srcinfo.get_srcinfo_for_pkgbuild(pkgbuild_path, True) == \
+        "changed"
+
+
+def test_check_output_timeout():
+    assert utils.check_output_timeout(["echo", "foo"], timeout=10) == b"foo\n"
+
+    with pytest.raises(subprocess.CalledProcessError):
+        utils.check_output_timeout(["false"])
+
+    # the background process keeps stdout open, so this only returns
+    # if the whole process group gets killed
+    with pytest.raises(utils.CommandTimeoutError):
+        utils.check_output_timeout(
+            ["sh", "-c", "sleep 30 & sleep 30"], timeout=0.2)
+
+
+@pytest.mark.parametrize("executor", list(utils.EXECUTORS))
+def test_iter_packages(tmpdir, executor):
+    srcinfocache.set_cache(srcinfocache.JSONCache(str(tmpdir.join("c"))))
+    srcinfocache.set_fingerprint_index(
+        srcinfocache.FingerprintIndex(str(tmpdir.join("index.json"))))
+    srcinfocache.set_package_snapshot(
+        srcinfocache.PackageSnapshot(str(tmpdir.join("snapshot.bin"))))
+    repo_path = os.path.join(DATA_DIR, "pkgbuilds")
+
+    def get_names(**kwargs):
+        return set(p.pkgname for p in srcinfo.iter_packages(
+            repo_path, executor=executor, **kwargs))
+
+    names = get_names(jobs=2)
+    assert "mingw-w64-x86_64-gtk3" in names
+    # the second time everything supported comes from the cache
+    assert get_names(jobs=1) == names
+
+    # stopping early shuts down the pool
+    srcinfocache.get_cache().clear()
+    packages = srcinfo.iter_packages(repo_path, executor=executor)
+    next(packages)
+    packages.close()
+
+
+def test_find_pkgbuilds(tmpdir):
+    def touch(*parts):
+        path = tmpdir.join(*parts)
+        path.ensure()
+        return str(path)
+
+    expected = [
+        touch("a", "PKGBUILD"),
+        touch("b", "c", "PKGBUILD"),
+        touch("b", "d", "PKGBUILD"),
+        touch("b", "pkg", "x", "PKGBUILD"),
+        touch("b", "src", "PKGBUILD"),
+        touch("b-e", "PKGBUILD"),
+    ]
+    # not searched
+    touch("a", "nested", "PKGBUILD")
+    touch("a", "src", "x", "PKGBUILD")
+    touch(".git", "x", "PKGBUILD")
+    touch("b", "some.patch")
+
+    dirs = {}
+    assert list(srcinfo._find_pkgbuilds(str(tmpdir), dirs)) == expected
+    assert sorted(dirs) == ["", "b", "b/pkg"]
+
+    # stopping early
+    paths = srcinfo._find_pkgbuilds(str(tmpdir), {})
+    assert next(paths) == expected[0]
+    paths.close()
+
+
+def test_iter_packages_snapshot(tmpdir, capsys):
+    srcinfocache.set_cache(srcinfocache.JSONCache(str(tmpdir.join("c"))))
+    srcinfocache.set_fingerprint_index(
+        srcinfocache.FingerprintIndex(str(tmpdir.join("index.json"))))
+    snapshot_path = str(tmpdir.join("snapshot.bin"))
+    srcinfocache.set_package_snapshot(
+        srcinfocache.PackageSnapshot(snapshot_path))
+
+    repo_path = str(tmpdir.join("repo"))
+    for name in ["dtc", "mingw-w64-fltk"]:
+        shutil.copytree(os.path.join(DATA_DIR, "pkgbuilds", name),
+                        os.path.join(repo_path, name))
+
+    mtimes = iter(range(1000, 100000, 1000))
+
+    def make_old():
+        # recently changed files can't be trusted
+        mtime = next(mtimes)
+        for base, dirs, files in os.walk(repo_path):
+            for name in files + [""]:
+                path = os.path.join(base, name)
+                if os.path.getmtime(path) > 100000:
+                    os.utime(path, (mtime, mtime))
+
+    def get_packages():
+        packages = list(srcinfo.iter_packages(repo_path))
+        return _package_set(packages), capsys.readouterr()[0]
+
+    make_old()
+    packages, out = get_packages()
+    assert "unchanged" not in out
+    new_packages, out = get_packages()
+    assert new_packages == packages
+    assert "Found 2 PKGBUILD files, 2 unchanged since the last run" in out
+    assert "Parsing" not in out
+
+    # changing one only invalidates that one
+    dtc_path = os.path.join(repo_path, "dtc", "PKGBUILD")
+    with open(dtc_path, "rb") as h:
+        dtc = h.read()
+    with open(dtc_path, "wb") as h:
+        h.write(dtc.replace(b"pkgrel=1", b"pkgrel=2"))
+    make_old()
+    new_packages, out = get_packages()
+    assert "1 unchanged" in out
+    assert "1.4.4-2" in [p[3] for p in new_packages]
+    assert len(new_packages) == len(packages)
+
+    # new ones get found
+    shutil.copytree(os.path.join(DATA_DIR, "pkgbuilds", "mingw-w64-gtk3"),
+                    os.path.join(repo_path, "mingw-w64-gtk3"))
+    make_old()
+    assert "Found 3 PKGBUILD files, 2 unchanged" in get_packages()[1]
+    shutil.rmtree(os.path.join(repo_path, "mingw-w64-gtk3"))
+    assert "Found 2 PKGBUILD files, 2 unchanged" in get_packages()[1]
+
+    # broken or from somewhere else
+    snapshot = srcinfocache.PackageSnapshot(snapshot_path)
+    assert snapshot.load(repo_path, srcinfo._SNAPSHOT_SCHEMA) is not None
+    assert snapshot.load(repo_path, None) is None
+    assert snapshot.load(str(tmpdir), srcinfo._SNAPSHOT_SCHEMA) is None
+    with open(snapshot_path, "r+b") as h:
+        h.seek(20)
+        h.write(b"garbage")
+    assert snapshot.load(repo_path, srcinfo._SNAPSHOT_SCHEMA) is None
+    assert "unchanged" not in get_packages()[1]
+
+
+def test_iter_packages_snapshot_keeps_cache(tmpdir, capsys):
+    cache = srcinfocache.SQLiteCache(
+        str(tmpdir.join("c.db")), None, max_age_runs=3)
+    srcinfocache.set_cache(cache)
+    srcinfocache.set_fingerprint_index(
+        srcinfocache.FingerprintIndex(str(tmpdir.join("index.json"))))
+    srcinfocache.set_package_snapshot(
+        srcinfocache.PackageSnapshot(str(tmpdir.join("snapshot.bin"))))
+
+    repo_path = str(tmpdir.join("repo"))
+    for name in ["dtc", "mingw-w64-fltk"]:
+        shutil.copytree(os.path.join(DATA_DIR, "pkgbuilds", name),
+                        os.path.join(repo_path, name))
+    for base, dirs, files in os.walk(repo_path):
+        for name in files + [""]:
+            os.utime(os.path.join(base, name), (1000, 1000))
+
+    list(srcinfo.iter_packages(repo_path))
+    assert cache.stats()["entries"] == 2
+    # served from the snapshot, the cache entries still count as used
+    for i in range(cache.max_age_runs + 2):
+        list(srcinfo.iter_packages(repo_path))
+        assert "2 unchanged" in capsys.readouterr()[0]
+    assert cache.stats()["entries"] == 2
+    assert len(list(cache.iter_entries())) == 2
+
+
+def _has_git():
+    try:
+        subprocess.check_output(["git", "--version"])
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+@pytest.mark.skipif(not _has_git(), reason="git not available")
+def test_iter_packages_incremental(tmpdir, capsys):
+    srcinfocache.set_cache(srcinfocache.JSONCache(str(tmpdir.join("c"))))
+    srcinfocache.set_fingerprint_index(
+        srcinfocache.FingerprintIndex(str(tmpdir.join("index.json"))))
+    srcinfocache.set_package_snapshot(
+        srcinfocache.PackageSnapshot(str(tmpdir.join("snapshot.bin"))))
+
+    repo_path = str(tmpdir.join("repo"))
+    for name in ["dtc", "mingw-w64-fltk"]:
+        shutil.copytree(os.path.join(DATA_DIR, "pkgbuilds", name),
+                        os.path.join(repo_path, name))
+
+    def git(*args):
+        subprocess.check_output(
+            ["git", "-c", "user.name=m2h", "-c", "user.email=m2h@localhost"] +
+            list(args), cwd=repo_path)
+
+    git("init", "-q")
+    git("add", "-A")
+    git("commit", "-q", "-m", "init")
+
+    def get_versions():
+        packages = srcinfo.iter_packages(repo_path, incremental=True)
+        versions = dict((p.pkgname, p.build_version) for p in packages)
+        return versions, capsys.readouterr()[0]
+
+    versions, out = get_versions()
+    assert versions["dtc"] == "1.4.4-1"
+    assert "unchanged" not in out
+    new_versions, out = get_versions()
+    assert new_versions == versions
+    assert "2 unchanged since the last run" in out
+
+    dtc_path = os.path.join(repo_path, "dtc", "PKGBUILD")
+    with open(dtc_path, "rb") as h:
+        dtc = h.read()
+
+    def write_dtc(data):
+        with open(dtc_path, "wb") as h:
+            h.write(data)
+
+    # changed in the work tree, then reverted
+    write_dtc(dtc.replace(b"pkgrel=1", b"pkgrel=2"))
+    new_versions, out = get_versions()
+    assert new_versions["dtc"] == "1.4.4-2"
+    assert "1 unchanged" in out
+    write_dtc(dtc)
+    assert get_versions()[0] == versions
+
+    # committed, a new untracked one and a deleted one
+    write_dtc(dtc.replace(b"pkgrel=1", b"pkgrel=3"))
+    git("commit", "-q", "-a", "-m", "bump")
+    shutil.copytree(os.path.join(DATA_DIR, "pkgbuilds", "mingw-w64-gtk3"),
+                    os.path.join(repo_path, "mingw-w64-gtk3"))
+    shutil.rmtree(os.path.join(repo_path, "mingw-w64-fltk"))
+    new_versions, out = get_versions()
+    assert new_versions["dtc"] == "1.4.4-3"
+    assert "mingw-w64-x86_64-gtk3" in new_versions
+    assert "mingw-w64-x86_64-fltk" not in new_versions
+    assert "Found 2 PKGBUILD files" in out
+
+
+def _package_set(packages):
+    return set((p.pkgbuild_path, p.pkgbase, p.pkgname, p.build_version,
+                p.pkgdesc) +
+               tuple(tuple(getattr(p, a)) for a in srcinfo._LIST_ATTRIBUTES)
+               for p in packages)
+
+
+def _iter_pkgbuild_fixtures():
+    base = os.path.join(DATA_DIR, "pkgbuilds")
+    for name in sorted(os.listdir(base)):
+        if os.path.isdir(os.path.join(base, name)):
+            yield os.path.join(base, name, "PKGBUILD")
+
+
+def test_pkgbuild_srcinfo():
+    supported = 0
+    for path in _iter_pkgbuild_fixtures():
+        with open(path, "rb") as h:
+            text = h.read().decode("utf-8")
+        with open(os.path.join(os.path.dirname(path), ".SRCINFO"),
+                  "rb") as h:
+            real = h.read().decode("utf-8")
+
+        try:
+            static = pkgbuild.get_srcinfo_for_text(text)
+        except pkgbuild.UnsupportedError:
+            continue
+        supported += 1
+        assert _package_set(
+            srcinfo.SrcInfoPackage.for_srcinfo(path, static)) == \
+            _package_set(srcinfo.SrcInfoPackage.for_srcinfo(path, real))
+    assert supported == 4
+
+
+@pytest.mark.skipif(not _has_makepkg_mingw(),
+                    reason="makepkg-mingw not installed")
+def test_pkgbuild_srcinfo_makepkg():
+    for path in _iter_pkgbuild_fixtures():
+        with open(path, "rb") as h:
+            text = h.read().decode("utf-8")
+        try:
+            static = pkgbuild.get_srcinfo_for_text(text)
+        except pkgbuild.UnsupportedError:
+            continue
+        real = subprocess.check_output(
+            ["bash", "/usr/bin/makepkg-mingw", "--printsrcinfo", "-p",
+             "PKGBUILD"], cwd=os.path.dirname(path)).decode("utf-8")
+        assert _package_set(
+            srcinfo.SrcInfoPackage.for_srcinfo(path, static)) == \
+            _package_set(srcinfo.SrcInfoPackage.for_srcinfo(path, real))
+
+
+def _has_bash():
+    try:
+        subprocess.check_output(["bash", "-c", "true"])
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+# sources a PKGBUILD and prints the values makepkg reads from the top level
+_BASH_DUMP = r"""
+source PKGBUILD
+for _name in "$@"; do
+    eval "_values=(\"\${${_name}[@]}\")"
+    printf '%s\0%s\0' "$_name" "${#_values[@]}"
+    if [ ${#_values[@]} -gt 0 ]; then
+        printf '%s\0' "${_values[@]}"
+    fi
+done
+"""
+
+
+def _bash_srcinfo_bases(path):
+    # what bash evaluates: the pkgbase sections and pkgname lists, one per
+    # environment
+    names = ["pkgbase", "pkgname"] + pkgbuild.SINGLE_VALUED + \
+        pkgbuild.MULTI_VALUED
+    result = []
+    for environment in pkgbuild.ENVIRONMENTS:
+        env = dict(os.environ)
+        env.update(environment)
+        fields = subprocess.check_output(
+            ["bash", "-c", _BASH_DUMP, "bash"] + names,
+            cwd=os.path.dirname(path), env=env).decode("utf-8").split("\0")
+        values = {}
+        i = 0
+        while i < len(fields) - 1:
+            name, count = fields[i], int(fields[i + 1])
+            values[name] = [" ".join(v.split())
+                            for v in fields[i + 2:i + 2 + count]]
+            i += 2 + count
+        pkgbase = values.pop("pkgbase") or values["pkgname"][:1]
+        attributes = dict((k, v) for k, v in values.items()
+                          if k != "pkgname" and v and v[0])
+        result.append((pkgbase[0], values["pkgname"], attributes))
+    return result
+
+
+def _srcinfo_bases(text):
+    # the same from srcinfo text, ignoring the pkgname sections content
+    result = []
+    for line in text.splitlines():
+        key, sep, value = line.strip().partition(" = ")
+        if key == "pkgbase":
+            attributes = {}
+            result.append((value, [], attributes))
+            in_base = True
+        elif key == "pkgname":
+            result[-1][1].append(value)
+            in_base = False
+        elif sep and in_base:
+            attributes.setdefault(key, []).append(value)
+    return result
+
+
+@pytest.mark.skipif(not _has_bash(), reason="bash not installed")
+def test_pkgbuild_fixtures_bash():
+    # the fixtures should match what bash makes of the PKGBUILD files, see
+    # tests/data/pkgbuilds/update-srcinfo.sh for updating them
+    for path in _iter_pkgbuild_fixtures():
+        with open(os.path.join(os.path.dirname(path), ".SRCINFO"),
+                  "rb") as h:
+            real = h.read().decode("utf-8")
+        assert _srcinfo_bases(real) == _bash_srcinfo_bases(path), path
+
+
+def test_pkgbuild_evaluate():
+    env = pkgbuild.ENVIRONMENTS[0]
+    variables, functions = pkgbuild.evaluate("""\
+_realname=python-foo
+_base=${_realname#python-}  # comment
+pkgver=1.2.3_rc1; _v=${pkgver//_/-}
+_short=${pkgver%.*} _major=${pkgver%%.*}
+depends=("${MINGW_PACKAGE_PREFIX}-${_base}" 'b c')
+depends+=(d)
+makedepends=("${depends[@]}" $_major)
+_opt=${_unset:-default}
+pkgdesc="a \\"$_realname\\" \\$HOME"
+package_foo() { true; }
+build() {
+  if true; then echo $(foo)
+  fi
+}
+""", env)
+    assert variables["_base"] == ["foo"]
+    assert variables["_v"] == ["1.2.3-rc1"]
+    assert variables["_short"] == ["1.2"]
+    assert variables["_major"] == ["1"]
+    assert variables["depends"] == ["mingw-w64-x86_64-foo", "b c", "d"]
+    assert variables["makedepends"] == variables["depends"] + ["1"]
+    assert variables["_opt"] == ["default"]
+    assert variables["pkgdesc"] == ['a "python-foo" $HOME']
+    assert list(functions.keys()) == ["package_foo", "build"]
+
+    # the closing brace doesn't have to be in the first column
+    # "*" joins the elements into one word
+    variables = pkgbuild.evaluate(
+        'b=(x y); d=("${b[*]}"); e="${b[*]}"; f=("${b[@]}")', env)[0]
+    assert variables["d"] == ["x y"]
+    assert variables["e"] == ["x y"]
+    assert variables["f"] == ["x", "y"]
+    # only "${" needs a matching "}"
+    assert pkgbuild.evaluate(
+        "a=1; b=${a:-${a}}; c=2 ;", env)[0]["b"] == ["1"]
+
+    variables, functions = pkgbuild.evaluate("""\
+build() {
+  make
+  }
+depends=(bar)
+package_foo-a() {
+  cat <<-EOF
+\t}
+\tEOF
+  echo '}' "${x}" "$(echo "}")" # }
+  depends=(other)
+}
+""", env)
+    assert variables["depends"] == ["bar"]
+    assert list(functions.keys()) == ["build", "package_foo-a"]
+    assert "depends=(other)" in functions["package_foo-a"]
+
+    for text in ["foo=$(uname)", "foo=`uname`", "if true; then a=1; fi",
+                 "foo=$undefined", "foo=bar make", "foo=a{b,c}",
+                 "_d=\"a b\"; foo=($_d)", "build() {\n  make\n",
+                 "build() {\n  cat <<EOF\n}\n", "build() {\nfoo() {\n}\n}",
+                 "a=${b:-{}}", "a=x;;b=y", ";a=x", "a=(x;y)", "a=${b[*]}"]:
+        with pytest.raises(pkgbuild.UnsupportedError):
+            pkgbuild.evaluate(text, env)